@@ -1,13 +1,21 @@
+import asyncio
 import base64
+import contextlib
 import datetime
 import hashlib
 import hmac
 import json
 import logging
+import os
+import socket
+import ssl
+import threading
 import time
 import typing as t
 import uuid
-from tempfile import NamedTemporaryFile
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from tempfile import TemporaryDirectory
 from urllib.parse import urlsplit
 
 import requests
@@ -18,26 +26,194 @@ from django.conf import settings
 from django.utils import timezone
 from requests.adapters import HTTPAdapter
 from tenacity import retry, stop_after_attempt, wait_exponential
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
 from urllib3.util.retry import Retry
 
+from eos import timing
+from eos.circuitbreaker import CircuitBreaker
+from eos.concurrency import AdaptiveConcurrency, CallOutcome
+from eos.ratelimit import RateLimiter
+
 logger = logging.getLogger(__name__)
 
 
+class TimedHTTPConnection(HTTPConnection):
+    def _new_conn(self) -> socket.socket:
+        with timing.current().stage("connect"):
+            return super()._new_conn()
+
+
+class TimedHTTPSConnection(HTTPSConnection):
+    """
+    Records the TCP connect and the TLS handshake of each new connection as separate stages.
+    """
+
+    def _new_conn(self) -> socket.socket:
+        start = time.perf_counter()
+        try:
+            return super()._new_conn()
+        finally:
+            self.tcp_connect_time = time.perf_counter() - start
+            timing.current().add("connect", self.tcp_connect_time)
+
+    def connect(self) -> None:
+        self.tcp_connect_time = 0.0
+        start = time.perf_counter()
+        try:
+            super().connect()
+        finally:
+            timing.current().add("tls", time.perf_counter() - start - self.tcp_connect_time)
+
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
 class RetryAdapter(HTTPAdapter):
-    def __init__(self, *args: t.Any, **kwargs: t.Any) -> None:
-        retries: int = 3
-        status_forcelist: t.Tuple = (500, 503, 504)
-        retry = Retry(
-            total=3,
-            read=3,
-            connect=retries,
-            backoff_factor=0.3,
-            status_forcelist=status_forcelist,
-            raise_on_status=False,
-        )
-        kwargs["max_retries"] = retry
+    def __init__(
+        self, *args: t.Any, ssl_context: t.Optional[ssl.SSLContext] = None, retry: bool = True, **kwargs: t.Any
+    ) -> None:
+        # must be set before super().__init__ as that builds the pool manager
+        self.ssl_context = ssl_context
+        if retry:
+            retries: int = 3
+            status_forcelist: t.Tuple = (500, 503, 504)
+            kwargs["max_retries"] = Retry(
+                total=3,
+                read=3,
+                connect=retries,
+                backoff_factor=0.3,
+                status_forcelist=status_forcelist,
+                raise_on_status=False,
+            )
         super().__init__(*args, **kwargs)
 
+    def init_poolmanager(self, *args: t.Any, **kwargs: t.Any) -> None:
+        if self.ssl_context is not None:
+            kwargs["ssl_context"] = self.ssl_context
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": TimedHTTPConnectionPool,
+            "https": TimedHTTPSConnectionPool,
+        }
+
+
+@contextlib.contextmanager
+def _pem_file(data: str) -> t.Iterator[str]:
+    """
+    Yield a path that `ssl` can read `data` from. An anonymous memfd is used where the platform has one so that
+    key material never reaches the disk, otherwise a private temporary directory that is removed straight away.
+    """
+    if hasattr(os, "memfd_create"):
+        fd = os.memfd_create("amex-pem")
+        try:
+            os.write(fd, data.encode())
+            yield f"/proc/self/fd/{fd}"
+        finally:
+            os.close(fd)
+    else:
+        with TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "amex.pem")
+            with open(os.open(path, os.O_CREAT | os.O_WRONLY, 0o600), "w") as file:
+                file.write(data)
+            yield path
+
+
+def make_ssl_context(key: str, cert: str) -> ssl.SSLContext:
+    """
+    Build a client SSLContext holding the Amex mTLS key and certificate in memory.
+    """
+    context = ssl.create_default_context()
+    with _pem_file(key) as key_path, _pem_file(cert) as cert_path:
+        context.load_cert_chain(certfile=cert_path, keyfile=key_path)
+    return context
+
+
+class SecretCache:
+    """
+    Process-wide cache for secrets fetched from Key Vault.
+
+    Values are loaded on first use and kept for `ttl` seconds. Once an entry is within `refresh_margin` seconds of
+    expiring it is reloaded on a background thread while the current value keeps being served, so callers only block
+    on the vault when an entry has expired outright or was invalidated.
+    """
+
+    def __init__(self, ttl: float, refresh_margin: float) -> None:
+        self.ttl = ttl
+        self.refresh_margin = refresh_margin
+        self._reset()
+        os.register_at_fork(after_in_child=self._reset_lock)
+
+    def _reset(self) -> None:
+        self._entries: t.Dict[str, t.Tuple[float, t.Any]] = {}
+        self._loaders: t.Dict[str, t.Callable[[], t.Any]] = {}
+        self._reset_lock()
+
+    def _reset_lock(self) -> None:
+        # a lock held by another thread at fork time would never be released in the child,
+        # and neither would a refresh thread that was running in the parent.
+        self._lock = threading.Lock()
+        self._refreshing: t.Set[str] = set()
+
+    def get(self, key: str, loader: t.Callable[[], t.Any]) -> t.Any:
+        with self._lock:
+            self._loaders[key] = loader
+            entry = self._entries.get(key)
+
+        if entry is None:
+            return self._load(key)
+
+        age = time.monotonic() - entry[0]
+        if age >= self.ttl:
+            return self._load(key)
+        if age >= self.ttl - self.refresh_margin:
+            self._refresh_in_background(key)
+        return entry[1]
+
+    def _load(self, key: str) -> t.Any:
+        value = self._loaders[key]()
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+        return value
+
+    def _refresh(self, key: str) -> None:
+        try:
+            self._load(key)
+        except Exception:
+            logger.exception(f"Background refresh of cached secret '{key}' failed")
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def _refresh_in_background(self, key: str) -> None:
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+        threading.Thread(target=self._refresh, args=(key,), name=f"secret-refresh-{key}", daemon=True).start()
+
+    def invalidate(self, key: t.Optional[str] = None) -> None:
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+
+secret_cache = SecretCache(
+    ttl=settings.AMEX_SECRET_CACHE_TTL,
+    refresh_margin=settings.AMEX_SECRET_CACHE_REFRESH_MARGIN,
+)
+
+# Amex answers with one of these when it does not accept our client id/secret or certificate
+CREDENTIALS_REJECTED_STATUSES = (401, 403)
+# responses that mean Amex is struggling, as opposed to rejecting a particular request
+OVERLOADED_STATUSES = (429, 500, 503, 504)
 
 BASE_URI = "/marketing/v4/smartoffers/offers/merchants"
 
@@ -50,33 +226,59 @@ class MerchantRegApi:
     }
     DATE_FORMAT = "%m/%d/%Y"
 
-    def __init__(self, *args: t.List[t.Any], **kwargs: t.Dict[str, t.Any]) -> None:
+    def __init__(
+        self,
+        *args: t.List[t.Any],
+        rate_limiter: t.Optional[RateLimiter] = None,
+        concurrency: t.Optional[AdaptiveConcurrency] = None,
+        circuit_breaker: t.Optional[CircuitBreaker] = None,
+        **kwargs: t.Any,
+    ) -> None:
+        self.rate_limiter = rate_limiter
+        self.concurrency = concurrency
+        self.circuit_breaker = circuit_breaker
         self.session = requests.Session()
-        self.session.mount(settings.AMEX_API_HOST, RetryAdapter())
+        self.ssl_context: t.Optional[ssl.SSLContext] = None
+        self.last_used = time.monotonic()
+        self._session_lock = threading.Lock()
+        self._mount(None)
 
-    def _write_tmp_files(self, key: str, cert: str) -> t.Tuple[str, ...]:
-        paths = []
-        for data in (key, cert):
-            file = NamedTemporaryFile(delete=False)
-            paths.append(file.name)
-            file.write(data.encode())
-            file.close()
-        return tuple(paths)
+    def _mount(self, ssl_context: t.Optional[ssl.SSLContext]) -> None:
+        self.ssl_context = ssl_context
+        self.session.mount(
+            settings.AMEX_API_HOST,
+            RetryAdapter(
+                ssl_context=ssl_context,
+                # every attempt must take its own token from a rate limit, so retries are left to the tasks
+                retry=self.rate_limiter is None,
+                pool_connections=1,
+                pool_maxsize=settings.AMEX_POOL_MAXSIZE,
+            ),
+        )
+
+    def _prepare_session(self, ssl_context: t.Optional[ssl.SSLContext]) -> None:
+        # only remount when the cached context has been replaced, so pooled connections survive between calls
+        with self._session_lock:
+            if ssl_context is not self.ssl_context:
+                self._mount(ssl_context)
+            elif time.monotonic() - self.last_used > settings.AMEX_POOL_IDLE_TIMEOUT:
+                # load balancers quietly drop idle connections; start afresh rather than find out mid-request
+                logger.debug("Amex connection pool idle, closing pooled connections")
+                self.session.get_adapter(settings.AMEX_API_HOST).close()
+            self.last_used = time.monotonic()
 
     def client_id_and_secret(self) -> t.Tuple[str, str]:
         if settings.TESTING or settings.TEST_RUNNER_SET:
-            client_id = settings.AMEX_CLIENT_ID
-            client_secret = settings.AMEX_CLIENT_SECRET
-        else:
-            client = self.connect_to_vault()
-            client_id = client.get_secret("amex-clientId").value
-            client_secret = client.get_secret("amex-clientSecret").value
-            if client_id and client_secret:
-                client_id = json.loads(client_id)["value"]
-                client_secret = json.loads(client_secret)["value"]
-            else:
-                raise ValueError
-        return client_id, client_secret
+            return settings.AMEX_CLIENT_ID, settings.AMEX_CLIENT_SECRET
+        return secret_cache.get("client", self._load_client_id_and_secret)
+
+    def _load_client_id_and_secret(self) -> t.Tuple[str, str]:
+        client = self.connect_to_vault()
+        client_id = client.get_secret("amex-clientId").value
+        client_secret = client.get_secret("amex-clientSecret").value
+        if not (client_id and client_secret):
+            raise ValueError
+        return json.loads(client_id)["value"], json.loads(client_secret)["value"]
 
     def _make_headers(self, httpmethod: str, resource_uri: str, payload: str) -> dict:
         current_time_ms = str(round(time.time() * 1000))
@@ -106,21 +308,57 @@ class MerchantRegApi:
             f',nonce="{nonce}",bodyhash="{bodyhash}",mac="{mac}"',
         }
 
+    def _call_slot(self) -> t.ContextManager[CallOutcome]:
+        if self.concurrency is None:
+            return contextlib.nullcontext(CallOutcome())
+        return self.concurrency.slot(time.monotonic)
+
+    def _send(
+        self, method: str, resource_uri: str, headers: dict, payload: str, probe: t.Optional[str]
+    ) -> requests.Response:
+        failed = True
+        try:
+            with self._call_slot() as outcome:
+                response = getattr(self.session, method.lower())(
+                    settings.AMEX_API_HOST + resource_uri,
+                    headers=headers,
+                    data=payload,
+                    timeout=(3.05, 10),
+                )
+                outcome.failed = response.status_code in OVERLOADED_STATUSES
+                # rejected credentials fail every call alike, so they open the circuit too
+                failed = outcome.failed or response.status_code in CREDENTIALS_REJECTED_STATUSES
+            return response
+        finally:
+            if self.circuit_breaker is not None:
+                self.circuit_breaker.record(failed, probe)
+
     def _call_api(
         self, method: str, resource_uri: str, data: t.Union[dict, None] = None
     ) -> t.Tuple[requests.Response, datetime.datetime]:
-        client_priv_path, client_cert_path = self.load_cert_from_vault()
+        probe = None
+        if self.circuit_breaker is not None:
+            probe = self.circuit_breaker.before_call()
+        timings = timing.current()
+        with timings.stage("vault"):
+            self._prepare_session(self.load_cert_from_vault())
 
         payload = json.dumps(data)
-        headers = self._make_headers(method, resource_uri, payload)
+        if self.rate_limiter is not None:
+            with timings.stage("rate_limit"):
+                self.rate_limiter.acquire()
+        # sign after waiting for the rate limiter as the MAC includes a timestamp
+        with timings.stage("sign"):
+            headers = self._make_headers(method, resource_uri, payload)
         timestamp = timezone.now()
-        response = getattr(self.session, method.lower())(
-            settings.AMEX_API_HOST + resource_uri,
-            cert=(client_cert_path, client_priv_path),
-            headers=headers,
-            data=payload,
-            timeout=(3.05, 10),
-        )
+        with timings.stage("request"):
+            response = self._send(method, resource_uri, headers, payload, probe)
+        # elapsed runs from sending the request to parsing the response headers, including any new connection
+        connection_setup = timings.stages.get("connect", 0.0) + timings.stages.get("tls", 0.0)
+        timings.add("server", max(0.0, response.elapsed.total_seconds() - connection_setup))
+        if response.status_code in CREDENTIALS_REJECTED_STATUSES:
+            logger.warning(f"Amex rejected our credentials ({response.status_code}), invalidating cached secrets")
+            secret_cache.invalidate()
         return response, timestamp
 
     def add_merchant(
@@ -158,6 +396,16 @@ class MerchantRegApi:
         )
         return self._call_api("DELETE", f"{BASE_URI}/{mid}", data)
 
+    def warm_secrets(self) -> None:
+        """
+        Populate (or refresh) the process-wide secret cache ahead of the first request.
+        """
+        try:
+            self.client_id_and_secret()
+            self.load_cert_from_vault()
+        except Exception:
+            logger.exception("Could not warm the Amex secret cache")
+
     def connect_to_vault(self) -> SecretClient:
         if settings.KEY_VAULT is None:
             raise Exception("Vault Error: settings.KEY_VAULT not set")
@@ -169,23 +417,55 @@ class MerchantRegApi:
         wait=wait_exponential(multiplier=1, min=3, max=12),
         reraise=True,
     )
-    def load_cert_from_vault(self) -> t.Tuple[t.Optional[str], ...]:
+    def _load_cert(self) -> ssl.SSLContext:
         client = self.connect_to_vault()
-        client_cert_path = None
-        client_priv_path = None
+        amex_cert = client.get_secret("amex-cert").value
+        if not amex_cert:
+            raise ValueError
+        return make_ssl_context(
+            json.loads(amex_cert)["key"],
+            json.loads(amex_cert)["cert"],
+        )
 
+    def load_cert_from_vault(self) -> t.Optional[ssl.SSLContext]:
+        if not settings.AMEX_MTLS:
+            return None
         try:
-            amex_cert = client.get_secret("amex-cert").value
-
-            if amex_cert:
-                client_priv_path, client_cert_path = self._write_tmp_files(
-                    json.loads(amex_cert)["key"],
-                    json.loads(amex_cert)["cert"],
-                )
-            else:
-                raise ValueError
-
+            return secret_cache.get("cert", self._load_cert)
         except ServiceRequestError:
             logger.error("Could not retrieve cert/key data from vault")
+            return None
+
+
+class AsyncMerchantRegApi:
+    """
+    asyncio interface to MerchantRegApi allowing up to `max_in_flight` concurrent calls.
+
+    requests has no async transport, so each call runs on a thread pool of the same size over the wrapped agent's
+    pooled session. Payloads and HMAC signing are exactly those of the wrapped MerchantRegApi.
+    """
+
+    def __init__(self, api: t.Optional[MerchantRegApi] = None, max_in_flight: int = 10) -> None:
+        self.api = api or MerchantRegApi()
+        self.max_in_flight = max_in_flight
+        self.executor = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix="amex")
+        self._in_flight = asyncio.Semaphore(max_in_flight)
+
+    async def _run(self, func: t.Callable[..., t.Any], *args: t.Any) -> t.Any:
+        async with self._in_flight:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, partial(func, *args))
+
+    async def add_merchant(
+        self,
+        mid: str,
+        merchant_slug: str,
+        start_date: datetime.date,
+        end_date: datetime.date,
+    ) -> t.Tuple[requests.Response, datetime.datetime]:
+        return await self._run(self.api.add_merchant, mid, merchant_slug, start_date, end_date)
+
+    async def delete_merchant(self, mid: str, merchant_slug: str) -> t.Tuple[requests.Response, datetime.datetime]:
+        return await self._run(self.api.delete_merchant, mid, merchant_slug)
 
-        return client_priv_path, client_cert_path
+    def close(self) -> None:
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,213 @@
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import math
+import random
+import re
+import threading
+import time
+import typing as t
+import uuid
+from email.message import Message
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from eos.agents.amex import BASE_URI
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONFIG: dict = {
+    "client_id": "simulator",
+    "client_secret": "simulator-secret",
+    # seconds, drawn from a log-normal distribution with this median and shape, never more than max
+    "latency": {"median": 0.15, "sigma": 0.5, "max": 10.0},
+    # proportion of otherwise successful calls answered with each status code
+    "errors": {"500": 0.005, "503": 0.005},
+    # requests per second (0 for no limit) and burst size beyond which calls are answered with 429
+    "throttle": {"rate": 0, "burst": 10},
+    # milliseconds a signed timestamp may differ from the simulator's clock
+    "max_clock_skew": 300000,
+}
+
+MAC_HEADER = re.compile(r'(\w+)="([^"]*)"')
+
+# error bodies as saved onto BatchItem, so they must fit its error fields
+ERRORS = {
+    400: ("400.01", "Invalid Request", "Merchant request could not be processed"),
+    401: ("401.01", "Unauthorized", "MAC signature verification failed"),
+    404: ("404.01", "Not Found", "No such resource"),
+    429: ("429.01", "Throttled", "Rate limit exceeded"),
+    500: ("500.01", "Server Error", "Internal server error"),
+    503: ("503.01", "Server Error", "Service temporarily unavailable"),
+    504: ("504.01", "Server Error", "Upstream timed out"),
+}
+
+
+def load_config(path: t.Optional[str] = None) -> dict:
+    """
+    DEFAULT_CONFIG overlaid with the JSON object in `path`, one level deep.
+    """
+    config = json.loads(json.dumps(DEFAULT_CONFIG))
+    if path is None:
+        return config
+    with open(path) as file:
+        overrides = json.load(file)
+    for key, value in overrides.items():
+        if isinstance(value, dict) and key != "errors":
+            config.setdefault(key, {}).update(value)
+        else:
+            config[key] = value
+    return config
+
+
+def percentiles(values: t.Sequence[float], points: t.Iterable[int] = (50, 90, 95, 99)) -> t.Dict[str, float]:
+    ordered = sorted(values)
+    if not ordered:
+        return {}
+    return {f"p{p}": round(ordered[min(len(ordered) - 1, math.ceil(len(ordered) * p / 100) - 1)], 4) for p in points}
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self) -> bool:
+        if not self.rate:
+            return True
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class AmexSimulator(ThreadingHTTPServer):
+    """
+    Local stand-in for the Amex merchant registration endpoint, for load testing.
+
+    Requests to BASE_URI must carry an Authorization MAC header signed with the configured client secret exactly as
+    MerchantRegApi signs them. Valid calls are answered after a configurable latency with either success, throttling
+    (429) once the configured rate is exceeded, or an error status from the configured mix. The status and latency of
+    every answer are recorded for `stats()`.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address: t.Tuple[str, int], config: dict) -> None:
+        super().__init__(address, SimulatorHandler)
+        self.config = config
+        self.bucket = TokenBucket(config["throttle"]["rate"], config["throttle"]["burst"])
+        self.calls: t.List[t.Tuple[int, float]] = []
+        self.calls_lock = threading.Lock()
+
+    def verify(self, method: str, path: str, host: str, headers: Message, body: bytes) -> bool:
+        client_id, secret = self.config["client_id"], self.config["client_secret"].encode()
+        fields = dict(MAC_HEADER.findall(headers.get("Authorization", "")))
+        if headers.get("X-AMEX-API-KEY") != client_id or fields.get("id") != client_id:
+            return False
+        try:
+            skew = abs(time.time() * 1000 - int(fields["ts"]))
+        except (KeyError, ValueError):
+            return False
+        if skew > self.config["max_clock_skew"]:
+            return False
+
+        bodyhash = base64.b64encode(hmac.new(secret, body, digestmod=hashlib.sha256).digest()).decode()
+        message = f"{fields['ts']}\n{fields.get('nonce', '')}\n{method}\n{path}\n{host}\n443\n{bodyhash}\n"
+        mac = base64.b64encode(hmac.new(secret, message.encode(), digestmod=hashlib.sha256).digest()).decode()
+        return hmac.compare_digest(bodyhash, fields.get("bodyhash", "")) and hmac.compare_digest(
+            mac, fields.get("mac", "")
+        )
+
+    def latency(self) -> float:
+        latency = self.config["latency"]
+        return min(latency["max"], random.lognormvariate(math.log(latency["median"]), latency["sigma"]))
+
+    def choose_status(self) -> int:
+        if not self.bucket.take():
+            return 429
+        roll = random.random()
+        for status, rate in self.config["errors"].items():
+            roll -= rate
+            if roll < 0:
+                return int(status)
+        return 200
+
+    def record(self, status: int, latency: float) -> None:
+        with self.calls_lock:
+            self.calls.append((status, latency))
+
+    def stats(self) -> dict:
+        with self.calls_lock:
+            calls = list(self.calls)
+        statuses: t.Dict[int, int] = {}
+        for status, _ in calls:
+            statuses[status] = statuses.get(status, 0) + 1
+        return {
+            "calls": len(calls),
+            "statuses": statuses,
+            "latency": percentiles([latency for _, latency in calls]),
+        }
+
+
+class SimulatorHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: AmexSimulator
+
+    def do_POST(self) -> None:
+        self._handle()
+
+    def do_DELETE(self) -> None:
+        self._handle()
+
+    def _handle(self) -> None:
+        self.start = time.monotonic()
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        # merchants are added by POST to BASE_URI and deleted by DELETE of BASE_URI/<mid>
+        resource = self.path.rpartition("/")[0] if self.command == "DELETE" else self.path
+        if resource != BASE_URI:
+            self._error(404)
+            return
+        if not self.server.verify(self.command, self.path, self.headers.get("Host", ""), self.headers, body):
+            self._error(401)
+            return
+        try:
+            data = json.loads(body)
+        except ValueError:
+            self._error(400)
+            return
+
+        time.sleep(self.server.latency())
+        status = self.server.choose_status()
+        if status != 200:
+            self._error(status)
+            return
+        self._respond(200, {"merchantId": data.get("merchantId"), "correlationId": str(uuid.uuid4())})
+
+    def _error(self, status: int) -> None:
+        error_code, error_type, error_description = ERRORS.get(status, ERRORS[500])
+        self._respond(
+            status,
+            {"error_code": error_code, "error_type": error_type, "error_description": error_description},
+        )
+
+    def _respond(self, status: int, data: dict) -> None:
+        # record before answering so that the call is counted by the time the client sees the response
+        self.server.record(status, time.monotonic() - self.start)
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: t.Any) -> None:
+        logger.debug(format % args)
@@ -0,0 +1,112 @@
+import logging
+import time
+import typing as t
+import uuid
+
+from redis import Redis
+
+logger = logging.getLogger(__name__)
+
+# only the call holding the probe token named in ARGV[1] may settle the half-open state
+SETTLE_PROBE_SCRIPT = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("DEL", KEYS[1])
+end
+return 0
+"""
+
+
+class CircuitOpen(Exception):
+    def __init__(self, name: str, retry_after: float) -> None:
+        super().__init__(f"Circuit {name} is open, retry in {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker shared by every process using the same `name` through redis.
+
+    While closed, calls and failures are counted in fixed windows of `window` seconds. Once at least `min_calls` calls
+    in a window have failed at `failure_rate` or more the circuit opens, and `before_call` raises CircuitOpen for
+    `reset_timeout` seconds. After that the circuit is half-open: one probe call at a time is let through, and its
+    outcome either closes the circuit again or re-opens it for another `reset_timeout`. `before_call` hands the probe
+    a token, and only a `record` passing that token back counts as the probe's outcome.
+    """
+
+    def __init__(
+        self,
+        redis: Redis,
+        name: str,
+        failure_rate: float,
+        min_calls: int,
+        window: int,
+        reset_timeout: int,
+    ) -> None:
+        self.redis = redis
+        self.name = name
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.window = window
+        self.reset_timeout = reset_timeout
+
+        prefix = f"eos:circuit:{name}"
+        # present from the moment the circuit trips until a probe succeeds
+        self.tripped_key = f"{prefix}:tripped"
+        # present, with a TTL of reset_timeout, while no calls at all are allowed
+        self.open_key = f"{prefix}:open"
+        self.probe_key = f"{prefix}:probe"
+        self.counts_key = f"{prefix}:counts"
+        self._settle_probe = redis.register_script(SETTLE_PROBE_SCRIPT)
+
+    def before_call(self) -> t.Optional[str]:
+        """
+        Raise CircuitOpen if the call may not go ahead. Returns a probe token when the call is the half-open probe.
+        """
+        if not self.redis.exists(self.tripped_key):
+            return None
+        open_ttl = self.redis.pttl(self.open_key)
+        if open_ttl > 0:
+            raise CircuitOpen(self.name, open_ttl / 1000)
+        probe = uuid.uuid4().hex
+        if not self.redis.set(self.probe_key, probe, nx=True, px=self.reset_timeout * 1000):
+            # another worker is already probing
+            raise CircuitOpen(self.name, self.reset_timeout)
+        logger.info(f"Circuit {self.name} half-open, sending a probe call")
+        return probe
+
+    def record(self, failed: bool, probe: t.Optional[str] = None) -> None:
+        if self.redis.exists(self.tripped_key):
+            # calls that were already in flight when the circuit tripped, or that outlived their probe, are ignored
+            if probe is not None and self._settle_probe(keys=[self.probe_key], args=[probe]):
+                self._record_probe(failed)
+            return
+
+        bucket = self._bucket()
+        with self.redis.pipeline() as pipe:
+            pipe.hincrby(bucket, "calls", 1)
+            pipe.hincrby(bucket, "failures", int(failed))
+            pipe.expire(bucket, self.window * 2)
+            calls, failures, _ = pipe.execute()
+        if calls >= self.min_calls and failures / calls >= self.failure_rate:
+            logger.warning(f"Circuit {self.name} opening: {failures} of {calls} calls failed")
+            self._open()
+
+    def _record_probe(self, failed: bool) -> None:
+        if failed:
+            logger.warning(f"Circuit {self.name} probe failed, re-opening")
+            self._open()
+        else:
+            logger.info(f"Circuit {self.name} probe succeeded, closing")
+            self.redis.delete(self.tripped_key, self.open_key)
+
+    def _open(self) -> None:
+        with self.redis.pipeline() as pipe:
+            pipe.set(self.tripped_key, 1)
+            pipe.set(self.open_key, 1, px=self.reset_timeout * 1000)
+            pipe.delete(self.probe_key)
+            # start counting afresh once the circuit closes again
+            pipe.delete(self._bucket())
+            pipe.execute()
+
+    def _bucket(self) -> str:
+        return f"{self.counts_key}:{int(time.time() // self.window)}"
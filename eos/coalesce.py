@@ -0,0 +1,101 @@
+import logging
+import typing as t
+
+from mids.models import Batch, BatchItem, BatchItemAction, BatchItemStatus, MerchantRegistration
+
+logger = logging.getLogger(__name__)
+
+# (mid, provider_slug)
+Key = t.Tuple[str, str]
+
+
+def _key(item: BatchItem) -> Key:
+    return item.mid, item.provider_slug
+
+
+def _operation(item: BatchItem) -> t.Tuple[str, str, t.Any, t.Any]:
+    return item.action, item.merchant_slug, item.start_date, item.end_date
+
+
+def coalesce(batch: Batch, item_ids: t.List[int]) -> t.List[BatchItem]:
+    """
+    Collapse the operations not yet sent for the MIDs of a page of a batch's PENDING items, marking the items that
+    are left unnecessary SUPERSEDED. Returns them as they were before, which may include QUEUED items of other
+    batches.
+
+    The page is taken together with the QUEUED items no worker has tried yet, in the order they were created. An item
+    asking for the same as the one before it for its MID is a duplicate. An ADD followed by a DELETE is superseded by
+    the DELETE, which goes too if the MID was not registered beforehand, so that the pair cancels out. Items of
+    batches sent with force_send are left alone.
+
+    Must be called in the transaction holding the page's rows: the QUEUED items are locked until it commits, so that
+    no worker claims one meanwhile, and any being claimed already are left out.
+    """
+    if batch.force_send or not item_ids:
+        return []
+    page = list(BatchItem.objects.filter(id__in=item_ids))
+    keys = {_key(item) for item in page}
+    mids = {mid for mid, _ in keys}
+    queued = _queued(mids, keys)
+
+    groups: t.Dict[Key, t.List[BatchItem]] = {}
+    for item in sorted(queued + page, key=lambda item: item.id):
+        groups.setdefault(_key(item), []).append(item)
+    # a MID with other items on the way may be registered by the time these are sent
+    may_be_registered = _registered(mids) | _unsettled(mids, [item.id for item in queued + page])
+
+    superseded: t.List[BatchItem] = []
+    for key, items in groups.items():
+        superseded.extend(_collapse(items, may_be_registered=key in may_be_registered))
+    if superseded:
+        BatchItem.objects.filter(id__in=[item.id for item in superseded]).update(status=BatchItemStatus.SUPERSEDED)
+        logger.info(f"Superseded {len(superseded)} BatchItems while dispatching batch {batch.file_name}")
+    return superseded
+
+
+def _queued(mids: t.Set[str], keys: t.Set[Key]) -> t.List[BatchItem]:
+    """
+    The QUEUED items for `keys` that no worker has tried yet, locked, skipping any that a worker is claiming.
+    """
+    items = BatchItem.objects.select_for_update(skip_locked=True, of=("self",)).filter(
+        mid__in=mids, status=BatchItemStatus.QUEUED, attempts=0, batch__force_send=False
+    )
+    return [item for item in items if _key(item) in keys]
+
+
+def _registered(mids: t.Set[str]) -> t.Set[Key]:
+    return set(
+        MerchantRegistration.objects.filter(mid__in=mids, action=BatchItemAction.ADD).values_list(
+            "mid", "provider_slug"
+        )
+    )
+
+
+def _unsettled(mids: t.Set[str], item_ids: t.List[int]) -> t.Set[Key]:
+    """
+    The MIDs with items QUEUED or IN_FLIGHT besides `item_ids`.
+    """
+    return set(
+        BatchItem.objects.filter(mid__in=mids, status__in=(BatchItemStatus.QUEUED, BatchItemStatus.IN_FLIGHT))
+        .exclude(id__in=item_ids)
+        .values_list("mid", "provider_slug")
+    )
+
+
+def _collapse(items: t.List[BatchItem], may_be_registered: bool) -> t.List[BatchItem]:
+    """
+    The items of one MID, in order, that the items after them make unnecessary.
+    """
+    kept: t.List[BatchItem] = []
+    superseded = []
+    for item in items:
+        if item.action == BatchItemAction.DELETE and kept and kept[-1].action == BatchItemAction.ADD:
+            superseded.append(kept.pop())
+            if not kept and not may_be_registered:
+                superseded.append(item)
+                continue
+        if kept and _operation(kept[-1]) == _operation(item):
+            superseded.append(item)
+            continue
+        kept.append(item)
+    return superseded
@@ -0,0 +1,153 @@
+import contextlib
+import logging
+import threading
+import typing as t
+
+from redis import Redis
+from redis.exceptions import RedisError
+
+from eos import timing
+
+logger = logging.getLogger(__name__)
+
+
+def stats_key(name: str) -> str:
+    return f"eos:concurrency:{name}"
+
+
+class CallOutcome:
+    def __init__(self) -> None:
+        self.failed = False
+
+
+class AdaptiveConcurrency:
+    """
+    AIMD limit on the number of calls in flight from this process.
+
+    Latency and failure of every call are recorded. After each `window` calls the limit is raised by one if the p95
+    latency is within `latency_target` seconds and the failure rate is within `error_threshold`; otherwise it is
+    multiplied by `backoff`. The limit always stays between `minimum` and `maximum`.
+
+    The limit is logged after each window and, given `redis`, kept in a hash per worker process that expires `ttl`
+    seconds after the last window.
+    """
+
+    window = 20
+
+    def __init__(
+        self,
+        minimum: int,
+        maximum: int,
+        latency_target: float,
+        error_threshold: float,
+        backoff: float = 0.5,
+        redis: t.Optional[Redis] = None,
+        ttl: int = 300,
+    ) -> None:
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency_target = latency_target
+        self.error_threshold = error_threshold
+        self.backoff = backoff
+        self.redis = redis
+        self.ttl = ttl
+
+        self.limit = minimum
+        self.reason = "initial"
+        self.in_flight = 0
+        self._latencies: t.List[float] = []
+        self._failures = 0
+        self._cond = threading.Condition()
+
+    def acquire(self) -> None:
+        with self._cond:
+            self._cond.wait_for(lambda: self.in_flight < self.limit)
+            self.in_flight += 1
+
+    def release(self, latency: float, failed: bool) -> None:
+        with self._cond:
+            self.in_flight -= 1
+            self._latencies.append(latency)
+            self._failures += failed
+            adjusted = len(self._latencies) >= self.window
+            if adjusted:
+                self._adjust()
+            self._cond.notify_all()
+        if adjusted:
+            self.report()
+
+    @contextlib.contextmanager
+    def slot(self, clock: t.Callable[[], float]) -> t.Iterator[CallOutcome]:
+        """
+        Hold one of the in-flight slots for the duration of a call. The call is counted as failed if it raises, or
+        if the caller sets `failed` on the yielded outcome.
+        """
+        outcome = CallOutcome()
+        self.acquire()
+        start = clock()
+        try:
+            yield outcome
+        except Exception:
+            outcome.failed = True
+            raise
+        finally:
+            self.release(clock() - start, outcome.failed)
+
+    def _adjust(self) -> None:
+        latencies = sorted(self._latencies)
+        p95 = latencies[int(0.95 * (len(latencies) - 1))]
+        error_rate = self._failures / len(latencies)
+        self._latencies, self._failures = [], 0
+
+        if error_rate > self.error_threshold:
+            self._set_limit(int(self.limit * self.backoff), f"error rate {error_rate:.0%} > {self.error_threshold:.0%}")
+        elif p95 > self.latency_target:
+            self._set_limit(int(self.limit * self.backoff), f"p95 latency {p95:.2f}s > {self.latency_target:.2f}s")
+        else:
+            self._set_limit(self.limit + 1, f"healthy: p95 latency {p95:.2f}s, error rate {error_rate:.0%}")
+
+    def _set_limit(self, limit: int, reason: str) -> None:
+        limit = max(self.minimum, min(self.maximum, limit))
+        if limit == self.limit:
+            return
+        logger.info(
+            f"Amex concurrency limit {self.limit} -> {limit}: {reason}",
+            extra={"concurrency_limit": limit, "concurrency_previous_limit": self.limit, "concurrency_reason": reason},
+        )
+        self.limit = limit
+        self.reason = reason
+
+    def stats(self) -> t.Dict[str, t.Any]:
+        with self._cond:
+            return {"limit": self.limit, "in_flight": self.in_flight, "reason": self.reason}
+
+    def report(self) -> None:
+        """
+        Log the current limit and publish it for this worker process, never failing the call that ended the window.
+        """
+        stats = self.stats()
+        logger.info(
+            f"Amex concurrency limit {stats['limit']}, {stats['in_flight']} calls in flight",
+            extra={f"concurrency_{name}": value for name, value in stats.items()},
+        )
+        if self.redis is None:
+            return
+        key = stats_key(timing.worker_name())
+        try:
+            with self.redis.pipeline() as pipe:
+                pipe.hset(key, mapping=t.cast(t.Mapping[t.Union[str, bytes], t.Union[str, int]], stats))
+                pipe.expire(key, self.ttl)
+                pipe.execute()
+        except RedisError:
+            logger.exception("Could not publish the Amex concurrency limit")
+
+
+def published(redis: Redis) -> t.Dict[str, t.Dict[str, str]]:
+    """
+    The concurrency stats last published by each worker process, by worker name.
+    """
+    return {
+        key.decode().removeprefix(stats_key("")): {field.decode(): value.decode() for field, value in fields.items()}
+        for key in redis.scan_iter(stats_key("*"))
+        if (fields := redis.hgetall(key))
+    }
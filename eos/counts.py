@@ -0,0 +1,101 @@
+import logging
+import typing as t
+from collections import Counter
+from functools import partial
+
+from django.db import DatabaseError, transaction
+from django.db.models import Count, F, Q
+
+from eos.progress import Move
+from mids.models import Batch, BatchItem, BatchItemStatus
+
+logger = logging.getLogger(__name__)
+
+# the Batch column counting items of each status; items being sent count as queued, and the other statuses are only
+# counted in total_items
+COLUMNS: t.Dict[int, str] = {
+    BatchItemStatus.PENDING: "pending_items",
+    BatchItemStatus.QUEUED: "queued_items",
+    BatchItemStatus.IN_FLIGHT: "queued_items",
+    BatchItemStatus.DONE: "done_items",
+    BatchItemStatus.ERROR: "error_items",
+}
+FIELDS = ["total_items", *dict.fromkeys(COLUMNS.values())]
+
+
+def move(moves: t.Iterable[Move]) -> None:
+    """
+    Move each item from the count of its old status to that of its new one, once the current transaction commits.
+    """
+    changes: t.Dict[int, t.Counter[str]] = {}
+    for batch_id, old, new in moves:
+        if COLUMNS.get(old) != COLUMNS.get(new):
+            batch_changes = changes.setdefault(batch_id, Counter())
+            batch_changes[COLUMNS.get(old, "")] -= 1
+            batch_changes[COLUMNS.get(new, "")] += 1
+    _apply_on_commit(changes)
+
+
+def remove(items: t.Iterable[t.Tuple[int, int]]) -> None:
+    """
+    Take deleted items, as (batch_id, status), out of their batches' counts once the current transaction commits.
+    """
+    changes: t.Dict[int, t.Counter[str]] = {}
+    for batch_id, status in items:
+        batch_changes = changes.setdefault(batch_id, Counter())
+        batch_changes["total_items"] -= 1
+        batch_changes[COLUMNS.get(status, "")] -= 1
+    _apply_on_commit(changes)
+
+
+def _apply_on_commit(changes: t.Dict[int, t.Counter[str]]) -> None:
+    # outside the transaction, so that the batch rows are not locked for as long as the items it changes
+    if changes:
+        transaction.on_commit(partial(_apply, changes))
+
+
+def _apply(changes: t.Dict[int, t.Counter[str]]) -> None:
+    try:
+        for batch_id, batch_changes in sorted(changes.items()):
+            Batch.objects.filter(id=batch_id).update(
+                **{column: F(column) + change for column, change in batch_changes.items() if column and change}
+            )
+    except DatabaseError:
+        logger.exception("Could not update the item counts of batches, reconcile_batch_counts will put them right")
+
+
+def counted(batch_ids: t.Optional[t.List[int]] = None) -> t.Dict[int, t.Dict[str, int]]:
+    """
+    The counts of the batches' items taken from the table, for the batches with any items.
+    """
+    items = BatchItem.objects.all() if batch_ids is None else BatchItem.objects.filter(batch_id__in=batch_ids)
+    statuses: t.Dict[str, t.List[int]] = {}
+    for status, column in COLUMNS.items():
+        statuses.setdefault(column, []).append(status)
+    rows = (
+        items.values("batch_id")
+        .annotate(
+            total_items=Count("id"),
+            **{column: Count("id", filter=Q(status__in=values)) for column, values in statuses.items()},
+        )
+        .order_by()
+    )
+    return {row.pop("batch_id"): row for row in rows}
+
+
+def reconcile(batch_ids: t.Optional[t.List[int]] = None) -> int:
+    """
+    Recount the items of the given batches, or of all of them, and put right the counts that have drifted. Returns
+    the number of batches corrected.
+    """
+    counts = counted(batch_ids)
+    batches = Batch.objects.all() if batch_ids is None else Batch.objects.filter(id__in=batch_ids)
+    drifted = []
+    for batch in batches.only("id", *FIELDS).iterator():
+        batch_counts = counts.get(batch.id, {})
+        if any(getattr(batch, field) != batch_counts.get(field, 0) for field in FIELDS):
+            for field in FIELDS:
+                setattr(batch, field, batch_counts.get(field, 0))
+            drifted.append(batch)
+    Batch.objects.bulk_update(drifted, FIELDS, batch_size=1000)
+    return len(drifted)
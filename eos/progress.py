@@ -0,0 +1,123 @@
+import logging
+import time
+import typing as t
+from collections import Counter
+
+from django.db.models import Count
+from redis import Redis
+from redis.exceptions import RedisError
+
+from mids.models import BatchItem, BatchItemStatus
+
+logger = logging.getLogger(__name__)
+
+# Adds each ARGV pair of field and increment to the hash at KEYS[1], unless the hash has expired or was never set,
+# so that counts are only ever moved from a full set of them.
+MOVE_SCRIPT = """
+if redis.call("EXISTS", KEYS[1]) == 0 then
+    return 0
+end
+for i = 2, #ARGV, 2 do
+    redis.call("HINCRBY", KEYS[1], ARGV[i], ARGV[i + 1])
+end
+redis.call("EXPIRE", KEYS[1], ARGV[1])
+return 1
+"""
+
+# items that are being sent count as queued
+FOLDED: t.Dict[int, int] = {BatchItemStatus.IN_FLIGHT: BatchItemStatus.QUEUED}
+UNFINISHED = ("pending", "queued")
+
+# (batch_id, status before, status after) for an item
+Move = t.Tuple[int, int, int]
+
+
+def counter(status: int) -> str:
+    return BatchItemStatus(FOLDED.get(status, status)).name.lower()
+
+
+class BatchProgress:
+    """
+    Counts of each batch's items by status, kept in a redis hash per batch so that a batch can be watched without
+    querying its items.
+
+    The counts are taken from the table when a batch is dispatched, or by a job once they are found missing, and are
+    then moved along by the code that changes item statuses. Updates are best effort: a redis error is logged rather
+    than raised, and any drift is put right at the batch's next dispatch. Hashes expire `ttl` seconds after their last
+    update.
+    """
+
+    def __init__(self, redis: Redis, ttl: int) -> None:
+        self.redis = redis
+        self.ttl = ttl
+        self._move = redis.register_script(MOVE_SCRIPT)
+
+    @staticmethod
+    def key(batch_id: int) -> str:
+        return f"eos:batch:{batch_id}:progress"
+
+    def reset(self, batch_id: int) -> t.Dict[str, float]:
+        """
+        Count the batch's items afresh, with throughput measured from now. Returns the hash as set.
+        """
+        counts: t.Counter[str] = Counter({counter(status): 0 for status in BatchItemStatus})
+        for status, count in (
+            BatchItem.objects.filter(batch_id=batch_id).values_list("status").annotate(Count("id")).order_by()
+        ):
+            counts[counter(status)] += count
+        values: t.Dict[str, float] = {
+            **counts,
+            "started": time.time(),
+            "finished_at_start": sum(count for name, count in counts.items() if name not in UNFINISHED),
+        }
+        try:
+            with self.redis.pipeline() as pipe:
+                pipe.delete(self.key(batch_id))
+                pipe.hset(self.key(batch_id), mapping=t.cast(t.Mapping[t.Union[str, bytes], float], values))
+                pipe.expire(self.key(batch_id), self.ttl)
+                pipe.execute()
+        except RedisError:
+            logger.exception(f"Could not set the progress of batch {batch_id}")
+        return values
+
+    def move(self, moves: t.Iterable[Move]) -> None:
+        """
+        Move each item from the count of its old status to that of its new one.
+        """
+        changes: t.Dict[int, t.Counter[str]] = {}
+        for batch_id, old, new in moves:
+            if counter(old) != counter(new):
+                batch_changes = changes.setdefault(batch_id, Counter())
+                batch_changes[counter(old)] -= 1
+                batch_changes[counter(new)] += 1
+        if not changes:
+            return
+        try:
+            with self.redis.pipeline() as pipe:
+                for batch_id, batch_changes in changes.items():
+                    args = [self.ttl, *(value for change in batch_changes.items() for value in change)]
+                    self._move(keys=[self.key(batch_id)], args=args, client=pipe)
+                pipe.execute()
+        except RedisError:
+            logger.exception("Could not update batch progress")
+
+    def read(self, batch_id: int) -> t.Optional[t.Dict[str, t.Any]]:
+        """
+        The batch's counts with its throughput and ETA, or None until they are set.
+        """
+        values = {key.decode(): float(value) for key, value in self.redis.hgetall(self.key(batch_id)).items()}
+        if not values:
+            return None
+        counts = {counter(status): int(values.get(counter(status), 0)) for status in BatchItemStatus}
+        unfinished = sum(counts[name] for name in UNFINISHED)
+        finished = sum(counts.values()) - unfinished
+        elapsed = time.time() - values["started"]
+        throughput = (finished - values["finished_at_start"]) / elapsed if elapsed > 0 else 0
+        return {
+            "batch": batch_id,
+            "counts": counts,
+            "total": sum(counts.values()),
+            "finished": finished,
+            "throughput": round(throughput, 2),
+            "eta": round(unfinished / throughput) if throughput > 0 else None,
+        }
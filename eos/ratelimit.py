@@ -0,0 +1,63 @@
+import logging
+import time
+
+from redis import Redis
+
+logger = logging.getLogger(__name__)
+
+# Generic cell rate algorithm. The key holds the theoretical arrival time (TAT) of the next request in microseconds
+# of the redis server clock, so every worker shares one clock and one schedule. Returns 0 if the request may go ahead
+# now, otherwise the number of microseconds until it may.
+GCRA_SCRIPT = """
+local emission_interval = tonumber(ARGV[1])
+local burst_offset = tonumber(ARGV[2])
+local time = redis.call("TIME")
+local now = tonumber(time[1]) * 1000000 + tonumber(time[2])
+local tat = tonumber(redis.call("GET", KEYS[1]) or now)
+if tat < now then
+    tat = now
+end
+local new_tat = tat + emission_interval
+local allow_at = new_tat - burst_offset
+if now < allow_at then
+    return allow_at - now
+end
+redis.call("SET", KEYS[1], string.format("%d", new_tat), "PX", math.ceil((new_tat - now) / 1000))
+return 0
+"""
+
+
+class RateLimitExceeded(Exception):
+    pass
+
+
+class RateLimiter:
+    """
+    Cluster-wide rate limit of `rate` requests per second allowing bursts of up to `burst` requests, shared through
+    redis by every process using the same `name`.
+
+    `acquire` blocks until the request is allowed, or raises RateLimitExceeded if that would take longer than
+    `max_wait` seconds.
+    """
+
+    def __init__(self, redis: Redis, name: str, rate: float, burst: int = 1, max_wait: float = 30) -> None:
+        self.key = f"eos:ratelimit:{name}"
+        self.emission_interval = round(1_000_000 / rate)
+        self.burst_offset = self.emission_interval * burst
+        self.max_wait = max_wait
+        self._script = redis.register_script(GCRA_SCRIPT)
+
+    def try_acquire(self) -> float:
+        """
+        Take a token if one is available and return 0, otherwise return the seconds until one will be.
+        """
+        wait_us = self._script(keys=[self.key], args=[self.emission_interval, self.burst_offset])
+        return int(wait_us) / 1_000_000
+
+    def acquire(self) -> None:
+        deadline = time.monotonic() + self.max_wait
+        while wait := self.try_acquire():
+            if time.monotonic() + wait > deadline:
+                raise RateLimitExceeded(f"No token available for {self.key} within {self.max_wait}s")
+            logger.debug(f"Rate limited on {self.key}, waiting {wait:.3f}s")
+            time.sleep(wait)
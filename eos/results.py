@@ -0,0 +1,135 @@
+import logging
+import threading
+import typing as t
+from functools import partial
+
+from django.db import connection, transaction
+
+from eos import counts
+from eos.progress import BatchProgress
+from mids.models import BatchItem, BatchItemStatus, MerchantRegistration
+
+logger = logging.getLogger(__name__)
+
+REGISTRATION_FIELDS = ["merchant_slug", "action", "start_date", "end_date", "last_item", "last_success"]
+
+
+def register(items: t.Iterable[BatchItem]) -> None:
+    """
+    Record the registration now in place for each MID that Amex accepted an item for, the last item winning.
+    """
+    registrations = {
+        (item.mid, item.provider_slug): MerchantRegistration.from_item(item)
+        for item in items
+        if item.status == BatchItemStatus.DONE
+    }
+    if registrations:
+        MerchantRegistration.objects.bulk_create(
+            # in key order, as every writer locks rows in the same order and none waits on another in turn
+            [registrations[key] for key in sorted(registrations)],
+            update_conflicts=True,
+            unique_fields=["mid", "provider_slug"],
+            update_fields=REGISTRATION_FIELDS,
+        )
+
+
+class ResultBuffer:
+    """
+    Collects item results and writes them with one bulk_update per set of changed fields, once `size` results are
+    waiting or `interval` seconds after the first of them arrived, instead of one UPDATE per item. The MIDs' new
+    registrations are written in the same transaction, and the items' batches' counts once it commits.
+
+    Each result is written exactly as `item.save(update_fields=...)` would write it, provided the item is still
+    IN_FLIGHT under the claim it was sent with. Items stay IN_FLIGHT until their result is written, so results lost
+    with the process are recovered by reclaim_stale_items like any other item whose worker died mid-call. With a
+    `size` of 1 results are saved straight away. Written results are counted in the batches' `progress` too.
+    """
+
+    def __init__(self, size: int, interval: float, progress: t.Optional[BatchProgress] = None) -> None:
+        self.size = size
+        self.interval = interval
+        self.progress = progress
+        self.pending: t.List[t.Tuple[BatchItem, t.Tuple[str, ...]]] = []
+        self.lock = threading.Lock()
+        self.timer: t.Optional[threading.Timer] = None
+
+    def add(self, item: BatchItem, update_fields: t.List[str]) -> None:
+        if self.size <= 1:
+            self._write([(item, tuple(update_fields))])
+            return
+        with self.lock:
+            self.pending.append((item, tuple(update_fields)))
+            full = len(self.pending) >= self.size
+            if not full and self.timer is None:
+                self.timer = threading.Timer(self.interval, self._flush_later)
+                self.timer.daemon = True
+                self.timer.start()
+        if full:
+            self.flush()
+
+    def holds(self, mid: str, provider_slug: str) -> bool:
+        """
+        Whether a result for the MID is waiting to be written.
+        """
+        with self.lock:
+            return any(item.mid == mid and item.provider_slug == provider_slug for item, _ in self.pending)
+
+    def flush(self) -> int:
+        """
+        Write every waiting result now. Returns the number of items written.
+        """
+        with self.lock:
+            pending, self.pending = self.pending, []
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+        if not pending:
+            return 0
+        return self._write(pending)
+
+    def _write(self, pending: t.List[t.Tuple[BatchItem, t.Tuple[str, ...]]]) -> int:
+        with transaction.atomic():
+            claims = dict(
+                BatchItem.objects.select_for_update()
+                .filter(id__in=[item.id for item, _ in pending], status=BatchItemStatus.IN_FLIGHT)
+                .order_by("id")
+                .values_list("id", "claimed_at")
+            )
+            # an item reclaimed since it was sent belongs to another worker now
+            written = [
+                (item, fields) for item, fields in pending if item.id in claims and claims[item.id] == item.claimed_at
+            ]
+            groups: t.Dict[t.Tuple[str, ...], t.List[BatchItem]] = {}
+            for item, update_fields in written:
+                groups.setdefault(update_fields, []).append(item)
+            for update_fields, items in groups.items():
+                BatchItem.objects.bulk_update(sorted(items, key=lambda item: item.id), update_fields)
+            register(item for item, _ in written)
+            self._count([item for item, _ in written])
+        if len(written) < len(pending):
+            logger.warning(f"Dropped the results of {len(pending) - len(written)} BatchItems reclaimed meanwhile")
+        logger.debug(f"Wrote results of {len(written)} BatchItems")
+        return len(written)
+
+    def _count(self, items: t.List[BatchItem]) -> None:
+        moves = [(item.batch_id, BatchItemStatus.IN_FLIGHT, item.status) for item in items]
+        counts.move(moves)
+        if self.progress is not None:
+            # redis has no part in the transaction, so only once the results are committed
+            transaction.on_commit(partial(self.progress.move, moves))
+
+    def flush_quietly(self) -> None:
+        """
+        flush, logging rather than raising a failure, for worker shutdown.
+        """
+        try:
+            self.flush()
+        except Exception:
+            logger.exception("Could not write buffered BatchItem results, they will be reclaimed")
+
+    def _flush_later(self) -> None:
+        try:
+            self.flush_quietly()
+        finally:
+            # the timer thread has its own database connection
+            connection.close()
@@ -0,0 +1,46 @@
+import random
+
+import requests
+from django.conf import settings
+from django.db import InterfaceError, OperationalError
+
+from eos.agents.amex import CREDENTIALS_REJECTED_STATUSES, OVERLOADED_STATUSES
+
+# answers from Amex that say nothing about the item itself, so that sending it again later may well succeed
+RETRYABLE_STATUSES = OVERLOADED_STATUSES
+
+
+class AmexUnavailable(Exception):
+    def __init__(self, response: requests.Response) -> None:
+        super().__init__(f"Amex answered {response.status_code}")
+        self.response = response
+
+
+class CredentialsRejected(Exception):
+    def __init__(self, response: requests.Response) -> None:
+        super().__init__(f"Amex rejected our credentials ({response.status_code})")
+        self.response = response
+
+
+def check_status(response: requests.Response) -> None:
+    if response.status_code in RETRYABLE_STATUSES:
+        raise AmexUnavailable(response)
+    if response.status_code in CREDENTIALS_REJECTED_STATUSES:
+        # not retried, as it would be rejected again until the credentials are put right
+        raise CredentialsRejected(response)
+
+
+# failures worth retrying; anything else, such as a body that is not JSON, would fail the same way every time
+TRANSIENT_ERRORS = (AmexUnavailable, requests.ConnectionError, requests.Timeout, OperationalError, InterfaceError)
+
+
+def is_transient(ex: Exception) -> bool:
+    return isinstance(ex, TRANSIENT_ERRORS)
+
+
+def backoff(attempts: int) -> float:
+    """
+    ITEM_RETRY_DELAY doubling per attempt up to ITEM_RETRY_MAX_DELAY, with up to half taken off as jitter.
+    """
+    delay = min(settings.ITEM_RETRY_MAX_DELAY, settings.ITEM_RETRY_DELAY * 2 ** (attempts - 1))
+    return random.uniform(delay / 2, delay)
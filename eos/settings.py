@@ -220,10 +220,95 @@ KEY_VAULT = getenv("KEY_VAULT", required=True)
 AMEX_API_HOST = getenv("AMEX_API_HOST", required=False)
 AMEX_CLIENT_ID = getenv("AMEX_CLIENT_ID", required=False)
 AMEX_CLIENT_SECRET = getenv("AMEX_CLIENT_SECRET", required=False)
+# present the client certificate from the vault; only turned off against the local simulator (see loadtest)
+AMEX_MTLS = getenv("AMEX_MTLS", default="True", conv=boolconv)
+# seconds that secrets fetched from the vault are cached for, and how long before expiry they are refreshed
+AMEX_SECRET_CACHE_TTL = getenv("AMEX_SECRET_CACHE_TTL", default="3600", conv=int)
+AMEX_SECRET_CACHE_REFRESH_MARGIN = getenv("AMEX_SECRET_CACHE_REFRESH_MARGIN", default="300", conv=int)
+# size of the keep-alive connection pool to AMEX_API_HOST, and seconds after which an idle pool is discarded
+AMEX_POOL_MAXSIZE = getenv("AMEX_POOL_MAXSIZE", default="10", conv=int)
+AMEX_POOL_IDLE_TIMEOUT = getenv("AMEX_POOL_IDLE_TIMEOUT", default="60", conv=int)
+# requests per second allowed to the Amex merchant API across all workers (0 disables the limit), the burst size,
+# and how many seconds a worker may wait for a token before putting the item back on the queue
+AMEX_RATE_LIMIT = getenv("AMEX_RATE_LIMIT", default="0", conv=float)
+AMEX_RATE_LIMIT_BURST = getenv("AMEX_RATE_LIMIT_BURST", default="1", conv=int)
+AMEX_RATE_LIMIT_MAX_WAIT = getenv("AMEX_RATE_LIMIT_MAX_WAIT", default="30", conv=float)
+# adapt the number of concurrent Amex calls per process between MIN and MAX, backing off when the p95 latency
+# goes over LATENCY_TARGET seconds or the proportion of 429/5xx responses goes over ERROR_THRESHOLD; only for workers
+# running --threads, whose calls share a process
+AMEX_ADAPTIVE_CONCURRENCY = getenv("AMEX_ADAPTIVE_CONCURRENCY", default="False", conv=boolconv)
+AMEX_CONCURRENCY_MIN = getenv("AMEX_CONCURRENCY_MIN", default="1", conv=int)
+AMEX_CONCURRENCY_MAX = getenv("AMEX_CONCURRENCY_MAX", default="32", conv=int)
+AMEX_CONCURRENCY_LATENCY_TARGET = getenv("AMEX_CONCURRENCY_LATENCY_TARGET", default="2.0", conv=float)
+AMEX_CONCURRENCY_ERROR_THRESHOLD = getenv("AMEX_CONCURRENCY_ERROR_THRESHOLD", default="0.05", conv=float)
+# seconds each worker process' current limit is kept in redis after it was last adjusted
+AMEX_CONCURRENCY_STATS_TTL = getenv("AMEX_CONCURRENCY_STATS_TTL", default="300", conv=int)
+# stop calling Amex from every worker for RESET_TIMEOUT seconds once FAILURE_RATE of at least MIN_CALLS calls
+# within a WINDOW second period have failed
+AMEX_CIRCUIT_BREAKER = getenv("AMEX_CIRCUIT_BREAKER", default="True", conv=boolconv)
+AMEX_CIRCUIT_FAILURE_RATE = getenv("AMEX_CIRCUIT_FAILURE_RATE", default="0.5", conv=float)
+AMEX_CIRCUIT_MIN_CALLS = getenv("AMEX_CIRCUIT_MIN_CALLS", default="20", conv=int)
+AMEX_CIRCUIT_WINDOW = getenv("AMEX_CIRCUIT_WINDOW", default="60", conv=int)
+AMEX_CIRCUIT_RESET_TIMEOUT = getenv("AMEX_CIRCUIT_RESET_TIMEOUT", default="30", conv=int)
+# log how long each stage of processing an item took and keep per worker histograms of them in redis for TTL seconds
+AMEX_CALL_TIMINGS = getenv("AMEX_CALL_TIMINGS", default="False", conv=boolconv)
+AMEX_CALL_TIMINGS_TTL = getenv("AMEX_CALL_TIMINGS_TTL", default="86400", conv=int)
 
 
 REDIS_URL = getenv("REDIS_URL")
 
+# number of jobs a single `worker` process keeps in flight, see mids/management/commands/worker.py
+WORKER_CONCURRENCY = getenv("WORKER_CONCURRENCY", default="1", conv=int)
+# number of worker processes a single `worker` command supervises
+WORKER_PROCESSES = getenv("WORKER_PROCESSES", default="1", conv=int)
+# run jobs in the long-lived worker process instead of forking a work horse per job, and replace that process after
+# MAX_JOBS jobs or once its memory has grown by MAX_MEMORY MB (0 for no limit)
+WORKER_PERSISTENT = getenv("WORKER_PERSISTENT", default="False", conv=boolconv)
+WORKER_MAX_JOBS = getenv("WORKER_MAX_JOBS", default="1000", conv=int)
+WORKER_MAX_MEMORY = getenv("WORKER_MAX_MEMORY", default="256", conv=float)
+# batch items are queued as one job per BATCH_CHUNK_SIZE items, each allowed BATCH_CHUNK_JOB_TIMEOUT seconds
+BATCH_CHUNK_SIZE = getenv("BATCH_CHUNK_SIZE", default="100", conv=int)
+BATCH_CHUNK_JOB_TIMEOUT = getenv("BATCH_CHUNK_JOB_TIMEOUT", default="3600", conv=int)
+# number of jobs sent to redis in a single pipeline when queueing batches
+ENQUEUE_PIPELINE_SIZE = getenv("ENQUEUE_PIPELINE_SIZE", default="500", conv=int)
+# "queue" hands batch items to workers as rq jobs, "db" leaves them for `worker --mode db` to claim from the table,
+# "sharded" queues them by MID on AMEX_SHARDS queues for `worker --mode sharded` to take in order, one worker a shard
+DISPATCH_MODE = getenv("DISPATCH_MODE", default="queue")
+AMEX_SHARDS = getenv("AMEX_SHARDS", default="8", conv=int)
+# seconds a sharded worker's hold on its shard lasts without being renewed, after which another worker may take over
+SHARD_LEASE_TTL = getenv("SHARD_LEASE_TTL", default="30", conv=int)
+# items a database worker thread claims at a time, and seconds it waits before looking again when there are none
+DB_WORKER_BLOCK_SIZE = getenv("DB_WORKER_BLOCK_SIZE", default="20", conv=int)
+DB_WORKER_POLL_INTERVAL = getenv("DB_WORKER_POLL_INTERVAL", default="5", conv=float)
+# collapse the operations not yet sent for each MID as a batch is dispatched: duplicates are superseded, and an ADD
+# followed by a DELETE cancels out
+DISPATCH_COALESCE = getenv("DISPATCH_COALESCE", default="True", conv=boolconv)
+# items a batch dispatch job queues per step before recording its progress, and its timeout in seconds
+DISPATCH_PAGE_SIZE = getenv("DISPATCH_PAGE_SIZE", default="5000", conv=int)
+DISPATCH_JOB_TIMEOUT = getenv("DISPATCH_JOB_TIMEOUT", default="3600", conv=int)
+# seconds after which an item still IN_FLIGHT is taken to belong to a dead worker and is queued again
+ITEM_CLAIM_TIMEOUT = getenv("ITEM_CLAIM_TIMEOUT", default="300", conv=int)
+# seconds each batch's item counts are kept in redis after their last change, and how many seconds the progress
+# stream has the client wait before reconnecting for the next event
+BATCH_PROGRESS_TTL = getenv("BATCH_PROGRESS_TTL", default="604800", conv=int)
+PROGRESS_STREAM_INTERVAL = getenv("PROGRESS_STREAM_INTERVAL", default="2", conv=float)
+# item results are written together once SIZE are waiting or INTERVAL seconds after the first, 1 to write each at once
+RESULT_BUFFER_SIZE = getenv("RESULT_BUFFER_SIZE", default="50", conv=int)
+RESULT_BUFFER_INTERVAL = getenv("RESULT_BUFFER_INTERVAL", default="0.5", conv=float)
+# items failing with a transient error are retried up to MAX_ATTEMPTS in all, after exponential backoff with jitter
+# from RETRY_DELAY seconds up to RETRY_MAX_DELAY; other failures go straight to the dead letter status
+ITEM_MAX_ATTEMPTS = getenv("ITEM_MAX_ATTEMPTS", default="5", conv=int)
+ITEM_RETRY_DELAY = getenv("ITEM_RETRY_DELAY", default="10", conv=float)
+ITEM_RETRY_MAX_DELAY = getenv("ITEM_RETRY_MAX_DELAY", default="600", conv=float)
+# each round of a worker's weighted round robin takes up to this many jobs from the urgent, normal and bulk queues
+QUEUE_WEIGHT_URGENT = getenv("QUEUE_WEIGHT_URGENT", default="6", conv=int)
+QUEUE_WEIGHT_NORMAL = getenv("QUEUE_WEIGHT_NORMAL", default="3", conv=int)
+QUEUE_WEIGHT_BULK = getenv("QUEUE_WEIGHT_BULK", default="1", conv=int)
+# batches with at least this many items to dispatch are queued on the bulk queue, unless sent as urgent
+BULK_BATCH_SIZE = getenv("BULK_BATCH_SIZE", default="10000", conv=int)
+# seconds a previewed roster diff is kept waiting to be imported
+ROSTER_PREVIEW_TTL = getenv("ROSTER_PREVIEW_TTL", default="3600", conv=int)
+
 SENTRY_DSN = getenv("SENTRY_DSN", required=False)
 SENTRY_ENV = getenv("SENTRY_ENV", default="unset").lower()
 
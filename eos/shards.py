@@ -0,0 +1,53 @@
+import zlib
+
+from django.conf import settings
+from redis import Redis
+
+# only the holder named in ARGV[1] may extend or give up its lease
+RENEW_SCRIPT = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("EXPIRE", KEYS[1], ARGV[2])
+end
+return 0
+"""
+RELEASE_SCRIPT = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("DEL", KEYS[1])
+end
+return 0
+"""
+
+
+def shard_of(mid: str) -> int:
+    """
+    The shard every item for `mid` is routed to, one of AMEX_SHARDS.
+    """
+    return zlib.crc32(mid.encode()) % settings.AMEX_SHARDS
+
+
+class ShardLease:
+    """
+    Exclusive, expiring holds on shard numbers, kept in redis so that no two consumers on any host work the same
+    shard at once. A holder must renew its lease more often than every `ttl` seconds, or it passes to whoever asks
+    next.
+    """
+
+    def __init__(self, redis: Redis, owner: str, ttl: int) -> None:
+        self.redis = redis
+        self.owner = owner
+        self.ttl = ttl
+        self._renew = redis.register_script(RENEW_SCRIPT)
+        self._release = redis.register_script(RELEASE_SCRIPT)
+
+    @staticmethod
+    def key(shard: int) -> str:
+        return f"eos:shard:{shard}"
+
+    def acquire(self, shard: int) -> bool:
+        return bool(self.redis.set(self.key(shard), self.owner, nx=True, ex=self.ttl))
+
+    def renew(self, shard: int) -> bool:
+        return bool(self._renew(keys=[self.key(shard)], args=[self.owner, self.ttl]))
+
+    def release(self, shard: int) -> None:
+        self._release(keys=[self.key(shard)], args=[self.owner])
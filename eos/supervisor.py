@@ -0,0 +1,92 @@
+import logging
+import os
+import signal
+import time
+import typing as t
+
+from django import db
+
+logger = logging.getLogger(__name__)
+
+
+class Supervisor:
+    """
+    Runs `target` in `processes` forked children and restarts any that exit, until told to stop.
+
+    Children are forked after Django has booted, so they share its loaded code and whatever state the caller warmed
+    before `run`. Database connections are closed first as they cannot be shared across a fork; redis and the Amex
+    agent's pools notice the fork and open their own. SIGTERM or SIGINT is passed on to the children as SIGTERM, for
+    a graceful shutdown, and a second one kills them. With `burst`, children that exit cleanly are not replaced and
+    `run` returns once all have finished.
+    """
+
+    # children exiting sooner than this after starting are restarted with an increasing delay
+    min_uptime = 5.0
+    max_restart_delay = 30.0
+
+    def __init__(self, processes: int, target: t.Callable[[], None], burst: bool = False) -> None:
+        self.processes = processes
+        self.target = target
+        self.burst = burst
+        self.children: t.Dict[int, float] = {}
+        self.stopping = False
+        self.fast_failures = 0
+
+    def run(self) -> None:
+        handlers = {signum: signal.signal(signum, self.request_stop) for signum in (signal.SIGINT, signal.SIGTERM)}
+        try:
+            for _ in range(self.processes):
+                self.spawn()
+            while self.children:
+                pid, status = os.wait()
+                self.reap(pid, status)
+        finally:
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
+
+    def spawn(self) -> None:
+        db.connections.close_all()
+        pid = os.fork()
+        if pid == 0:
+            self._child()
+        self.children[pid] = time.monotonic()
+        logger.info(f"Started worker process {pid}")
+
+    def _child(self) -> t.NoReturn:
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, signal.SIG_DFL)
+        code = 0
+        try:
+            self.target()
+        except BaseException:
+            logger.exception("Worker process failed")
+            code = 1
+        finally:
+            logging.shutdown()
+            os._exit(code)
+
+    def reap(self, pid: int, status: int) -> None:
+        started = self.children.pop(pid, None)
+        if started is None:
+            return
+        code = os.waitstatus_to_exitcode(status)
+        if self.stopping or (self.burst and code == 0):
+            logger.info(f"Worker process {pid} exited ({code})")
+            return
+
+        logger.warning(f"Worker process {pid} exited unexpectedly ({code}), restarting it")
+        self.fast_failures = self.fast_failures + 1 if time.monotonic() - started < self.min_uptime else 0
+        if self.fast_failures:
+            time.sleep(min(self.max_restart_delay, 2.0**self.fast_failures / 2))
+        if not self.stopping:
+            self.spawn()
+
+    def request_stop(self, signum: int, frame: t.Any) -> None:
+        forward = signal.SIGKILL if self.stopping else signal.SIGTERM
+        logger.info(f"Stopping {len(self.children)} worker processes ({signal.Signals(forward).name})")
+        self.stopping = True
+        for pid in self.children:
+            try:
+                os.kill(pid, forward)
+            except ProcessLookupError:
+                pass
@@ -1,14 +1,28 @@
 import logging
+import time
 import typing as t
-from datetime import date
+from datetime import date, datetime, timedelta
+from functools import partial
 
+import requests
 import rq
 from django.conf import settings
 from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
 from redis import Redis
+from redis.exceptions import RedisError
+from rq.timeouts import JobTimeoutException
 
+from eos import counts, retries, shards, timing
 from eos.agents.amex import MerchantRegApi
-from mids.models import BatchItem, BatchItemAction, BatchItemStatus
+from eos.circuitbreaker import CircuitBreaker, CircuitOpen
+from eos.coalesce import coalesce
+from eos.concurrency import AdaptiveConcurrency
+from eos.progress import BatchProgress, Move
+from eos.ratelimit import RateLimiter, RateLimitExceeded
+from eos.results import ResultBuffer
+from mids.models import Batch, BatchDispatchStatus, BatchItem, BatchItemAction, BatchItemStatus, MerchantRegistration
 
 logger = logging.getLogger(__name__)
 
@@ -20,46 +34,565 @@ redis = Redis.from_url(
 )
 
 task_queue = rq.Queue("amex", connection=redis)
+urgent_queue = rq.Queue("amex-urgent", connection=redis)
+bulk_queue = rq.Queue("amex-bulk", connection=redis)
+
+# values of settings.DISPATCH_MODE
+DISPATCH_MODE_QUEUE = "queue"
+DISPATCH_MODE_DB = "db"
+DISPATCH_MODE_SHARDED = "sharded"
+
+# retry policy for jobs processing chunks of batch items, for failures outside any one item
+CHUNK_RETRY = rq.Retry(max=1, interval=[10, 30, 60])
+
+# counts of each batch's items by status
+progress = BatchProgress(redis, ttl=settings.BATCH_PROGRESS_TTL)
+
+# item results waiting to be written by this worker process
+results = ResultBuffer(size=settings.RESULT_BUFFER_SIZE, interval=settings.RESULT_BUFFER_INTERVAL, progress=progress)
+
+_amex_agent: t.Optional[MerchantRegApi] = None
+
+
+def amex_agent() -> MerchantRegApi:
+    """
+    One Amex agent per worker process, so its pooled connections are reused from one MID to the next.
+    """
+    global _amex_agent
+    if _amex_agent is None:
+        rate_limiter = None
+        if settings.AMEX_RATE_LIMIT:
+            rate_limiter = RateLimiter(
+                redis,
+                "amex",
+                rate=settings.AMEX_RATE_LIMIT,
+                burst=settings.AMEX_RATE_LIMIT_BURST,
+                max_wait=settings.AMEX_RATE_LIMIT_MAX_WAIT,
+            )
+        concurrency = None
+        if settings.AMEX_ADAPTIVE_CONCURRENCY:
+            concurrency = AdaptiveConcurrency(
+                minimum=settings.AMEX_CONCURRENCY_MIN,
+                maximum=settings.AMEX_CONCURRENCY_MAX,
+                latency_target=settings.AMEX_CONCURRENCY_LATENCY_TARGET,
+                error_threshold=settings.AMEX_CONCURRENCY_ERROR_THRESHOLD,
+                redis=redis,
+                ttl=settings.AMEX_CONCURRENCY_STATS_TTL,
+            )
+        circuit_breaker = None
+        if settings.AMEX_CIRCUIT_BREAKER:
+            circuit_breaker = CircuitBreaker(
+                redis,
+                "amex",
+                failure_rate=settings.AMEX_CIRCUIT_FAILURE_RATE,
+                min_calls=settings.AMEX_CIRCUIT_MIN_CALLS,
+                window=settings.AMEX_CIRCUIT_WINDOW,
+                reset_timeout=settings.AMEX_CIRCUIT_RESET_TIMEOUT,
+            )
+        _amex_agent = MerchantRegApi(
+            rate_limiter=rate_limiter,
+            concurrency=concurrency,
+            circuit_breaker=circuit_breaker,
+        )
+    return _amex_agent
+
+
+def _send(item: BatchItem) -> t.Optional[t.Tuple[requests.Response, datetime]]:
+    api = amex_agent()
+    if item.action == BatchItemAction.ADD:
+        return api.add_merchant(
+            item.mid,
+            item.merchant_slug,
+            t.cast(date, item.start_date),
+            t.cast(date, item.end_date),
+        )
+    elif item.action == BatchItemAction.DELETE:
+        return api.delete_merchant(item.mid, item.merchant_slug)
+    return None
+
+
+def _save_response(item: BatchItem, response: requests.Response, request_timestamp: datetime) -> None:
+    item.response = data = response.json()
+    item.request_timestamp = request_timestamp
+    if "error_code" in data:
+        # error code strings are not consistent e.g.
+        # "Invalid Request", "Invalid_request" etc
+        # Original will be preserved in the response field
+        item.error_code = data["error_code"].replace("_", " ").lower()
+        update_fields = ["error_code"]
+        for f in ("error_type", "error_description"):
+            setattr(item, f, data[f])
+            update_fields.append(f)
+        # parked rather than failed, to be re-driven once whatever Amex rejected is put right
+        item.status = BatchItemStatus.DEAD_LETTER
+    else:
+        update_fields = []
+        item.status = BatchItemStatus.DONE
+    results.add(item, update_fields + ["status", "response", "request_timestamp"])
+
+
+def _claim(item_id: int) -> t.Optional[BatchItem]:
+    """
+    Move a QUEUED item to IN_FLIGHT in its own short transaction, so none is held open during the Amex call.
+    """
+    claimed = BatchItem.objects.filter(id=item_id, status=BatchItemStatus.QUEUED).update(
+        status=BatchItemStatus.IN_FLIGHT, claimed_at=timezone.now()
+    )
+    return BatchItem.objects.select_related("batch").get(id=item_id) if claimed else None
+
+
+def _release(item: BatchItem) -> None:
+    BatchItem.objects.filter(id=item.id, status=BatchItemStatus.IN_FLIGHT).update(
+        status=BatchItemStatus.QUEUED, claimed_at=None
+    )
+
+
+def worker_queues() -> t.List[rq.Queue]:
+    return [urgent_queue, task_queue, bulk_queue]
+
+
+def queue_weights() -> t.Dict[str, int]:
+    return {
+        urgent_queue.name: settings.QUEUE_WEIGHT_URGENT,
+        task_queue.name: settings.QUEUE_WEIGHT_NORMAL,
+        bulk_queue.name: settings.QUEUE_WEIGHT_BULK,
+    }
+
+
+def batch_queue(batch: Batch, size: int) -> rq.Queue:
+    if batch.urgent:
+        return urgent_queue
+    if size >= settings.BULK_BATCH_SIZE:
+        return bulk_queue
+    return task_queue
+
+
+def shard_queue(shard: int) -> rq.Queue:
+    return rq.Queue(f"amex-shard-{shard}", connection=redis)
+
+
+def _job_queue() -> rq.Queue:
+    """
+    The queue of the running job, so that items put back keep their priority.
+    """
+    job = rq.get_current_job()
+    if job is not None:
+        for queue in (urgent_queue, bulk_queue):
+            if job.origin == queue.name:
+                return queue
+    return task_queue
+
+
+def _defer(item_id: int, delay: float) -> None:
+    queue = _job_queue()
+    if delay:
+        queue.enqueue_in(timedelta(seconds=delay), process_item, item_id)
+    else:
+        # go to the back of the queue rather than fail the job
+        queue.enqueue(process_item, item_id)
+
+
+def _already_registered(item: BatchItem) -> bool:
+    if item.batch.force_send:
+        return False
+    if results.holds(item.mid, item.provider_slug):
+        # an earlier item for the MID has been sent but its registration not yet written
+        results.flush()
+    registration = MerchantRegistration.objects.filter(mid=item.mid, provider_slug=item.provider_slug).first()
+    return registration is not None and registration.matches(item)
+
+
+def _process_claimed(item: BatchItem, timings: timing.CallTimings) -> None:
+    """
+    Send an IN_FLIGHT item, putting it back to QUEUED if the call or buffering its result raises.
+    """
+    with timings.stage("db_registration"):
+        skip = _already_registered(item)
+    if skip:
+        logger.debug(f"MID {item.mid} is already registered as BatchItem ({item.id}) asks, skipping it")
+        item.status = BatchItemStatus.SKIPPED
+        with timings.stage("db_write"):
+            results.add(item, ["status"])
+        return
+
+    try:
+        result = _send(item)
+        if result is not None:
+            retries.check_status(result[0])
+        with timings.stage("db_write"):
+            if result is None:
+                logger.warning("Item with id {} has unrecognised action ({})".format(item.id, item.action))
+                item.status = BatchItemStatus.ERROR
+                results.add(item, ["status"])
+            else:
+                _save_response(item, *result)
+    except Exception:
+        _release(item)
+        raise
 
 
 def process_item(item_id: int) -> None:
+    _process_item(item_id)
+    results.flush()
+
+
+def _process_item(item_id: int) -> None:
+    delay = _attempt(item_id)
+    if delay is not None:
+        _defer(item_id, delay)
+
+
+def _attempt(item_id: int) -> t.Optional[float]:
+    """
+    Returns None once the item is done with, or the seconds to wait before sending it again.
+    """
     logger.debug(f"Processing BatchItem with id: {item_id}")
+    with timing.timed_call(redis, f"BatchItem ({item_id})", batch_item_id=item_id) as timings:
+        with timings.stage("db_claim"):
+            item = _claim(item_id)
+        if item is None:
+            logger.warning("QUEUED BatchItem ({}) does not exist".format(item_id))
+            return None
+
+        try:
+            _process_claimed(item, timings)
+        except CircuitOpen as ex:
+            logger.info(f"{ex}, deferring BatchItem ({item.id})")
+            return ex.retry_after
+        except RateLimitExceeded:
+            logger.info(f"Amex rate limit reached, deferring BatchItem ({item.id})")
+            return 0
+        except JobTimeoutException:
+            raise
+        except Exception as ex:
+            return _retry_or_dead_letter(item, ex)
+    return None
+
+
+def _retry_or_dead_letter(item: BatchItem, ex: Exception) -> t.Optional[float]:
+    """
+    Returns the backoff before the next attempt, or None once the item is a dead letter.
+    """
+    attempts = item.attempts + 1
+    items = BatchItem.objects.filter(id=item.id, status=BatchItemStatus.QUEUED)
+    if retries.is_transient(ex) and attempts < settings.ITEM_MAX_ATTEMPTS:
+        delay = retries.backoff(attempts)
+        logger.warning(f"BatchItem ({item.id}) failed on attempt {attempts} with {ex!r}, retrying in {delay:.0f}s")
+        # database workers claim the item again once retry_at has passed
+        items.update(attempts=attempts, retry_at=timezone.now() + timedelta(seconds=delay))
+        return delay
+
+    logger.error(f"BatchItem ({item.id}) failed on attempt {attempts}, moving it to the dead letters", exc_info=ex)
     with transaction.atomic():
+        if items.update(
+            attempts=attempts,
+            retry_at=None,
+            status=BatchItemStatus.DEAD_LETTER,
+            error_description=f"{type(ex).__name__}: {ex}"[:100],
+        ):
+            _count_moves([(item.batch_id, BatchItemStatus.QUEUED, BatchItemStatus.DEAD_LETTER)])
+    return None
+
+
+def count_progress(batch_id: int) -> None:
+    progress.reset(batch_id)
+
+
+def request_progress(batch_id: int) -> None:
+    # database workers take no jobs, so there the counts are only set again when the batch is next dispatched
+    if settings.DISPATCH_MODE != DISPATCH_MODE_DB:
+        urgent_queue.enqueue(count_progress, batch_id, job_id=f"count-progress-{batch_id}")
+
+
+def _count_moves(moves: t.Sequence[Move]) -> None:
+    counts.move(moves)
+    transaction.on_commit(partial(progress.move, moves))
+
+
+def claim_items(limit: int) -> t.Tuple[t.List[int], datetime]:
+    claimed_at = timezone.now()
+    with transaction.atomic():
+        item_ids = list(
+            BatchItem.objects.select_for_update(skip_locked=True)
+            .filter(Q(retry_at=None) | Q(retry_at__lte=claimed_at), status=BatchItemStatus.QUEUED)
+            .values_list("id", flat=True)[:limit]
+        )
+        BatchItem.objects.filter(id__in=item_ids).update(status=BatchItemStatus.IN_FLIGHT, claimed_at=claimed_at)
+    return item_ids, claimed_at
+
+
+def release_items(item_ids: t.List[int], claimed_at: datetime) -> None:
+    BatchItem.objects.filter(id__in=item_ids, status=BatchItemStatus.IN_FLIGHT, claimed_at=claimed_at).update(
+        status=BatchItemStatus.QUEUED, claimed_at=None
+    )
+
+
+def fail_item(item_id: int, ex: Exception) -> None:
+    items = BatchItem.objects.filter(id=item_id, status=BatchItemStatus.QUEUED)
+    with transaction.atomic():
+        batch_ids = list(items.select_for_update().values_list("batch_id", flat=True))
+        if items.update(status=BatchItemStatus.ERROR, error_description=str(ex)[:100]):
+            _count_moves([(batch_id, BatchItemStatus.QUEUED, BatchItemStatus.ERROR) for batch_id in batch_ids])
+
+
+def process_claimed_item(item_id: int, claimed_at: datetime) -> None:
+    # renew the claim so ITEM_CLAIM_TIMEOUT runs from now rather than from the claim of the whole block
+    renewed = BatchItem.objects.filter(id=item_id, status=BatchItemStatus.IN_FLIGHT, claimed_at=claimed_at).update(
+        claimed_at=timezone.now()
+    )
+    if not renewed:
+        logger.warning(f"BatchItem ({item_id}) was reclaimed before this worker started it, skipping it")
+        return
+    with timing.timed_call(redis, f"BatchItem ({item_id})", batch_item_id=item_id) as timings:
+        item = BatchItem.objects.select_related("batch").get(id=item_id)
         try:
-            item = BatchItem.objects.get(id=item_id, status=BatchItemStatus.QUEUED)
-        except BatchItem.DoesNotExist:
-            logger.warning("PENDING BatchItem ({}) does not exist".format(item_id))
-            return
-
-        api = MerchantRegApi()
-        if item.action == BatchItemAction.ADD:
-            response, request_timestamp = api.add_merchant(
-                item.mid,
-                item.merchant_slug,
-                t.cast(date, item.start_date),
-                t.cast(date, item.end_date),
+            _process_claimed(item, timings)
+        except (RateLimitExceeded, CircuitOpen):
+            raise
+        except Exception as ex:
+            _retry_or_dead_letter(item, ex)
+
+
+def reclaim_stale_items() -> int:
+    cutoff = timezone.now() - timedelta(seconds=settings.ITEM_CLAIM_TIMEOUT)
+    with transaction.atomic():
+        item_ids = list(
+            BatchItem.objects.select_for_update(skip_locked=True)
+            .filter(status=BatchItemStatus.IN_FLIGHT, claimed_at__lt=cutoff)
+            .values_list("id", flat=True)
+        )
+        BatchItem.objects.filter(id__in=item_ids).update(status=BatchItemStatus.QUEUED, claimed_at=None)
+    if not item_ids:
+        return 0
+
+    queued, errors = hand_over(item_ids)
+    # leave those that could not be queued to be reclaimed next time
+    BatchItem.objects.filter(id__in=errors, status=BatchItemStatus.QUEUED).update(
+        status=BatchItemStatus.IN_FLIGHT, claimed_at=cutoff
+    )
+    logger.warning(f"Reclaimed {len(queued)} BatchItems stuck in flight, {len(errors)} could not be queued")
+    return len(queued)
+
+
+def process_items(item_ids: t.List[int]) -> t.Dict[int, str]:
+    for item_id in item_ids:
+        _process_item(item_id)
+
+    results.flush()
+    return _statuses(item_ids)
+
+
+def process_items_in_order(item_ids: t.List[int]) -> t.Dict[int, str]:
+    """
+    Send items in order, waiting in place, until waiting would run past half the job timeout.
+    """
+    deadline = time.monotonic() + settings.BATCH_CHUNK_JOB_TIMEOUT / 2
+    for index, item_id in enumerate(item_ids):
+        if not _attempt_until(item_id, deadline):
+            _continue_in_order(item_ids[index:])
+            item_ids = item_ids[:index]
+            break
+
+    results.flush()
+    return _statuses(item_ids)
+
+
+def _attempt_until(item_id: int, deadline: float) -> bool:
+    delay = _attempt(item_id)
+    while delay is not None:
+        if time.monotonic() + delay > deadline:
+            return False
+        time.sleep(delay)
+        delay = _attempt(item_id)
+    return True
+
+
+def _continue_in_order(item_ids: t.List[int]) -> None:
+    mid = BatchItem.objects.values_list("mid", flat=True).get(id=item_ids[0])
+    logger.info(f"Putting {len(item_ids)} items back at the head of shard {shards.shard_of(mid)}")
+    shard_queue(shards.shard_of(mid)).enqueue(
+        process_items_in_order, item_ids, at_front=True, job_timeout=settings.BATCH_CHUNK_JOB_TIMEOUT
+    )
+
+
+def dead_letter_chunk(job: rq.job.Job, exc_type: t.Type[BaseException], exc_value: BaseException, tb: t.Any) -> None:
+    """
+    Exception handler parking the unsent items of a failed shard job, which is not retried.
+    """
+    if job.func_name != f"{__name__}.process_items_in_order":
+        return
+    items = BatchItem.objects.filter(id__in=job.args[0], status=BatchItemStatus.QUEUED)
+    with transaction.atomic():
+        batch_ids = list(items.select_for_update().values_list("batch_id", flat=True))
+        items.update(status=BatchItemStatus.DEAD_LETTER, retry_at=None, error_description=f"{exc_value!r}"[:100])
+        _count_moves([(batch_id, BatchItemStatus.QUEUED, BatchItemStatus.DEAD_LETTER) for batch_id in batch_ids])
+    logger.error(f"Job {job.id} failed, moved its {len(batch_ids)} unsent items to the dead letters")
+
+
+def _statuses(item_ids: t.List[int]) -> t.Dict[int, str]:
+    statuses = dict(BatchItem.objects.filter(id__in=item_ids).values_list("id", "status"))
+    return {item_id: BatchItemStatus(statuses[item_id]).label for item_id in item_ids if item_id in statuses}
+
+
+def enqueue_items(
+    item_ids: t.List[int],
+    queue: t.Optional[rq.Queue] = None,
+    func: t.Callable = process_items,
+    retry: t.Optional[rq.Retry] = CHUNK_RETRY,
+) -> t.Tuple[t.List[int], t.List[int]]:
+    queue = queue or task_queue
+    chunk_size = settings.BATCH_CHUNK_SIZE
+    chunks = [item_ids[start : start + chunk_size] for start in range(0, len(item_ids), chunk_size)]
+    queued: t.List[int] = []
+    errors: t.List[int] = []
+    for start in range(0, len(chunks), settings.ENQUEUE_PIPELINE_SIZE):
+        group = chunks[start : start + settings.ENQUEUE_PIPELINE_SIZE]
+        ids = [item_id for chunk in group for item_id in chunk]
+        try:
+            queue.enqueue_many(
+                [
+                    queue.prepare_data(
+                        func,
+                        (chunk,),
+                        retry=retry,
+                        timeout=settings.BATCH_CHUNK_JOB_TIMEOUT,
+                    )
+                    for chunk in group
+                ]
             )
-        elif item.action == BatchItemAction.DELETE:
-            response, request_timestamp = api.delete_merchant(item.mid, item.merchant_slug)
-        else:
-            logger.warning("Item with id {} has unrecognised action ({})".format(item.id, item.action))
-            item.status = BatchItemStatus.ERROR
-            item.save(update_fields=["status"])
-            return
-
-        item.response = data = response.json()
-        item.request_timestamp = request_timestamp
-        if "error_code" in data:
-            # error code strings are not consistent e.g.
-            # "Invalid Request", "Invalid_request" etc
-            # Original will be preserved in the response field
-            item.error_code = data["error_code"].replace("_", " ").lower()
-            update_fields = ["error_code"]
-            for f in ("error_type", "error_description"):
-                setattr(item, f, data[f])
-                update_fields.append(f)
-            item.status = BatchItemStatus.ERROR
-        else:
-            update_fields = []
-            item.status = BatchItemStatus.DONE
-        item.save(update_fields=update_fields + ["status", "response", "request_timestamp"])
+            queued.extend(ids)
+        except RedisError:
+            logger.exception(f"Could not enqueue {len(ids)} items")
+            errors.extend(ids)
+    return queued, errors
+
+
+def enqueue_sharded(item_ids: t.List[int]) -> t.Tuple[t.List[int], t.List[int]]:
+    by_shard: t.Dict[int, t.List[int]] = {}
+    for item_id, mid in BatchItem.objects.filter(id__in=item_ids).order_by("id").values_list("id", "mid"):
+        by_shard.setdefault(shards.shard_of(mid), []).append(item_id)
+    queued: t.List[int] = []
+    errors: t.List[int] = []
+    for shard, ids in sorted(by_shard.items()):
+        # no retry, as nothing schedules jobs on the shard queues and a retry would queue behind later items
+        shard_queued, shard_errors = enqueue_items(ids, shard_queue(shard), func=process_items_in_order, retry=None)
+        queued.extend(shard_queued)
+        errors.extend(shard_errors)
+    return queued, errors
+
+
+def redrive_items(item_ids: t.List[int]) -> t.Tuple[t.List[int], t.List[int]]:
+    with transaction.atomic():
+        batch_ids = dict(
+            BatchItem.objects.select_for_update(skip_locked=True)
+            .filter(id__in=item_ids, status=BatchItemStatus.DEAD_LETTER)
+            .values_list("id", "batch_id")
+        )
+        BatchItem.objects.filter(id__in=batch_ids).update(
+            status=BatchItemStatus.QUEUED, attempts=0, retry_at=None, error_code="", error_type="", error_description=""
+        )
+        _count_moves(
+            [(batch_id, BatchItemStatus.DEAD_LETTER, BatchItemStatus.QUEUED) for batch_id in batch_ids.values()]
+        )
+    queued, errors = hand_over(list(batch_ids))
+    with transaction.atomic():
+        reverted = list(
+            BatchItem.objects.select_for_update()
+            .filter(id__in=errors, status=BatchItemStatus.QUEUED)
+            .values_list("id", flat=True)
+        )
+        BatchItem.objects.filter(id__in=reverted).update(status=BatchItemStatus.DEAD_LETTER)
+        _count_moves(
+            [(batch_ids[item_id], BatchItemStatus.QUEUED, BatchItemStatus.DEAD_LETTER) for item_id in reverted]
+        )
+    return queued, errors
+
+
+def hand_over(item_ids: t.List[int], queue: t.Optional[rq.Queue] = None) -> t.Tuple[t.List[int], t.List[int]]:
+    if settings.DISPATCH_MODE == DISPATCH_MODE_DB:
+        return item_ids, []
+    if settings.DISPATCH_MODE == DISPATCH_MODE_SHARDED:
+        return enqueue_sharded(item_ids)
+    return enqueue_items(item_ids, queue)
+
+
+def claim_pending_batch() -> t.Optional[int]:
+    with transaction.atomic():
+        batch_id = (
+            Batch.objects.select_for_update(skip_locked=True)
+            .filter(dispatch_status=BatchDispatchStatus.PENDING)
+            .values_list("id", flat=True)
+            .first()
+        )
+        if batch_id is not None:
+            Batch.objects.filter(id=batch_id).update(
+                dispatch_status=BatchDispatchStatus.DISPATCHING, dispatch_started=timezone.now()
+            )
+    return batch_id
+
+
+def reclaim_stale_dispatches() -> int:
+    cutoff = timezone.now() - timedelta(seconds=settings.DISPATCH_JOB_TIMEOUT)
+    failed = Batch.objects.filter(
+        Q(dispatch_started__lt=cutoff) | Q(dispatch_started=None), dispatch_status=BatchDispatchStatus.DISPATCHING
+    ).update(dispatch_status=BatchDispatchStatus.FAILED)
+    if failed:
+        logger.warning(f"Marked {failed} batch dispatches failed after DISPATCH_JOB_TIMEOUT")
+    return failed
+
+
+def dispatch_batch(batch_id: int) -> None:
+    """
+    Each page is committed as QUEUED before it is handed over, so workers never see a PENDING item.
+    """
+    batch = Batch.objects.get(id=batch_id)
+    pending = batch.batchitem_set.filter(status=BatchItemStatus.PENDING).count()
+    Batch.objects.filter(id=batch_id).update(
+        dispatch_status=BatchDispatchStatus.DISPATCHING,
+        dispatch_started=timezone.now(),
+        items_to_dispatch=pending,
+        items_dispatched=0,
+    )
+    progress.reset(batch_id)
+    queue = batch_queue(batch, pending)
+    logger.info(f"Dispatching items from batch {batch.file_name} to queue {queue.name}")
+    try:
+        status = _dispatch_pages(batch, queue)
+    except Exception:
+        Batch.objects.filter(id=batch_id).update(dispatch_status=BatchDispatchStatus.FAILED)
+        raise
+    Batch.objects.filter(id=batch_id).update(dispatch_status=status)
+    logger.info(f"Dispatched batch {batch.file_name}: {BatchDispatchStatus(status).label}")
+
+
+def _dispatch_pages(batch: Batch, queue: rq.Queue) -> BatchDispatchStatus:
+    while True:
+        with transaction.atomic():
+            page = list(
+                batch.batchitem_set.select_for_update(skip_locked=True)
+                .filter(status=BatchItemStatus.PENDING)
+                .values_list("id", flat=True)[: settings.DISPATCH_PAGE_SIZE]
+            )
+            superseded = coalesce(batch, page) if settings.DISPATCH_COALESCE else []
+            superseded_ids = {item.id for item in superseded}
+            item_ids = [item_id for item_id in page if item_id not in superseded_ids]
+            BatchItem.objects.filter(id__in=item_ids).update(status=BatchItemStatus.QUEUED)
+            _count_moves(
+                [(item.batch_id, item.status, BatchItemStatus.SUPERSEDED) for item in superseded]
+                + [(batch.id, BatchItemStatus.PENDING, BatchItemStatus.QUEUED)] * len(item_ids)
+            )
+        if not page:
+            return BatchDispatchStatus.DISPATCHED
+
+        queued, errors = hand_over(item_ids, queue)
+        # superseded items are done with as far as the dispatch goes
+        done = len(queued) + len(page) - len(item_ids)
+        Batch.objects.filter(id=batch.id).update(items_dispatched=F("items_dispatched") + done)
+        if errors:
+            with transaction.atomic():
+                reverted = BatchItem.objects.filter(id__in=errors, status=BatchItemStatus.QUEUED).update(
+                    status=BatchItemStatus.PENDING
+                )
+                _count_moves([(batch.id, BatchItemStatus.QUEUED, BatchItemStatus.PENDING)] * reverted)
+            logger.warning(f"{len(errors)} items from batch {batch.file_name} were not queued due to a redis error")
+            return BatchDispatchStatus.FAILED
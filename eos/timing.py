@@ -0,0 +1,135 @@
+import bisect
+import contextlib
+import logging
+import os
+import socket
+import threading
+import time
+import typing as t
+
+import rq
+from django.conf import settings
+from redis import Redis
+from redis.exceptions import RedisError
+
+logger = logging.getLogger(__name__)
+
+# upper bounds, in seconds, of the histogram buckets kept for each stage
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float("inf"))
+
+
+class CallTimings:
+    """
+    Seconds spent in each named stage of a single call. A stage entered more than once is summed.
+    """
+
+    def __init__(self) -> None:
+        self.stages: t.Dict[str, float] = {}
+
+    @contextlib.contextmanager
+    def stage(self, name: str) -> t.Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name: str, seconds: float) -> None:
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+
+class NullTimings(CallTimings):
+    _context = contextlib.nullcontext()
+
+    def stage(self, name: str) -> t.ContextManager[None]:  # type: ignore[override]
+        return self._context
+
+    def add(self, name: str, seconds: float) -> None:
+        pass
+
+
+NULL_TIMINGS = NullTimings()
+_local = threading.local()
+
+
+def current() -> CallTimings:
+    """
+    The timings being collected on this thread, or a recorder that discards everything.
+    """
+    return getattr(_local, "timings", NULL_TIMINGS)
+
+
+def worker_name() -> str:
+    job = rq.get_current_job()
+    if job is not None and job.worker_name:
+        return job.worker_name
+    return f"{socket.gethostname()}.{os.getpid()}"
+
+
+def histogram_key(name: str) -> str:
+    return f"eos:timings:{name}"
+
+
+@contextlib.contextmanager
+def timed_call(redis: Redis, description: str, **fields: t.Any) -> t.Iterator[CallTimings]:
+    """
+    Collect the stage timings recorded on this thread while the block runs, then log them as structured fields and
+    add them to this worker's histograms in redis. Does nothing unless AMEX_CALL_TIMINGS is set.
+    """
+    if not settings.AMEX_CALL_TIMINGS:
+        yield NULL_TIMINGS
+        return
+
+    timings = _local.timings = CallTimings()
+    try:
+        with timings.stage("total"):
+            yield timings
+    finally:
+        del _local.timings
+        logger.info(
+            f"{description} took {timings.stages['total']:.3f}s",
+            extra={**fields, **{f"timing_{stage}": seconds for stage, seconds in timings.stages.items()}},
+        )
+        try:
+            observe(redis, worker_name(), timings.stages)
+        except RedisError:
+            # the call itself may well have succeeded, so losing its timings must not fail it
+            logger.exception("Could not record call timings")
+
+
+def observe(redis: Redis, name: str, stages: t.Dict[str, float]) -> None:
+    key = histogram_key(name)
+    with redis.pipeline(transaction=False) as pipe:
+        for stage, seconds in stages.items():
+            pipe.hincrby(key, f"{stage}:{BUCKETS[bisect.bisect_left(BUCKETS, seconds)]}", 1)
+            pipe.hincrby(key, f"{stage}:count", 1)
+            pipe.hincrbyfloat(key, f"{stage}:sum", seconds)
+        pipe.expire(key, settings.AMEX_CALL_TIMINGS_TTL)
+        pipe.execute()
+
+
+def histograms(redis: Redis, name: str) -> t.Dict[str, t.Dict[str, float]]:
+    """
+    The histograms kept for worker `name`, as {stage: {"count": n, "sum": seconds, "<bucket bound>": n, ...}}.
+    """
+    result: t.Dict[str, t.Dict[str, float]] = {}
+    for field, value in redis.hgetall(histogram_key(name)).items():
+        stage, _, bucket = field.decode().rpartition(":")
+        result.setdefault(stage, {})[bucket] = float(value)
+    return result
+
+
+def summary(histogram: t.Dict[str, float]) -> t.Dict[str, float]:
+    """
+    Count, mean and the bucket bounds containing the median and p95 of one stage's histogram.
+    """
+    count = histogram.get("count", 0.0)
+    result = {"count": count, "mean": round(histogram.get("sum", 0.0) / count, 4) if count else 0.0}
+    for name, point in (("p50", 0.5), ("p95", 0.95)):
+        seen = 0.0
+        for bound in BUCKETS:
+            seen += histogram.get(str(bound), 0.0)
+            if seen >= count * point:
+                result[name] = bound
+                break
+    return result
@@ -0,0 +1,354 @@
+import itertools
+import logging
+import resource
+import signal
+import threading
+import time
+import typing as t
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import rq
+from django.conf import settings
+from django.db import close_old_connections, connection
+from redis.exceptions import RedisError
+from rq.timeouts import TimerDeathPenalty
+from rq.worker import WorkerStatus
+
+from eos import tasks
+from eos.circuitbreaker import CircuitOpen
+from eos.ratelimit import RateLimitExceeded
+from eos.shards import ShardLease
+from eos.tasks import amex_agent
+
+logger = logging.getLogger(__name__)
+
+
+def weighted_schedule(weights: t.Dict[str, int]) -> t.List[str]:
+    """
+    One round of smooth weighted round robin: each name appears as many times as its weight, spread out as evenly
+    as possible rather than in runs.
+    """
+    total = sum(weights.values())
+    current = dict.fromkeys(weights, 0)
+    schedule = []
+    for _ in range(total):
+        for name, weight in weights.items():
+            current[name] += weight
+        chosen = max(current, key=lambda name: current[name])
+        current[chosen] -= total
+        schedule.append(chosen)
+    return schedule
+
+
+class WeightedQueuesMixin:
+    """
+    Takes jobs from an rq worker's queues in weighted round robin, by queue name, rather than always draining the
+    first queue before the next. Each dequeue tries the queue whose turn it is first and falls back to the others
+    in their given order, so no turn is wasted on an empty queue. Queues without a weight count as 1.
+    """
+
+    queues: t.List[rq.Queue]
+
+    def __init__(self, *args: t.Any, weights: t.Optional[t.Dict[str, int]] = None, **kwargs: t.Any) -> None:
+        super().__init__(*args, **kwargs)
+        weights = tasks.queue_weights() if weights is None else weights
+        schedule = weighted_schedule({queue.name: weights.get(queue.name, 1) for queue in self.queues})
+        self._turns = itertools.cycle(schedule or [""])
+
+    def reorder_queues(self, reference_queue: rq.Queue) -> None:
+        turn = next(self._turns)
+        self._ordered_queues = sorted(self.queues, key=lambda queue: queue.name != turn)
+
+
+class Worker(WeightedQueuesMixin, rq.Worker):
+    """
+    Keeps the Amex secret cache warm in the long-lived parent process so that
+    every forked work horse inherits it instead of going to the vault itself.
+    """
+
+    def execute_job(self, job: rq.job.Job, queue: rq.Queue) -> None:
+        amex_agent().warm_secrets()
+        super().execute_job(job, queue)
+
+
+def peak_rss_mb() -> float:
+    # kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class RecyclingMixin:
+    """
+    Stops a long-lived rq worker, for its process to be replaced by a fresh one, once it has run `max_jobs` jobs or
+    its peak memory has grown by `max_memory` MB since its first job. `recycle` is set when that is the reason the
+    worker stopped.
+    """
+
+    def __init__(
+        self, *args: t.Any, max_jobs: t.Optional[int] = None, max_memory: t.Optional[float] = None, **kwargs: t.Any
+    ) -> None:
+        super().__init__(*args, **kwargs)
+        self.max_jobs = max_jobs
+        self.max_memory = max_memory
+        self.jobs_started = 0
+        self.baseline_memory: t.Optional[float] = None
+        self.recycle = False
+        self._recycling_lock = threading.Lock()
+
+    def execute_job(self, job: rq.job.Job, queue: rq.Queue) -> None:
+        super().execute_job(job, queue)  # type: ignore[misc]
+        self.job_done()
+
+    def job_done(self) -> None:
+        """
+        Count a finished job, and stop the worker if that takes it over its limits. Thread safe, for workers that
+        finish jobs off the main thread.
+        """
+        with self._recycling_lock:
+            self.jobs_started += 1
+            memory = peak_rss_mb()
+            if self.baseline_memory is None:
+                # measured after the first job, once the caches it warms are in place
+                self.baseline_memory = memory
+            if self.recycle:
+                return
+            if self.max_jobs and self.jobs_started >= self.max_jobs:
+                self._request_recycle(f"{self.jobs_started} jobs run")
+            elif self.max_memory and memory - self.baseline_memory >= self.max_memory:
+                self._request_recycle(f"memory grew by {memory - self.baseline_memory:.0f}MB")
+
+    def _request_recycle(self, reason: str) -> None:
+        logger.info(f"Recycling worker process: {reason}")
+        self.recycle = True
+        self._stop_requested = True
+
+
+class PersistentWorker(WeightedQueuesMixin, RecyclingMixin, rq.SimpleWorker):
+    """
+    Runs each job in this long-lived process rather than a forked work horse, so the Amex agent's pooled
+    connections, the secret cache and the database connection stay warm from one job to the next. Job timeouts are
+    still enforced with SIGALRM.
+    """
+
+    def execute_job(self, job: rq.job.Job, queue: rq.Queue) -> None:
+        # as Django does around each request, so that CONN_MAX_AGE is honoured and broken connections are replaced
+        close_old_connections()
+        try:
+            super().execute_job(job, queue)
+        finally:
+            close_old_connections()
+
+
+class ConcurrentWorker(WeightedQueuesMixin, RecyclingMixin, rq.SimpleWorker):
+    """
+    Keeps up to `concurrency` jobs in flight from a single process.
+
+    rq's own loop still dequeues jobs, but instead of forking a work horse each job is performed on a thread pool
+    sharing this process' Amex agent and its connection pool. Dequeueing blocks while every slot is busy, and a warm
+    shutdown waits for the jobs already in flight. Jobs count towards recycling as they finish on the pool, and a
+    recycle likewise waits for the jobs in flight.
+    """
+
+    # signal based timeouts only work on the main thread
+    death_penalty_class = TimerDeathPenalty  # type: ignore[assignment]
+
+    def __init__(self, *args: t.Any, concurrency: int, **kwargs: t.Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.concurrency = concurrency
+        self._slots = threading.BoundedSemaphore(concurrency)
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="job")
+
+    def execute_job(self, job: rq.job.Job, queue: rq.Queue) -> None:
+        self._slots.acquire()
+        self.set_state(WorkerStatus.BUSY)
+        self._executor.submit(self._perform_job, job, queue)
+
+    def _perform_job(self, job: rq.job.Job, queue: rq.Queue) -> None:
+        try:
+            self.perform_job(job, queue)
+        finally:
+            close_old_connections()
+            # before freeing the slot, so that a recycle stops the next dequeue when every slot was busy
+            self.job_done()
+            self._slots.release()
+
+    def teardown(self) -> None:
+        logger.info("Waiting for in-flight jobs to finish")
+        self._executor.shutdown(wait=True)
+        super().teardown()
+
+
+class ShardWorker:
+    """
+    Takes the jobs of one shard queue at a time, under a ShardLease so that no other worker takes them too, and so
+    sends the items of each MID to Amex one after the other in the order they were queued. Jobs on the shared queues,
+    such as batch dispatches, are taken in between.
+
+    Running AMEX_SHARDS of these gives every shard its consumer, and any more wait to take over the shard of a worker
+    that stops renewing its lease. In burst mode the worker drains each shard it can lease in turn until none has
+    jobs left. A shard job that fails parks its unsent items as dead letters.
+    """
+
+    def __init__(self, max_jobs: t.Optional[int] = None, max_memory: t.Optional[float] = None) -> None:
+        self.recycling: t.Dict[str, t.Any] = {"max_jobs": max_jobs, "max_memory": max_memory}
+        self.lease = ShardLease(tasks.redis, owner=uuid.uuid4().hex, ttl=settings.SHARD_LEASE_TTL)
+        self.lease_lost = False
+        self.recycle = False
+
+    def make_worker(self, shard: int) -> PersistentWorker:
+        # equal turns, as the shared queues only carry the odd dispatch
+        queues = [tasks.shard_queue(shard), *tasks.worker_queues()]
+        return PersistentWorker(
+            queues,
+            connection=tasks.redis,
+            weights={},
+            exception_handlers=[tasks.dead_letter_chunk],
+            **self.recycling,
+        )
+
+    def work(self, burst: bool = False) -> None:
+        if burst:
+            self._drain()
+            return
+        while True:
+            worker = self._work_shard(self._wait_for_shard(), burst=False)
+            self.recycle = worker.recycle
+            if not self.lease_lost:
+                return
+
+    def _wait_for_shard(self) -> int:
+        while True:
+            for shard in range(settings.AMEX_SHARDS):
+                if self.lease.acquire(shard):
+                    return shard
+            logger.debug("Every shard has a worker, waiting to take one over")
+            time.sleep(self.lease.ttl / 3)
+
+    def _drain(self) -> None:
+        while True:
+            jobs = 0
+            for shard in range(settings.AMEX_SHARDS):
+                if not self.lease.acquire(shard):
+                    continue
+                worker = self._work_shard(shard, burst=True)
+                jobs += worker.jobs_started
+                if worker._stop_requested:
+                    self.recycle = worker.recycle
+                    return
+            if not jobs:
+                return
+
+    def _work_shard(self, shard: int, burst: bool) -> PersistentWorker:
+        """
+        Run a worker on a leased shard until it stops, renewing the lease meanwhile, then give the lease up.
+        """
+        logger.info(f"Taking the jobs of shard {shard}")
+        worker = self.make_worker(shard)
+        self.lease_lost = False
+        stop = threading.Event()
+        renewer = threading.Thread(target=self._renew, args=(shard, worker, stop), name=f"shard-{shard}-lease")
+        renewer.start()
+        try:
+            worker.work(burst=burst, with_scheduler=False)
+        finally:
+            stop.set()
+            renewer.join()
+            self.lease.release(shard)
+        return worker
+
+    def _renew(self, shard: int, worker: PersistentWorker, stop: threading.Event) -> None:
+        renewed = time.monotonic()
+        while not stop.wait(self.lease.ttl / 3):
+            try:
+                if self.lease.renew(shard):
+                    renewed = time.monotonic()
+                    continue
+            except RedisError:
+                logger.exception(f"Could not renew the lease on shard {shard}")
+                if time.monotonic() - renewed < self.lease.ttl:
+                    continue
+            # another worker may have the shard by now, so stop after the job in hand
+            logger.warning(f"Lost the lease on shard {shard}, stopping")
+            self.lease_lost = True
+            worker._stop_requested = True
+            return
+
+
+class DatabaseWorker:
+    """
+    Claims blocks of QUEUED items straight from the table with SELECT ... FOR UPDATE SKIP LOCKED instead of taking
+    jobs from redis, so any number of workers can drain one batch without waiting on each other's rows.
+
+    Each of `concurrency` threads claims and processes its own blocks of `block_size` items, dispatching batches
+    whose dispatch is PENDING in between. On SIGINT or SIGTERM the threads finish the item in hand and put the rest
+    of their block back to QUEUED. Results are written in bulk at the end of each block.
+    """
+
+    def __init__(self, concurrency: int = 1, block_size: t.Optional[int] = None) -> None:
+        self.concurrency = concurrency
+        self.block_size = block_size or settings.DB_WORKER_BLOCK_SIZE
+        self.stopping = threading.Event()
+
+    def work(self, burst: bool = False) -> None:
+        handlers = {signum: signal.signal(signum, self.request_stop) for signum in (signal.SIGINT, signal.SIGTERM)}
+        threads = [
+            threading.Thread(target=self._run, args=(burst,), name=f"db-worker-{n}") for n in range(self.concurrency)
+        ]
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
+
+    def request_stop(self, signum: int, frame: t.Any) -> None:
+        logger.info("Stopping once the items in hand are done")
+        self.stopping.set()
+
+    def _run(self, burst: bool) -> None:
+        try:
+            while not self.stopping.is_set():
+                if not self.work_once() and (burst or self.stopping.wait(settings.DB_WORKER_POLL_INTERVAL)):
+                    return
+        finally:
+            connection.close()
+
+    def work_once(self) -> bool:
+        """
+        Dispatch one PENDING batch or process one block of items. Returns False if there was nothing to do.
+        """
+        batch_id = tasks.claim_pending_batch()
+        if batch_id is not None:
+            tasks.dispatch_batch(batch_id)
+            return True
+        item_ids, claimed_at = tasks.claim_items(self.block_size)
+        if not item_ids:
+            return False
+        self.process_block(item_ids, claimed_at)
+        return True
+
+    def process_block(self, item_ids: t.List[int], claimed_at: datetime) -> None:
+        remaining = list(item_ids)
+        try:
+            while remaining and not self.stopping.is_set():
+                self._process(remaining.pop(0), claimed_at)
+        finally:
+            tasks.release_items(remaining, claimed_at)
+        tasks.results.flush_quietly()
+
+    def _process(self, item_id: int, claimed_at: datetime) -> None:
+        try:
+            tasks.process_claimed_item(item_id, claimed_at)
+        except RateLimitExceeded:
+            # already back to QUEUED, to be claimed again
+            pass
+        except CircuitOpen as ex:
+            logger.info(f"{ex}, pausing")
+            self.stopping.wait(ex.retry_after)
+        except Exception as ex:
+            # without a job retry policy to fall back on, stop the item being claimed over and over
+            logger.exception(f"Processing BatchItem ({item_id}) failed")
+            tasks.fail_item(item_id, ex)
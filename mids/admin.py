@@ -1,8 +1,11 @@
+import codecs
 import csv
 import io
+import json
 import logging
 import typing as t
 from datetime import date, datetime
+from functools import partial
 
 import rq
 from django import forms
@@ -11,7 +14,7 @@ from django.contrib import admin, messages
 from django.core.files.uploadedfile import UploadedFile
 from django.db import transaction
 from django.db.models import QuerySet
-from django.http import HttpRequest, HttpResponse, StreamingHttpResponse
+from django.http import HttpRequest, HttpResponse, JsonResponse, StreamingHttpResponse
 from django.shortcuts import redirect
 from django.template.response import TemplateResponse
 from django.urls import path, reverse
@@ -21,8 +24,9 @@ from django.utils.http import urlencode
 from django.utils.safestring import SafeText
 from redis.exceptions import RedisError
 
-from eos import tasks
-from mids.models import Batch, BatchItem, BatchItemAction, BatchItemStatus
+from eos import counts, tasks
+from mids import roster
+from mids.models import Batch, BatchDispatchStatus, BatchItem, BatchItemAction, BatchItemStatus, MerchantRegistration
 
 logger = logging.getLogger(__name__)
 
@@ -39,43 +43,109 @@ class FileUploadForm(forms.Form):
         return file
 
 
-def queue_batches(batches: QuerySet, user_name: str) -> t.Tuple[t.List[int], t.List[int]]:
-    queued, errors = [], []
+class RosterUploadForm(FileUploadForm):
+    input_file = forms.FileField(
+        label="Select full MID roster file",
+    )
+
+
+def dispatch_batches(
+    batches: QuerySet, user_name: str, force: bool = False, urgent: bool = False
+) -> t.Tuple[t.List[int], t.List[int], t.List[int]]:
+    """
+    Record who sent each batch and have a worker queue its items, through a dispatch_batch job unless database
+    workers dispatch them. With `force`, items are sent even to MIDs already registered as they ask. With `urgent`,
+    the items go on the urgent queue. Returns the ids of the batches dispatched, of those skipped because a dispatch is
+    already under way, and of those whose job could not be enqueued.
+    """
+    queue = tasks.urgent_queue if urgent else tasks.task_queue
+    dispatched: t.List[int] = []
+    busy: t.List[int] = []
+    errors: t.List[int] = []
     for batch in batches:
         with transaction.atomic():
-            batch.sender_name = user_name
-            batch.date_sent = datetime.now()
-            logger.info(f"Queuing items from batch {batch.file_name}")
-            for item in batch.batchitem_set.select_for_update().filter(status=BatchItemStatus.PENDING):
-                try:
-                    tasks.task_queue.enqueue(
-                        tasks.process_item,
-                        item.id,
-                        retry=rq.Retry(max=1, interval=[10, 30, 60]),
-                    )
-                    queued.append(item.id)
-                except RedisError:
-                    errors.append(item.id)
-            batch.batchitem_set.filter(id__in=queued).update(status=BatchItemStatus.QUEUED)
-            batch.save()
-        logger.info(f"Queued {len(queued)} items from batch {batch.file_name}")
-    return queued, errors
+            claimed = (
+                Batch.objects.filter(id=batch.id)
+                .exclude(dispatch_status__in=(BatchDispatchStatus.PENDING, BatchDispatchStatus.DISPATCHING))
+                .update(
+                    sender_name=user_name,
+                    date_sent=datetime.now(),
+                    dispatch_status=BatchDispatchStatus.PENDING,
+                    force_send=force,
+                    urgent=urgent,
+                )
+            )
+            if not claimed:
+                busy.append(batch.id)
+                continue
+            # database workers pick up PENDING dispatches themselves
+            if settings.DISPATCH_MODE != tasks.DISPATCH_MODE_DB:
+                # only once committed, so that the job finds the batch as it was sent
+                transaction.on_commit(partial(enqueue_dispatch, queue, batch.id, errors))
+        if batch.id in errors:
+            continue
+        logger.info(f"Dispatching batch {batch.file_name}")
+        dispatched.append(batch.id)
+    return dispatched, busy, errors
+
+
+def enqueue_dispatch(queue: rq.Queue, batch_id: int, errors: t.List[int]) -> None:
+    try:
+        queue.enqueue(tasks.dispatch_batch, batch_id, job_timeout=settings.DISPATCH_JOB_TIMEOUT)
+    except RedisError:
+        logger.exception(f"Could not enqueue the dispatch of batch {batch_id}")
+        Batch.objects.filter(id=batch_id, dispatch_status=BatchDispatchStatus.PENDING).update(
+            dispatch_status=BatchDispatchStatus.FAILED
+        )
+        errors.append(batch_id)
 
 
 def queue_batches_action(modeladmin: admin.ModelAdmin, request: HttpRequest, queryset: QuerySet) -> None:
-    queued, errors = queue_batches(queryset, request.user.get_username())
-    if queued:
-        messages.info(request, "Queued {} items".format(len(queued)))
-    else:
-        messages.warning(request, "No items queued. Perhaps none in the batch were PENDING")
+    report_dispatch(request, *dispatch_batches(queryset, request.user.get_username()))
+
+
+queue_batches_action.short_description = "Process batches"  # type:ignore
+
+
+def resend_batches_action(modeladmin: admin.ModelAdmin, request: HttpRequest, queryset: QuerySet) -> None:
+    report_dispatch(request, *dispatch_batches(queryset, request.user.get_username(), force=True))
+
+
+resend_batches_action.short_description = "Process batches, resending to registered MIDs"  # type:ignore
+
+
+def urgent_batches_action(modeladmin: admin.ModelAdmin, request: HttpRequest, queryset: QuerySet) -> None:
+    report_dispatch(request, *dispatch_batches(queryset, request.user.get_username(), urgent=True))
+
+
+urgent_batches_action.short_description = "Process batches urgently, ahead of other batches"  # type:ignore
+
+
+def report_dispatch(request: HttpRequest, dispatched: t.List[int], busy: t.List[int], errors: t.List[int]) -> None:
+    if dispatched:
+        messages.info(request, "Queuing items from {} batches in the background".format(len(dispatched)))
+    if busy:
+        messages.warning(request, "{} batches are already being queued".format(len(busy)))
     if errors:
         messages.warning(
             request,
-            "{} items were not queued due to an error with redis".format(len(errors)),
+            "{} batches were not queued due to an error with redis".format(len(errors)),
         )
 
 
-queue_batches_action.short_description = "Process batches"  # type:ignore
+def redrive_items_action(modeladmin: admin.ModelAdmin, request: HttpRequest, queryset: QuerySet) -> None:
+    dead_letters = queryset.filter(status=BatchItemStatus.DEAD_LETTER)
+    try:
+        queued, errors = tasks.redrive_items(list(dead_letters.values_list("id", flat=True)))
+    except RedisError:
+        messages.warning(request, "Dead letter items were not queued due to an error with redis")
+        return
+    messages.info(request, "Queued {} dead letter items again".format(len(queued)))
+    if errors:
+        messages.warning(request, "{} items were not queued due to an error with redis".format(len(errors)))
+
+
+redrive_items_action.short_description = "Re-drive dead letter items"  # type:ignore
 
 
 class TypedRow(t.TypedDict):
@@ -93,12 +163,15 @@ class BatchAdmin(admin.ModelAdmin):
         "batch_filter_link",
         "time_uploaded",
         "export_link",
+        "progress_link",
         "processed",
+        "item_counts",
+        "dispatch_progress",
         "sender_name",
         "date_sent",
     ]
     fields = readonly_fields = ["file_name", "time_uploaded"]
-    actions = [queue_batches_action]
+    actions = [queue_batches_action, urgent_batches_action, resend_batches_action]
 
     # def user_email(self, obj: Batch) -> str:
     # return obj.user.email
@@ -109,9 +182,77 @@ class BatchAdmin(admin.ModelAdmin):
                 "<int:batch_id>/export/",
                 admin.site.admin_view(self.export_as_csv),
                 name="export_as_csv",
-            )
+            ),
+            path(
+                "roster/",
+                admin.site.admin_view(self.roster_view),
+                name="mids_batch_roster",
+            ),
+            path(
+                "<int:batch_id>/progress/",
+                admin.site.admin_view(self.progress_page),
+                name="mids_batch_progress",
+            ),
+            path(
+                "<int:batch_id>/progress/json/",
+                admin.site.admin_view(self.progress_view),
+                name="mids_batch_progress_json",
+            ),
+            path(
+                "<int:batch_id>/progress/stream/",
+                admin.site.admin_view(self.progress_stream),
+                name="mids_batch_progress_stream",
+            ),
         ] + super().get_urls()
 
+    def _read_progress(self, batch_id: int) -> t.Optional[t.Dict[str, t.Any]]:
+        progress = tasks.progress.read(batch_id)
+        if progress is None:
+            # counting the items here would hold the request for as long as the query takes
+            tasks.request_progress(batch_id)
+        return progress
+
+    def progress_page(self, request: HttpRequest, batch_id: int) -> HttpResponse:
+        return TemplateResponse(
+            request,
+            "admin/batch_progress.html",
+            {
+                "batch": Batch.objects.get(id=batch_id),
+                "title": "Progress",
+                "site_header": settings.SITE_HEADER,
+            },
+        )
+
+    def progress_view(self, request: HttpRequest, batch_id: int) -> JsonResponse:
+        try:
+            progress = self._read_progress(batch_id)
+        except RedisError:
+            return JsonResponse({"error": "Progress is unavailable due to an error with redis"}, status=503)
+        if progress is None:
+            return JsonResponse({"error": "Progress is being counted, try again shortly"}, status=503)
+        return JsonResponse(progress)
+
+    def progress_stream(self, request: HttpRequest, batch_id: int) -> HttpResponse:
+        """
+        One server-sent event per request, with EventSource reconnecting after PROGRESS_STREAM_INTERVAL seconds.
+        """
+        try:
+            progress = self._read_progress(batch_id)
+        except RedisError:
+            logger.exception(f"Could not read the progress of batch {batch_id}")
+            # EventSource gives up on anything but a 200
+            return HttpResponse(status=503)
+        if progress is None:
+            event = "counting"
+        else:
+            event = "done" if progress["finished"] == progress["total"] else "progress"
+        retry = round(settings.PROGRESS_STREAM_INTERVAL * 1000)
+        response = HttpResponse(
+            f"retry: {retry}\nevent: {event}\ndata: {json.dumps(progress)}\n\n", content_type="text/event-stream"
+        )
+        response["Cache-Control"] = "no-cache"
+        return response
+
     def export_as_csv(self, request: HttpRequest, batch_id: int) -> StreamingHttpResponse:
         field_names = [
             "mid",
@@ -155,14 +296,23 @@ class BatchAdmin(admin.ModelAdmin):
         return response
 
     def processed(self, obj: Batch) -> bool:
-        return (
-            not BatchItem.objects.filter(batch__id=obj.id)
-            .filter(status__in=(BatchItemStatus.PENDING, BatchItemStatus.QUEUED))
-            .exists()
-        )
+        return obj.pending_items == 0 and obj.queued_items == 0
 
     processed.boolean = True  # type:ignore
 
+    def item_counts(self, obj: Batch) -> str:
+        return f"{obj.done_items} done, {obj.error_items} errors of {obj.total_items}"
+
+    item_counts.short_description = "Items"  # type:ignore
+
+    def dispatch_progress(self, obj: Batch) -> str:
+        label = BatchDispatchStatus(obj.dispatch_status).label
+        if obj.dispatch_status in (BatchDispatchStatus.NOT_DISPATCHED, BatchDispatchStatus.PENDING):
+            return label
+        return f"{label}: {obj.items_dispatched} of {obj.items_to_dispatch} queued"
+
+    dispatch_progress.short_description = "Dispatch"  # type:ignore
+
     def batch_filter_link(self, obj: Batch) -> SafeText:
         url = reverse("admin:mids_batchitem_changelist") + "?" + urlencode({"batch__id": f"{obj.id}"})
         return format_html('<a href="{}">{}</a>', url, obj.file_name)
@@ -171,6 +321,12 @@ class BatchAdmin(admin.ModelAdmin):
         url = reverse("admin:export_as_csv", args=[obj.id])
         return format_html('<a href="{}">Export</a>', url)
 
+    def progress_link(self, obj: Batch) -> SafeText:
+        url = reverse("admin:mids_batch_progress", args=[obj.id])
+        return format_html('<a href="{}">Progress</a>', url)
+
+    progress_link.short_description = "Progress"  # type:ignore
+
     REQUIRED_COLUMNS = [
         "mid",
         "start_date",
@@ -240,16 +396,22 @@ class BatchAdmin(admin.ModelAdmin):
             errors.append(f"Start date ({row['start_date']}) >= end date ({row['end_date']})")
         return typed_row, errors
 
-    def _process_rows(self, reader: csv.DictReader) -> t.Tuple[t.List[TypedRow], t.Dict[str, t.List[str]]]:
-        errors = {}
-        typed_rows: t.List[TypedRow] = []
+    def _process_rows(
+        self, reader: t.Iterable[t.Dict[str, str]]
+    ) -> t.Tuple[t.List[TypedRow], t.Dict[str, t.List[str]]]:
+        errors: t.Dict[str, t.List[str]] = {}
+        typed_rows = list(self._valid_rows(reader, errors))
+        return typed_rows, errors
+
+    def _valid_rows(
+        self, reader: t.Iterable[t.Dict[str, str]], errors: t.Dict[str, t.List[str]]
+    ) -> t.Iterator[TypedRow]:
         for row in reader:
             typed_row, row_errors = self._validate_row(row)
             if row_errors:
                 errors[row["mid"]] = row_errors
             elif typed_row:
-                typed_rows.append(typed_row)
-        return typed_rows, errors
+                yield typed_row
 
     def add_view(
         self,
@@ -280,7 +442,11 @@ class BatchAdmin(admin.ModelAdmin):
 
                 if not errors:
                     with transaction.atomic():
-                        batch = Batch.objects.create(file_name=file.name or "filename.csv")
+                        batch = Batch.objects.create(
+                            file_name=file.name or "filename.csv",
+                            total_items=len(typed_rows),
+                            pending_items=len(typed_rows),
+                        )
                         BatchItem.objects.bulk_create(
                             [BatchItem(batch=batch, status=BatchItemStatus.PENDING, **row) for row in typed_rows]
                         )
@@ -302,6 +468,100 @@ class BatchAdmin(admin.ModelAdmin):
             },
         )
 
+    ROSTER_COLUMNS = [column for column in REQUIRED_COLUMNS if column != "action"]
+
+    def roster_view(self, request: HttpRequest) -> HttpResponse:
+        """
+        Upload a merchant's full roster of MIDs, preview the ADDs and DELETEs that bring their registrations into line
+        with it, then import those as a batch.
+        """
+        if request.method == "POST" and "token" in request.POST:
+            return self._import_roster(request, request.POST["token"])
+
+        errors = None
+        form = RosterUploadForm(request.POST, request.FILES) if request.method == "POST" else RosterUploadForm()
+        if request.method == "POST" and form.is_valid():
+            response, errors = self._upload_roster(request, t.cast(UploadedFile, request.FILES["input_file"]))
+            if response is not None:
+                return response
+        return TemplateResponse(
+            request,
+            "admin/upload.html",
+            {
+                "form": form,
+                "file_errors": errors,
+                "title": "Upload roster",
+                "site_header": settings.SITE_HEADER,
+            },
+        )
+
+    def _upload_roster(
+        self, request: HttpRequest, file: UploadedFile
+    ) -> t.Tuple[t.Optional[HttpResponse], t.Optional[t.Dict[str, t.List[str]]]]:
+        # decoded line by line rather than read whole, as a roster holds every MID of a merchant
+        reader = csv.DictReader(codecs.iterdecode(file, "utf-8"))
+        errors: t.Dict[str, t.List[str]] = {}
+        try:
+            if set(reader.fieldnames or []) != set(self.ROSTER_COLUMNS):
+                messages.error(request, f"Required column headers: {', '.join(self.ROSTER_COLUMNS)}")
+                return redirect(reverse("admin:mids_batch_roster")), None
+            # every MID in a roster is one that should be registered
+            diff = roster.RosterDiff(
+                self._valid_rows((row | {"action": BatchItemAction.ADD} for row in reader), errors)
+            )
+        except UnicodeDecodeError:
+            messages.error(request, "Invalid file format")
+            return redirect(reverse("admin:mids_batch_roster")), None
+
+        for mid, provider_slug in diff.duplicates:
+            errors.setdefault(mid, []).append(f"Listed more than once for {provider_slug}")
+        if errors:
+            messages.error(request, "Invalid file contents. Please see below")
+            return None, errors
+        return self._preview_roster(request, file.name or "roster.csv", diff), None
+
+    def _preview_roster(self, request: HttpRequest, file_name: str, diff: roster.RosterDiff) -> HttpResponse:
+        try:
+            token = roster.stash(tasks.redis, file_name, diff.rows())
+        except RedisError:
+            messages.error(request, "The roster could not be previewed due to an error with redis")
+            return redirect(reverse("admin:mids_batch_roster"))
+        return TemplateResponse(
+            request,
+            "admin/roster_preview.html",
+            {
+                "token": token,
+                "file_name": file_name,
+                "summary": diff.summary(),
+                "adds": len(diff.adds),
+                "deletes": len(diff.deletes),
+                "title": "Confirm roster changes",
+                "site_header": settings.SITE_HEADER,
+            },
+        )
+
+    def _import_roster(self, request: HttpRequest, token: str) -> HttpResponse:
+        try:
+            stashed = roster.unstash(tasks.redis, token)
+        except RedisError:
+            messages.error(request, "The roster could not be imported due to an error with redis")
+            return redirect(reverse("admin:mids_batch_roster"))
+        if stashed is None:
+            messages.error(request, "The roster preview has expired, please upload the roster again")
+            return redirect(reverse("admin:mids_batch_roster"))
+
+        file_name, rows = stashed
+        if rows:
+            with transaction.atomic():
+                batch = Batch.objects.create(file_name=file_name, total_items=len(rows), pending_items=len(rows))
+                BatchItem.objects.bulk_create(
+                    (BatchItem(batch=batch, status=BatchItemStatus.PENDING, **row) for row in rows), batch_size=5000
+                )
+            messages.success(request, f"Batch imported with {len(rows)} changes from the roster")
+        else:
+            messages.info(request, "The roster matches the registered MIDs, there is nothing to import")
+        return redirect(reverse("admin:mids_batch_changelist"))
+
 
 @admin.register(BatchItem)
 class BatchItemAdmin(admin.ModelAdmin):
@@ -321,8 +581,10 @@ class BatchItemAdmin(admin.ModelAdmin):
         "updated",
         "request_timestamp",
         "response",
+        "attempts",
     ]
     list_filter = ["status", "error_type", "action", "merchant_slug"]
+    actions = [redrive_items_action]
     search_fields = ["mid"]
     raw_id_fields = ["batch"]
     fields = readonly_fields = list_display  # type: ignore
@@ -330,5 +592,34 @@ class BatchItemAdmin(admin.ModelAdmin):
     def get_queryset(self, request: HttpRequest) -> QuerySet:
         return super().get_queryset(request).select_related("batch")
 
+    def delete_model(self, request: HttpRequest, obj: BatchItem) -> None:
+        with transaction.atomic():
+            deleted = list(BatchItem.objects.select_for_update().filter(id=obj.id).values_list("batch_id", "status"))
+            super().delete_model(request, obj)
+            counts.remove(deleted)
+
+    def delete_queryset(self, request: HttpRequest, queryset: QuerySet) -> None:
+        with transaction.atomic():
+            deleted = list(queryset.select_for_update().values_list("batch_id", "status"))
+            super().delete_queryset(request, queryset)
+            counts.remove(deleted)
+
     def batch_file_name(self, obj: BatchItem) -> str:
         return obj.batch.file_name
+
+
+@admin.register(MerchantRegistration)
+class MerchantRegistrationAdmin(admin.ModelAdmin):
+    list_display = [
+        "mid",
+        "provider_slug",
+        "merchant_slug",
+        "action",
+        "start_date",
+        "end_date",
+        "last_success",
+    ]
+    list_filter = ["action", "provider_slug", "merchant_slug"]
+    search_fields = ["mid"]
+    raw_id_fields = ["last_item"]
+    fields = readonly_fields = list_display + ["last_item"]  # type: ignore
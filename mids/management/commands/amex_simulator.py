@@ -0,0 +1,38 @@
+import json
+import logging
+import typing as t
+
+from django.core.management.base import BaseCommand, CommandParser
+
+from eos.agents.amex_simulator import AmexSimulator, load_config
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Serve a local stand-in for the Amex merchant registration API for load testing"
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument("--host", default="127.0.0.1")
+        parser.add_argument("--port", type=int, default=8443)
+        parser.add_argument(
+            "--config",
+            help="JSON file overriding the simulator's latency, error mix, throttling and credentials. "
+            "See DEFAULT_CONFIG in eos/agents/amex_simulator.py.",
+        )
+
+    def handle(self, *args: t.List[t.Any], **options: t.Any) -> None:
+        config = load_config(options["config"])
+        server = AmexSimulator((options["host"], options["port"]), config)
+        self.stdout.write(
+            f"Amex simulator listening, run workers with AMEX_API_HOST=http://{options['host']}:{server.server_port} "
+            f"AMEX_MTLS=False TEST_RUNNER=True AMEX_CLIENT_ID={config['client_id']} "
+            f"AMEX_CLIENT_SECRET={config['client_secret']}"
+        )
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            logger.info("Shutting down.")
+        finally:
+            server.server_close()
+            self.stdout.write(json.dumps(server.stats(), indent=2))
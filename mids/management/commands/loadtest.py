@@ -0,0 +1,147 @@
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import typing as t
+
+from django.core.management.base import BaseCommand, CommandError, CommandParser
+
+from eos import concurrency, timing
+from eos.agents.amex_simulator import AmexSimulator, load_config
+from eos.tasks import dispatch_batch, redis, worker_queues
+from mids.models import Batch, BatchItem, BatchItemAction, BatchItemStatus, MerchantRegistration
+
+
+class Command(BaseCommand):
+    help = (
+        "Upload a synthetic batch, drain it through `worker --burst` against the local Amex simulator and "
+        "report throughput. Run against a local redis and database only."
+    )
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument("--items", type=int, default=1000, help="Number of items in the synthetic batch.")
+        parser.add_argument("--processes", type=int, default=1, help="Number of worker processes to run.")
+        parser.add_argument("--threads", type=int, default=1, help="--threads passed to the worker.")
+        parser.add_argument("--config", help="Simulator config file, see the amex_simulator command.")
+        parser.add_argument("--keep", action="store_true", help="Keep the synthetic batch afterwards.")
+
+    def handle(self, *args: t.List[t.Any], **options: t.Any) -> None:
+        for queue in worker_queues():
+            if queue.count:
+                raise CommandError(f"Queue {queue.name} is not empty, refusing to mix load test items into it")
+
+        config = load_config(options["config"])
+        server = AmexSimulator(("127.0.0.1", 0), config)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        batch = self.make_batch(options["items"])
+        existing_timings = set(redis.keys(timing.histogram_key("*")))
+        existing_limits = set(concurrency.published(redis))
+        try:
+            # dispatch here rather than on a worker, so no burst worker finds the queue empty before it is filled
+            dispatch_batch(batch.id)
+            start = time.monotonic()
+            self.drain(options["processes"], options["threads"], server, config)
+            elapsed = time.monotonic() - start
+            timings = [
+                timing.histograms(redis, key.decode().removeprefix(timing.histogram_key("")))
+                for key in set(redis.keys(timing.histogram_key("*"))) - existing_timings
+            ]
+            limits = {
+                name: stats for name, stats in concurrency.published(redis).items() if name not in existing_limits
+            }
+            self.report(batch, elapsed, server.stats(), timings, limits)
+        finally:
+            server.shutdown()
+            server.server_close()
+            if not options["keep"]:
+                batch.delete()
+                MerchantRegistration.objects.filter(merchant_slug="loadtest").delete()
+
+    def make_batch(self, size: int) -> Batch:
+        # sent in full every time, whatever registrations earlier runs left behind
+        batch = Batch.objects.create(
+            file_name=f"loadtest-{size}.csv", force_send=True, total_items=size, pending_items=size
+        )
+        BatchItem.objects.bulk_create(
+            BatchItem(
+                batch=batch,
+                mid=f"{9000000000 + n}",
+                start_date=batch.time_uploaded.date(),
+                end_date=batch.time_uploaded.date().replace(year=2999),
+                merchant_slug="loadtest",
+                provider_slug="amex",
+                action=BatchItemAction.ADD,
+                status=BatchItemStatus.PENDING,
+            )
+            for n in range(size)
+        )
+        return batch
+
+    def drain(self, processes: int, threads: int, server: AmexSimulator, config: dict) -> None:
+        """
+        Run burst workers until no retries are left scheduled. A burst worker queues the retries already due when it
+        starts, but exits without waiting for the rest.
+        """
+        self.run_worker(processes, threads, server, config)
+        while due := self.next_retry():
+            time.sleep(max(0.0, due - time.time()))
+            self.run_worker(processes, threads, server, config)
+
+    def next_retry(self) -> t.Optional[float]:
+        """
+        The time the earliest retry scheduled on the worker queues is due, if any.
+        """
+        scheduled = [
+            score
+            for queue in worker_queues()
+            for _, score in redis.zrange(queue.scheduled_job_registry.key, 0, 0, withscores=True)
+        ]
+        return min(scheduled, default=None)
+
+    def run_worker(self, processes: int, threads: int, server: AmexSimulator, config: dict) -> None:
+        env = os.environ | {
+            "AMEX_API_HOST": f"http://127.0.0.1:{server.server_port}",
+            "AMEX_MTLS": "False",
+            "AMEX_CALL_TIMINGS": "True",
+            "TEST_RUNNER": "True",
+            "AMEX_CLIENT_ID": config["client_id"],
+            "AMEX_CLIENT_SECRET": config["client_secret"],
+        }
+        command = [
+            sys.executable,
+            sys.argv[0],
+            "worker",
+            "--burst",
+            "--processes",
+            str(processes),
+            "--threads",
+            str(threads),
+        ]
+        subprocess.run(command, env=env, check=True)
+
+    def report(self, batch: Batch, elapsed: float, server_stats: dict, timings: t.List[dict], limits: dict) -> None:
+        # stage histograms summed over the workers that ran
+        stages: t.Dict[str, t.Dict[str, float]] = {}
+        for histograms in timings:
+            for stage, histogram in histograms.items():
+                for bucket, value in histogram.items():
+                    stages.setdefault(stage, {})
+                    stages[stage][bucket] = stages[stage].get(bucket, 0.0) + value
+        statuses = {
+            BatchItemStatus(status).label: batch.batchitem_set.filter(status=status).count()
+            for status in BatchItemStatus.values
+        }
+        result = {
+            "items": sum(statuses.values()),
+            "statuses": statuses,
+            "elapsed": round(elapsed, 3),
+            "items_per_second": round(batch.batchitem_set.exclude(request_timestamp=None).count() / elapsed, 2),
+            "amex": server_stats,
+            "stages": {stage: timing.summary(histogram) for stage, histogram in stages.items()},
+            # the adaptive concurrency limit each worker process last reported
+            "concurrency": limits,
+        }
+        self.stdout.write(json.dumps(result, indent=2))
@@ -0,0 +1,16 @@
+import typing as t
+
+from django.core.management.base import BaseCommand
+
+from eos.tasks import reclaim_stale_dispatches, reclaim_stale_items
+
+
+class Command(BaseCommand):
+    help = (
+        "Queue again batch items left IN_FLIGHT by a worker that died, and fail the dispatches of batches whose "
+        "dispatcher died, for running on a schedule"
+    )
+
+    def handle(self, *args: t.List[t.Any], **options: t.Any) -> None:
+        self.stdout.write(f"Reclaimed {reclaim_stale_items()} items")
+        self.stdout.write(f"Failed {reclaim_stale_dispatches()} stale dispatches")
@@ -0,0 +1,15 @@
+import typing as t
+
+from django.core.management.base import BaseCommand, CommandParser
+
+from eos.counts import reconcile
+
+
+class Command(BaseCommand):
+    help = "Recount the items of each batch by status and correct the batch's counts where they have drifted"
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument("--batch", type=int, action="append", help="Only this batch; may be given more than once")
+
+    def handle(self, *args: t.List[t.Any], **options: t.Any) -> None:
+        self.stdout.write(f"Corrected the counts of {reconcile(options['batch'])} batches")
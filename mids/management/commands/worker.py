@@ -1,10 +1,24 @@
 import logging
+import os
+import sys
 import typing as t
 
 import rq
-from django.core.management.base import BaseCommand
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError, CommandParser
 
-from eos.tasks import redis, task_queue
+from eos.supervisor import Supervisor
+from eos.tasks import (
+    DISPATCH_MODE_DB,
+    DISPATCH_MODE_QUEUE,
+    DISPATCH_MODE_SHARDED,
+    amex_agent,
+    reclaim_stale_dispatches,
+    reclaim_stale_items,
+    redis,
+    worker_queues,
+)
+from eos.workers import ConcurrentWorker, DatabaseWorker, PersistentWorker, ShardWorker, Worker
 
 logger = logging.getLogger(__name__)
 
@@ -12,10 +26,98 @@ logger = logging.getLogger(__name__)
 class Command(BaseCommand):
     help = "Consume MID on/off-boarding tasks from the queue"
 
-    def handle(self, *args: t.List[t.Any], **options: t.Dict[str, t.Any]) -> None:
-        logger.info(f"Watching queue: {task_queue.name}")
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument(
+            "--threads",
+            "--concurrency",
+            dest="concurrency",
+            type=int,
+            default=settings.WORKER_CONCURRENCY,
+            help="Number of jobs to keep in flight from each worker process. 1 forks a work horse per job unless "
+            "--persistent is given.",
+        )
+        parser.add_argument(
+            "--persistent",
+            action="store_true",
+            default=settings.WORKER_PERSISTENT,
+            help="Run jobs in the worker process itself, keeping warm state from one job to the next.",
+        )
+        parser.add_argument(
+            "--max-jobs",
+            type=int,
+            default=settings.WORKER_MAX_JOBS,
+            help="With --persistent or --threads, replace the worker process after this many jobs.",
+        )
+        parser.add_argument(
+            "--max-memory",
+            type=float,
+            default=settings.WORKER_MAX_MEMORY,
+            help="With --persistent or --threads, replace the worker process once its memory has grown this many MB.",
+        )
+        parser.add_argument(
+            "--processes",
+            type=int,
+            default=settings.WORKER_PROCESSES,
+            help="Number of worker processes to run, restarting any that exit.",
+        )
+        parser.add_argument("--burst", action="store_true", help="Exit once the queue is empty.")
+        parser.add_argument(
+            "--mode",
+            choices=[DISPATCH_MODE_QUEUE, DISPATCH_MODE_DB, DISPATCH_MODE_SHARDED],
+            default=settings.DISPATCH_MODE,
+            help="Take items as jobs from the redis queue, claim QUEUED items straight from the database, or take the "
+            "jobs of one MID shard at a time in order. Sharded workers run jobs in process, one at a time.",
+        )
+
+    def handle(self, *args: t.List[t.Any], **options: t.Any) -> None:
+        concurrency = options["concurrency"]
+        if settings.AMEX_ADAPTIVE_CONCURRENCY and (concurrency <= 1 or options["mode"] == DISPATCH_MODE_SHARDED):
+            # the limit is kept per process, so it has nothing to adapt when each process makes one call at a time
+            raise CommandError("AMEX_ADAPTIVE_CONCURRENCY needs --threads above 1, and is not used in sharded mode")
+        if concurrency > settings.AMEX_POOL_MAXSIZE:
+            logger.warning(f"AMEX_POOL_MAXSIZE is lower than --threads {concurrency}")
+        # pick up items left in flight by a worker that died
+        reclaim_stale_items()
+        reclaim_stale_dispatches()
+        # fetched once here, the secrets are inherited by every worker process and work horse
+        amex_agent().warm_secrets()
+        if options["processes"] > 1:
+            Supervisor(options["processes"], lambda: self.consume(options), burst=options["burst"]).run()
+        else:
+            self.consume(options)
+
+    def consume(self, options: t.Dict[str, t.Any]) -> None:
+        worker: t.Union[rq.Worker, ShardWorker]
         try:
-            worker = rq.Worker([task_queue], connection=redis)
-            worker.work()
+            if options["mode"] == DISPATCH_MODE_DB:
+                logger.info("Claiming items from the database")
+                DatabaseWorker(options["concurrency"]).work(burst=options["burst"])
+                return
+            if options["mode"] == DISPATCH_MODE_SHARDED:
+                logger.info(f"Taking items from one of {settings.AMEX_SHARDS} MID shards at a time")
+                worker = ShardWorker(max_jobs=options["max_jobs"], max_memory=options["max_memory"])
+                worker.work(burst=options["burst"])
+            else:
+                logger.info(f"Watching queues: {', '.join(queue.name for queue in worker_queues())}")
+                worker = self.make_worker(options)
+                # the scheduler moves items deferred while the Amex circuit is open back onto the queue
+                worker.work(burst=options["burst"], with_scheduler=True)
         except KeyboardInterrupt:
             logger.info("Shutting down.")
+            return
+        if getattr(worker, "recycle", False):
+            self.recycle()
+
+    def make_worker(self, options: t.Dict[str, t.Any]) -> rq.Worker:
+        recycling = {"max_jobs": options["max_jobs"], "max_memory": options["max_memory"]}
+        if options["concurrency"] > 1:
+            return ConcurrentWorker(worker_queues(), connection=redis, concurrency=options["concurrency"], **recycling)
+        if options["persistent"]:
+            return PersistentWorker(worker_queues(), connection=redis, **recycling)
+        return Worker(worker_queues(), connection=redis)
+
+    def recycle(self) -> None:
+        # start this command afresh in place of the current process; a supervised child must not supervise in turn
+        for handler in logging.getLogger().handlers:
+            handler.flush()
+        os.execv(sys.executable, [sys.executable, *sys.argv, "--processes", "1"])
@@ -0,0 +1,37 @@
+# Generated by Django 4.2 on 2026-10-17 05:08
+
+from django.db import migrations, models
+
+
+def mark_sent_batches_dispatched(apps, schema_editor):  # type: ignore
+    # batches sent before dispatching moved to the worker were queued in full by the admin
+    Batch = apps.get_model("mids", "Batch")
+    Batch.objects.exclude(date_sent=None).update(dispatch_status=4)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("mids", "0003_auto_20210414_1149"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="batch",
+            name="dispatch_status",
+            field=models.IntegerField(
+                choices=[(1, "Not dispatched"), (2, "Pending"), (3, "Dispatching"), (4, "Dispatched"), (5, "Failed")],
+                default=1,
+            ),
+        ),
+        migrations.AddField(
+            model_name="batch",
+            name="items_dispatched",
+            field=models.IntegerField(default=0, help_text="Items queued so far by the dispatch"),
+        ),
+        migrations.AddField(
+            model_name="batch",
+            name="items_to_dispatch",
+            field=models.IntegerField(default=0, help_text="PENDING items when the dispatch started"),
+        ),
+        migrations.RunPython(mark_sent_batches_dispatched, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.2 on 2026-10-17 05:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("mids", "0004_batch_dispatch_status"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="batchitem",
+            name="claimed_at",
+            field=models.DateTimeField(blank=True, help_text="When a worker started sending the item", null=True),
+        ),
+        migrations.AlterField(
+            model_name="batchitem",
+            name="status",
+            field=models.IntegerField(
+                choices=[(1, "Pending"), (2, "Queued"), (3, "Done"), (4, "Error"), (5, "In flight")]
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="batchitem",
+            index=models.Index(fields=["status", "claimed_at"], name="mids_batchitem_claimed_idx"),
+        ),
+    ]
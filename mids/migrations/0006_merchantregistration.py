@@ -0,0 +1,81 @@
+# Generated by Django 4.2 on 2026-10-17 05:24
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def register_done_items(apps, schema_editor):  # type: ignore
+    # the latest item Amex accepted for each MID stands for its registration so far
+    BatchItem = apps.get_model("mids", "BatchItem")
+    MerchantRegistration = apps.get_model("mids", "MerchantRegistration")
+    items = (
+        BatchItem.objects.filter(status=3)
+        .order_by("mid", "provider_slug", "-request_timestamp", "-id")
+        .distinct("mid", "provider_slug")
+    )
+    registrations = [
+        MerchantRegistration(
+            mid=item.mid,
+            provider_slug=item.provider_slug,
+            merchant_slug=item.merchant_slug,
+            action=item.action,
+            start_date=item.start_date,
+            end_date=item.end_date,
+            last_item=item,
+            last_success=item.request_timestamp,
+        )
+        for item in items.iterator()
+    ]
+    MerchantRegistration.objects.bulk_create(registrations, batch_size=5000)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("mids", "0005_batchitem_claimed_at"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="batch",
+            name="force_send",
+            field=models.BooleanField(
+                default=False, help_text="Send every item, even to MIDs already registered as the item asks"
+            ),
+        ),
+        migrations.AlterField(
+            model_name="batchitem",
+            name="status",
+            field=models.IntegerField(
+                choices=[(1, "Pending"), (2, "Queued"), (3, "Done"), (4, "Error"), (5, "In flight"), (6, "Skipped")]
+            ),
+        ),
+        migrations.CreateModel(
+            name="MerchantRegistration",
+            fields=[
+                ("id", models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("mid", models.CharField(max_length=50)),
+                ("provider_slug", models.CharField(max_length=50)),
+                ("merchant_slug", models.CharField(max_length=50)),
+                ("action", models.CharField(choices=[("A", "Add"), ("D", "Delete")], max_length=1)),
+                ("start_date", models.DateField(blank=True, null=True)),
+                ("end_date", models.DateField(blank=True, null=True)),
+                ("last_success", models.DateTimeField(blank=True, null=True)),
+                (
+                    "last_item",
+                    models.ForeignKey(
+                        blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to="mids.batchitem"
+                    ),
+                ),
+            ],
+            options={
+                "ordering": ["mid"],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name="merchantregistration",
+            constraint=models.UniqueConstraint(
+                fields=("mid", "provider_slug"), name="mids_registration_mid_provider_uniq"
+            ),
+        ),
+        migrations.RunPython(register_done_items, migrations.RunPython.noop),
+    ]
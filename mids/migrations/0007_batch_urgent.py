@@ -0,0 +1,17 @@
+# Generated by Django 4.2 on 2026-10-17 05:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("mids", "0006_merchantregistration"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="batch",
+            name="urgent",
+            field=models.BooleanField(default=False, help_text="Queue items ahead of other batches"),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 4.2 on 2026-10-17 05:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("mids", "0007_batch_urgent"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="batchitem",
+            name="attempts",
+            field=models.IntegerField(default=0, help_text="Failed attempts to send the item"),
+        ),
+        migrations.AddField(
+            model_name="batchitem",
+            name="retry_at",
+            field=models.DateTimeField(
+                blank=True, help_text="When the item will be sent again after a failure", null=True
+            ),
+        ),
+        migrations.AlterField(
+            model_name="batchitem",
+            name="status",
+            field=models.IntegerField(
+                choices=[
+                    (1, "Pending"),
+                    (2, "Queued"),
+                    (3, "Done"),
+                    (4, "Error"),
+                    (5, "In flight"),
+                    (6, "Skipped"),
+                    (7, "Dead letter"),
+                ]
+            ),
+        ),
+    ]
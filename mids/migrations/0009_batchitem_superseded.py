@@ -0,0 +1,28 @@
+# Generated by Django 4.2 on 2026-10-17 05:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("mids", "0008_batchitem_retries"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="batchitem",
+            name="status",
+            field=models.IntegerField(
+                choices=[
+                    (1, "Pending"),
+                    (2, "Queued"),
+                    (3, "Done"),
+                    (4, "Error"),
+                    (5, "In flight"),
+                    (6, "Skipped"),
+                    (7, "Dead letter"),
+                    (8, "Superseded"),
+                ]
+            ),
+        ),
+    ]
@@ -0,0 +1,60 @@
+# Generated by Django 4.2 on 2026-10-17 05:54
+
+from django.db import migrations, models
+from django.db.models import Count, Q
+
+
+def count_items(apps, schema_editor):  # type: ignore
+    # in-flight items count as queued; skipped, dead letter and superseded items only count in the total
+    Batch = apps.get_model("mids", "Batch")
+    BatchItem = apps.get_model("mids", "BatchItem")
+    rows = (
+        BatchItem.objects.values("batch_id")
+        .annotate(
+            total_items=Count("id"),
+            pending_items=Count("id", filter=Q(status=1)),
+            queued_items=Count("id", filter=Q(status__in=(2, 5))),
+            done_items=Count("id", filter=Q(status=3)),
+            error_items=Count("id", filter=Q(status=4)),
+        )
+        .order_by()
+    )
+    batches = [Batch(id=row.pop("batch_id"), **row) for row in rows.iterator()]
+    Batch.objects.bulk_update(
+        batches, ["total_items", "pending_items", "queued_items", "done_items", "error_items"], batch_size=5000
+    )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("mids", "0009_batchitem_superseded"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="batch",
+            name="done_items",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="batch",
+            name="error_items",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="batch",
+            name="pending_items",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="batch",
+            name="queued_items",
+            field=models.IntegerField(default=0, help_text="Items queued or being sent"),
+        ),
+        migrations.AddField(
+            model_name="batch",
+            name="total_items",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(count_items, migrations.RunPython.noop),
+    ]
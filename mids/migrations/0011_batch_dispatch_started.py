@@ -0,0 +1,17 @@
+# Generated by Django 4.2 on 2026-10-17 06:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("mids", "0010_batch_item_counts"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="batch",
+            name="dispatch_started",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -3,11 +3,34 @@ from django.db import models
 # from django.contrib import auth
 
 
+class BatchDispatchStatus(models.IntegerChoices):
+    NOT_DISPATCHED = 1, "Not dispatched"
+    PENDING = 2, "Pending"
+    DISPATCHING = 3, "Dispatching"
+    DISPATCHED = 4, "Dispatched"
+    FAILED = 5, "Failed"
+
+
 class Batch(models.Model):
     file_name = models.CharField(max_length=250, help_text="The name of the uploaded file")
     time_uploaded = models.DateTimeField(auto_now_add=True)
     sender_name = models.CharField(max_length=50, blank=True)
     date_sent = models.DateTimeField(null=True, blank=True)
+    dispatch_status = models.IntegerField(
+        choices=BatchDispatchStatus.choices, default=BatchDispatchStatus.NOT_DISPATCHED
+    )
+    items_to_dispatch = models.IntegerField(default=0, help_text="PENDING items when the dispatch started")
+    items_dispatched = models.IntegerField(default=0, help_text="Items queued so far by the dispatch")
+    dispatch_started = models.DateTimeField(null=True, blank=True)
+    force_send = models.BooleanField(
+        default=False, help_text="Send every item, even to MIDs already registered as the item asks"
+    )
+    urgent = models.BooleanField(default=False, help_text="Queue items ahead of other batches")
+    total_items = models.IntegerField(default=0)
+    pending_items = models.IntegerField(default=0)
+    queued_items = models.IntegerField(default=0, help_text="Items queued or being sent")
+    done_items = models.IntegerField(default=0)
+    error_items = models.IntegerField(default=0)
 
     class Meta:
         verbose_name_plural = "Batches"
@@ -24,6 +47,10 @@ class BatchItemStatus(models.IntegerChoices):
     QUEUED = 2, "Queued"
     DONE = 3, "Done"
     ERROR = 4, "Error"
+    IN_FLIGHT = 5, "In flight"
+    SKIPPED = 6, "Skipped"
+    DEAD_LETTER = 7, "Dead letter"
+    SUPERSEDED = 8, "Superseded"
 
 
 class BatchItem(models.Model):
@@ -42,6 +69,55 @@ class BatchItem(models.Model):
     error_description = models.CharField(max_length=100, blank=True)
     request_timestamp = models.DateTimeField(null=True, blank=True)
     response = models.JSONField(null=True, blank=True)  # type:ignore
+    claimed_at = models.DateTimeField(null=True, blank=True, help_text="When a worker started sending the item")
+    attempts = models.IntegerField(default=0, help_text="Failed attempts to send the item")
+    retry_at = models.DateTimeField(null=True, blank=True, help_text="When the item will be sent again after a failure")
 
     class Meta:
         ordering = ["id"]
+        indexes = [models.Index(fields=["status", "claimed_at"], name="mids_batchitem_claimed_idx")]
+
+
+class MerchantRegistration(models.Model):
+    """
+    The last action Amex accepted for each MID, so that items asking for what is already in place can be skipped.
+    """
+
+    mid = models.CharField(max_length=50)
+    provider_slug = models.CharField(max_length=50)
+    merchant_slug = models.CharField(max_length=50)
+    action = models.CharField(choices=BatchItemAction.choices, max_length=1)
+    start_date = models.DateField(null=True, blank=True)
+    end_date = models.DateField(null=True, blank=True)
+    last_item = models.ForeignKey(BatchItem, null=True, blank=True, on_delete=models.SET_NULL)
+    last_success = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ["mid"]
+        constraints = [
+            models.UniqueConstraint(fields=["mid", "provider_slug"], name="mids_registration_mid_provider_uniq")
+        ]
+
+    @classmethod
+    def from_item(cls, item: BatchItem) -> "MerchantRegistration":
+        return cls(
+            mid=item.mid,
+            provider_slug=item.provider_slug,
+            merchant_slug=item.merchant_slug,
+            action=item.action,
+            start_date=item.start_date,
+            end_date=item.end_date,
+            last_item=item,
+            last_success=item.request_timestamp,
+        )
+
+    def matches(self, item: BatchItem) -> bool:
+        """
+        Whether sending the item would ask Amex for the registration already in place.
+        """
+        return (self.merchant_slug, self.action, self.start_date, self.end_date) == (
+            item.merchant_slug,
+            item.action,
+            item.start_date,
+            item.end_date,
+        )
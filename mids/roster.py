@@ -0,0 +1,177 @@
+import json
+import secrets
+import typing as t
+import zlib
+from datetime import date, datetime
+
+from django.conf import settings
+from redis import Redis
+
+from mids.models import BatchItemAction, MerchantRegistration
+
+# (mid, provider_slug)
+Key = t.Tuple[str, str]
+# (merchant_slug, start_date, end_date)
+Registration = t.Tuple[str, t.Optional[date], t.Optional[date]]
+
+
+class RosterRow(t.TypedDict):
+    mid: str
+    start_date: t.Optional[date]
+    end_date: t.Optional[date]
+    merchant_slug: str
+    provider_slug: str
+    action: str
+
+
+class RosterDiff:
+    """
+    The ADD and DELETE items that bring the registered MIDs of each merchant in a full roster into line with it.
+
+    Both sides are held as hash maps keyed on (mid, provider_slug), so the comparison is linear in the size of the
+    roster and of the merchants' current registrations. MIDs whose registration already matches the roster are left
+    out, as are merchants that are not in the roster at all. Keys listed more than once are kept in `duplicates`.
+    """
+
+    def __init__(self, rows: t.Iterable[t.Mapping[str, t.Any]]) -> None:
+        self.roster: t.Dict[Key, Registration] = {}
+        self.duplicates: t.List[Key] = []
+        for row in rows:
+            key = (row["mid"], row["provider_slug"])
+            if key in self.roster:
+                self.duplicates.append(key)
+            self.roster[key] = (
+                row["merchant_slug"],
+                _as_date(row["start_date"]),
+                _as_date(row["end_date"]),
+            )
+        self.merchants = {(merchant_slug, key[1]) for key, (merchant_slug, _, _) in self.roster.items()}
+        self.registered = self._registered()
+
+        self.adds = [key for key, registration in self.roster.items() if self.registered.get(key) != registration]
+        self.deletes = [
+            key
+            for key, (merchant_slug, _, _) in self.registered.items()
+            if key not in self.roster and (merchant_slug, key[1]) in self.merchants
+        ]
+
+    def _registered(self) -> t.Dict[Key, Registration]:
+        registrations = (
+            MerchantRegistration.objects.filter(
+                action=BatchItemAction.ADD,
+                merchant_slug__in={merchant_slug for merchant_slug, _ in self.merchants},
+            )
+            .values_list("mid", "provider_slug", "merchant_slug", "start_date", "end_date")
+            .iterator(chunk_size=10000)
+        )
+        return {
+            (mid, provider_slug): (merchant_slug, start, end)
+            for mid, provider_slug, merchant_slug, start, end in registrations
+        }
+
+    def summary(self) -> t.List[t.Dict[str, t.Any]]:
+        """
+        Counts of roster MIDs, adds, deletes and unchanged MIDs for each merchant and provider in the roster.
+        """
+        counts = {merchant: {"roster": 0, "adds": 0, "deletes": 0} for merchant in self.merchants}
+        for key, (merchant_slug, _, _) in self.roster.items():
+            counts[(merchant_slug, key[1])]["roster"] += 1
+        for key in self.adds:
+            counts[(self.roster[key][0], key[1])]["adds"] += 1
+        for key in self.deletes:
+            counts[(self.registered[key][0], key[1])]["deletes"] += 1
+        return [
+            {
+                "merchant_slug": merchant_slug,
+                "provider_slug": provider_slug,
+                "unchanged": count["roster"] - count["adds"],
+                **count,
+            }
+            for (merchant_slug, provider_slug), count in sorted(counts.items())
+        ]
+
+    def rows(self) -> t.Iterator[RosterRow]:
+        for key in self.adds:
+            merchant_slug, start, end = self.roster[key]
+            yield RosterRow(
+                mid=key[0],
+                start_date=start,
+                end_date=end,
+                merchant_slug=merchant_slug,
+                provider_slug=key[1],
+                action=BatchItemAction.ADD,
+            )
+        for key in self.deletes:
+            yield RosterRow(
+                mid=key[0],
+                start_date=None,
+                end_date=None,
+                merchant_slug=self.registered[key][0],
+                provider_slug=key[1],
+                action=BatchItemAction.DELETE,
+            )
+
+
+def _as_date(value: t.Union[date, datetime, None]) -> t.Optional[date]:
+    return value.date() if isinstance(value, datetime) else value
+
+
+def _key(token: str) -> str:
+    return f"eos:roster:{token}"
+
+
+def stash(redis: Redis, file_name: str, rows: t.Iterable[RosterRow]) -> str:
+    """
+    Keep the rows of a previewed roster diff in redis for ROSTER_PREVIEW_TTL seconds. Returns the token to import
+    them with.
+    """
+    data = {
+        "file_name": file_name,
+        "rows": [
+            [
+                row["mid"],
+                _iso(row["start_date"]),
+                _iso(row["end_date"]),
+                row["merchant_slug"],
+                row["provider_slug"],
+                row["action"],
+            ]
+            for row in rows
+        ],
+    }
+    token = secrets.token_urlsafe(16)
+    redis.set(_key(token), zlib.compress(json.dumps(data).encode()), ex=settings.ROSTER_PREVIEW_TTL)
+    return token
+
+
+def unstash(redis: Redis, token: str) -> t.Optional[t.Tuple[str, t.List[RosterRow]]]:
+    """
+    Take the file name and rows stashed under `token`, or None if they have expired or were already taken.
+    """
+    with redis.pipeline() as pipe:
+        pipe.get(_key(token))
+        pipe.delete(_key(token))
+        value, _ = pipe.execute()
+    if value is None:
+        return None
+    data = json.loads(zlib.decompress(value))
+    rows = [
+        RosterRow(
+            mid=mid,
+            start_date=_from_iso(start),
+            end_date=_from_iso(end),
+            merchant_slug=merchant_slug,
+            provider_slug=provider_slug,
+            action=action,
+        )
+        for mid, start, end, merchant_slug, provider_slug, action in data["rows"]
+    ]
+    return data["file_name"], rows
+
+
+def _iso(value: t.Optional[date]) -> t.Optional[str]:
+    return value.isoformat() if value is not None else None
+
+
+def _from_iso(value: t.Optional[str]) -> t.Optional[date]:
+    return date.fromisoformat(value) if value is not None else None
@@ -0,0 +1,35 @@
+import typing as t
+from datetime import date
+
+from mids.models import Batch, BatchItem, BatchItemAction, BatchItemStatus
+
+
+class MockResponse:
+    def __init__(self, json: dict, status_code: int = 200) -> None:
+        self._json = json
+        self.status_code = status_code
+
+    def json(self) -> dict:
+        return self._json
+
+
+def make_items(batch: Batch, count: int, status: int = BatchItemStatus.PENDING) -> t.List[BatchItem]:
+    return BatchItem.objects.bulk_create(
+        BatchItem(
+            batch=batch,
+            mid=str(mid),
+            start_date=date(2021, 2, 15),
+            end_date=date(2021, 2, 16),
+            merchant_slug="wasabi-club",
+            provider_slug="amex",
+            action=BatchItemAction.ADD,
+            status=status,
+        )
+        for mid in range(count)
+    )
+
+
+def make_batch(file_name: str, size: int) -> Batch:
+    batch = Batch.objects.create(file_name=file_name, total_items=size, pending_items=size)
+    make_items(batch, size)
+    return batch
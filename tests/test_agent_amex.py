@@ -1,12 +1,19 @@
+import asyncio
+import itertools
 import json
+import ssl
+import threading
 import uuid
 from datetime import date, timedelta
 from unittest import mock
 
 import responses
 from django.test import TestCase, override_settings
+from requests.adapters import HTTPAdapter
 
-from eos.agents.amex import BASE_URI, MerchantRegApi
+from eos.agents.amex import BASE_URI, AsyncMerchantRegApi, MerchantRegApi, SecretCache, make_ssl_context
+
+from .certs import make_self_signed_cert
 
 AMEX_API_HOST = "http://localhost"
 AMEX_CLIENT_SECRET = "shhhhhh"
@@ -116,3 +123,115 @@ class TestAmexAgent(TestCase):
                 "partnerMerchantRefId": "wasabi-club",
             },
         )
+
+    @responses.activate
+    def test_rejected_credentials_invalidate_secret_cache(self) -> None:
+        responses.add(responses.DELETE, AMEX_API_HOST + BASE_URI + f"/{self.mid}", status=401)
+        self.amex.circuit_breaker = mock.Mock()
+        self.amex.circuit_breaker.before_call.return_value = None
+        with mock.patch("eos.agents.amex.secret_cache") as mock_cache:
+            mock_cache.get.return_value = None
+            self.amex.delete_merchant(self.mid, "wasabi-club")
+        mock_cache.invalidate.assert_called_once_with()
+        self.amex.circuit_breaker.record.assert_called_once_with(True, None)
+
+    def test_no_adapter_retries_under_rate_limit(self) -> None:
+        for agent, total in ((self.amex, 3), (MerchantRegApi(rate_limiter=mock.Mock()), 0)):
+            adapter = agent.session.get_adapter(AMEX_API_HOST)
+            assert isinstance(adapter, HTTPAdapter)
+            self.assertEqual(total, adapter.max_retries.total)
+
+    def test_load_cert_from_vault_builds_ssl_context(self) -> None:
+        key, cert = make_self_signed_cert()
+        with mock.patch.object(MerchantRegApi, "connect_to_vault") as mock_vault, mock.patch(
+            "eos.agents.amex.secret_cache", new=SecretCache(ttl=60, refresh_margin=0)
+        ):
+            mock_vault.return_value.get_secret.return_value.value = json.dumps({"key": key, "cert": cert})
+            ssl_context = self.amex.load_cert_from_vault()
+            self.assertIs(ssl_context, self.amex.load_cert_from_vault())
+        self.assertIsInstance(ssl_context, ssl.SSLContext)
+        mock_vault.assert_called_once_with()
+
+    @responses.activate
+    def test_ssl_context_is_mounted_once(self) -> None:
+        responses.add(responses.DELETE, AMEX_API_HOST + BASE_URI + f"/{self.mid}", json={}, status=200)
+        ssl_context = make_ssl_context(*make_self_signed_cert())
+        with mock.patch.object(MerchantRegApi, "load_cert_from_vault", return_value=ssl_context):
+            self.amex.delete_merchant(self.mid, "wasabi-club")
+            adapter = self.amex.session.get_adapter(AMEX_API_HOST)
+            self.amex.delete_merchant(self.mid, "wasabi-club")
+        self.assertIs(adapter, self.amex.session.get_adapter(AMEX_API_HOST))
+        self.assertIs(ssl_context, adapter.poolmanager.connection_pool_kw["ssl_context"])  # type: ignore
+
+
+class TestSecretCache(TestCase):
+    def test_get_caches_value(self) -> None:
+        cache = SecretCache(ttl=60, refresh_margin=10)
+        loader = mock.Mock(return_value="secret")
+        self.assertEqual("secret", cache.get("key", loader))
+        self.assertEqual("secret", cache.get("key", loader))
+        loader.assert_called_once_with()
+
+    def test_invalidate(self) -> None:
+        cache = SecretCache(ttl=60, refresh_margin=10)
+        loader = mock.Mock(side_effect=["old", "new"])
+        self.assertEqual("old", cache.get("key", loader))
+        cache.invalidate()
+        self.assertEqual("new", cache.get("key", loader))
+
+    def test_expired_value_is_reloaded(self) -> None:
+        cache = SecretCache(ttl=0, refresh_margin=0)
+        loader = mock.Mock(side_effect=["old", "new"])
+        self.assertEqual("old", cache.get("key", loader))
+        self.assertEqual("new", cache.get("key", loader))
+
+    def test_refresh_in_background_before_expiry(self) -> None:
+        cache = SecretCache(ttl=60, refresh_margin=60)
+        loader = mock.Mock(side_effect=itertools.chain(["old"], itertools.repeat("new")))
+        self.assertEqual("old", cache.get("key", loader))
+        # stale but not expired: the cached value is served while a refresh happens in the background
+        self.assertEqual("old", cache.get("key", loader))
+        for thread in threading.enumerate():
+            if thread.name == "secret-refresh-key":
+                thread.join(5)
+        self.assertEqual("new", cache.get("key", loader))
+
+
+class TestAsyncAmexAgent(TestCase):
+    @mock.patch("uuid.uuid4", new=lambda: uuid.UUID("{12345678-1234-5678-1234-567812345678}"))
+    @mock.patch("time.time", new=lambda: 1613218482.810827)
+    @override_settings(AMEX_API_HOST=AMEX_API_HOST, AMEX_CLIENT_ID=AMEX_CLIENT_ID, AMEX_CLIENT_SECRET="shhhhhh")
+    @responses.activate
+    def test_delete_merchant_signed_like_sync_agent(self) -> None:
+        responses.add(responses.DELETE, AMEX_API_HOST + BASE_URI + "/4548436161", json={}, status=200)
+        api = MerchantRegApi()
+        amex = AsyncMerchantRegApi(api, max_in_flight=2)
+        self.addCleanup(amex.close)
+        with mock.patch.object(MerchantRegApi, "load_cert_from_vault", return_value=None):
+            response, _ = asyncio.run(amex.delete_merchant("4548436161", "wasabi-club"))
+        payload = response.request.body
+        expected = api._make_headers("DELETE", BASE_URI + "/4548436161", payload)  # type: ignore
+        self.assertEqual(expected["Authorization"], response.request.headers["Authorization"])
+
+    def test_in_flight_calls_are_bounded(self) -> None:
+        in_flight = peak = 0
+        lock = threading.Lock()
+
+        def delete_merchant(mid: str, merchant_slug: str) -> None:
+            nonlocal in_flight, peak
+            with lock:
+                in_flight += 1
+                peak = max(peak, in_flight)
+            threading.Event().wait(0.05)
+            with lock:
+                in_flight -= 1
+
+        api = mock.Mock(delete_merchant=delete_merchant)
+        amex = AsyncMerchantRegApi(api, max_in_flight=3)
+        self.addCleanup(amex.close)
+
+        async def main() -> None:
+            await asyncio.gather(*(amex.delete_merchant(str(mid), "wasabi-club") for mid in range(10)))
+
+        asyncio.run(main())
+        self.assertEqual(3, peak)
@@ -0,0 +1,55 @@
+import threading
+from datetime import date
+
+from django.test import SimpleTestCase, override_settings
+
+from eos.agents.amex import MerchantRegApi
+from eos.agents.amex_simulator import AmexSimulator, load_config
+
+
+class TestAmexSimulator(SimpleTestCase):
+    def start(self, **overrides: dict) -> MerchantRegApi:
+        config = load_config()
+        config["latency"]["median"] = 0.001
+        config.update(overrides)
+        self.server = AmexSimulator(("127.0.0.1", 0), config)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        settings = override_settings(
+            AMEX_API_HOST=f"http://127.0.0.1:{self.server.server_port}",
+            AMEX_CLIENT_ID=config["client_id"],
+            AMEX_CLIENT_SECRET=config["client_secret"],
+            AMEX_MTLS=False,
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+        return MerchantRegApi()
+
+    def add(self, api: MerchantRegApi) -> int:
+        response, _ = api.add_merchant("4548436161", "wasabi-club", date(2021, 2, 15), date(2021, 2, 16))
+        return response.status_code
+
+    def test_signed_calls_succeed(self) -> None:
+        api = self.start(errors={})
+        self.assertEqual(200, self.add(api))
+        response, _ = api.delete_merchant("4548436161", "wasabi-club")
+        self.assertEqual(200, response.status_code)
+        self.assertEqual({200: 2}, self.server.stats()["statuses"])
+
+    def test_bad_signature_rejected(self) -> None:
+        api = self.start(errors={})
+        with override_settings(AMEX_CLIENT_SECRET="wrong"):
+            self.assertEqual(401, self.add(api))
+        self.assertEqual({401: 1}, self.server.stats()["statuses"])
+
+    def test_throttled_beyond_burst(self) -> None:
+        api = self.start(errors={}, throttle={"rate": 0.001, "burst": 2})
+        self.assertEqual([200, 200, 429], [self.add(api) for _ in range(3)])
+
+    def test_error_mix(self) -> None:
+        api = self.start(errors={"400": 1.0})
+        response, _ = api.add_merchant("4548436161", "wasabi-club", date(2021, 2, 15), date(2021, 2, 16))
+        self.assertEqual(400, response.status_code)
+        self.assertEqual("400.01", response.json()["error_code"])
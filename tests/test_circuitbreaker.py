@@ -0,0 +1,82 @@
+from django.test import SimpleTestCase
+
+from eos.circuitbreaker import CircuitBreaker, CircuitOpen
+from eos.tasks import redis
+
+
+class TestCircuitBreaker(SimpleTestCase):
+    def setUp(self) -> None:
+        self.breaker = CircuitBreaker(redis, "test", failure_rate=0.5, min_calls=4, window=60, reset_timeout=30)
+        self.addCleanup(self._clear)
+        self._clear()
+
+    def _clear(self) -> None:
+        keys = redis.keys("eos:circuit:test:*")
+        if keys:
+            redis.delete(*keys)
+
+    def _half_open(self) -> None:
+        for _ in range(4):
+            self.breaker.record(failed=True)
+        redis.delete(self.breaker.open_key)
+
+    def test_stays_closed_below_min_calls(self) -> None:
+        for _ in range(3):
+            self.breaker.record(failed=True)
+        self.breaker.before_call()
+
+    def test_opens_at_failure_rate(self) -> None:
+        for failed in (False, True, False, True):
+            self.breaker.record(failed)
+        with self.assertRaises(CircuitOpen) as ctx:
+            self.breaker.before_call()
+        self.assertGreater(ctx.exception.retry_after, 0)
+        self.assertLessEqual(ctx.exception.retry_after, 30)
+
+    def test_breakers_share_state(self) -> None:
+        for _ in range(4):
+            self.breaker.record(failed=True)
+        other = CircuitBreaker(redis, "test", failure_rate=0.5, min_calls=4, window=60, reset_timeout=30)
+        with self.assertRaises(CircuitOpen):
+            other.before_call()
+
+    def test_half_open_allows_single_probe(self) -> None:
+        self._half_open()
+        self.breaker.before_call()
+        with self.assertRaises(CircuitOpen):
+            self.breaker.before_call()
+
+    def test_probe_success_closes(self) -> None:
+        self._half_open()
+        probe = self.breaker.before_call()
+        self.assertIsNotNone(probe)
+        self.breaker.record(failed=False, probe=probe)
+        self.assertIsNone(self.breaker.before_call())
+        self.breaker.before_call()
+
+    def test_probe_failure_reopens(self) -> None:
+        self._half_open()
+        probe = self.breaker.before_call()
+        self.breaker.record(failed=True, probe=probe)
+        with self.assertRaises(CircuitOpen):
+            self.breaker.before_call()
+        self.assertGreater(redis.pttl(self.breaker.open_key), 0)
+
+    def test_only_probe_outcome_settles_half_open(self) -> None:
+        self._half_open()
+        probe = self.breaker.before_call()
+        # a call that was in flight before the circuit tripped finishes during the probe
+        self.breaker.record(failed=False)
+        with self.assertRaises(CircuitOpen):
+            self.breaker.before_call()
+        self.breaker.record(failed=True, probe=probe)
+        self.assertGreater(redis.pttl(self.breaker.open_key), 0)
+
+    def test_expired_probe_is_ignored(self) -> None:
+        self._half_open()
+        stale = self.breaker.before_call()
+        redis.delete(self.breaker.probe_key)
+        probe = self.breaker.before_call()
+        self.breaker.record(failed=True, probe=stale)
+        self.breaker.record(failed=False, probe=probe)
+        self.assertFalse(redis.exists(self.breaker.tripped_key))
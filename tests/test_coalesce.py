@@ -0,0 +1,102 @@
+import typing as t
+from datetime import date
+from unittest import mock
+
+from django.test import TestCase, override_settings
+
+from eos import tasks
+from mids.models import Batch, BatchItem, BatchItemAction, BatchItemStatus, MerchantRegistration
+
+
+@override_settings(DISPATCH_MODE=tasks.DISPATCH_MODE_QUEUE, DISPATCH_COALESCE=True)
+class TestCoalesce(TestCase):
+    def make_item(self, batch: Batch, action: str, status: int = BatchItemStatus.PENDING, **kwargs: t.Any) -> BatchItem:
+        fields = {
+            "mid": "123456789",
+            "start_date": date(2021, 2, 15),
+            "end_date": date(2021, 2, 16),
+            "merchant_slug": "wasabi-club",
+            "provider_slug": "amex",
+            **kwargs,
+        }
+        return BatchItem.objects.create(batch=batch, action=action, status=status, **fields)
+
+    def dispatch(self, batch: Batch) -> t.List[int]:
+        with mock.patch.object(tasks.task_queue, "enqueue_many") as enqueue_many:
+            tasks.dispatch_batch(batch.id)
+        batch.refresh_from_db()
+        self.assertEqual(batch.items_to_dispatch, batch.items_dispatched)
+        return [item_id for call in enqueue_many.call_args_list for job in call.args[0] for item_id in job.args[0]]
+
+    def statuses(self, *items: BatchItem) -> t.List[int]:
+        return [BatchItem.objects.get(id=item.id).status for item in items]
+
+    def test_duplicates_merge(self) -> None:
+        first = self.make_item(Batch.objects.create(file_name="first.csv"), BatchItemAction.ADD, BatchItemStatus.QUEUED)
+        batch = Batch.objects.create(file_name="second.csv")
+        again = self.make_item(batch, BatchItemAction.ADD)
+        other = self.make_item(batch, BatchItemAction.ADD, mid="987654321")
+
+        self.assertEqual([other.id], self.dispatch(batch))
+        self.assertEqual(
+            [BatchItemStatus.QUEUED, BatchItemStatus.SUPERSEDED, BatchItemStatus.QUEUED],
+            self.statuses(first, again, other),
+        )
+
+    def test_add_then_delete_cancels_out(self) -> None:
+        add = self.make_item(Batch.objects.create(file_name="first.csv"), BatchItemAction.ADD, BatchItemStatus.QUEUED)
+        batch = Batch.objects.create(file_name="second.csv")
+        delete = self.make_item(batch, BatchItemAction.DELETE, start_date=None, end_date=None)
+
+        self.assertEqual([], self.dispatch(batch))
+        self.assertEqual([BatchItemStatus.SUPERSEDED] * 2, self.statuses(add, delete))
+
+    def test_add_then_delete_in_one_batch(self) -> None:
+        batch = Batch.objects.create(file_name="mids.csv")
+        add = self.make_item(batch, BatchItemAction.ADD)
+        delete = self.make_item(batch, BatchItemAction.DELETE, start_date=None, end_date=None)
+        add_again = self.make_item(batch, BatchItemAction.ADD, end_date=date(2021, 3, 1))
+
+        self.assertEqual([add_again.id], self.dispatch(batch))
+        self.assertEqual(
+            [BatchItemStatus.SUPERSEDED, BatchItemStatus.SUPERSEDED, BatchItemStatus.QUEUED],
+            self.statuses(add, delete, add_again),
+        )
+
+    def test_delete_kept_for_registered_mid(self) -> None:
+        add = self.make_item(Batch.objects.create(file_name="first.csv"), BatchItemAction.ADD, BatchItemStatus.QUEUED)
+        MerchantRegistration.objects.create(
+            mid=add.mid, provider_slug=add.provider_slug, merchant_slug=add.merchant_slug, action=BatchItemAction.ADD
+        )
+        batch = Batch.objects.create(file_name="second.csv")
+        delete = self.make_item(batch, BatchItemAction.DELETE, start_date=None, end_date=None)
+
+        self.assertEqual([delete.id], self.dispatch(batch))
+        self.assertEqual([BatchItemStatus.SUPERSEDED, BatchItemStatus.QUEUED], self.statuses(add, delete))
+
+    def test_items_already_tried_are_left_alone(self) -> None:
+        first = Batch.objects.create(file_name="first.csv")
+        tried = self.make_item(first, BatchItemAction.ADD, BatchItemStatus.QUEUED, attempts=1)
+        in_flight = self.make_item(first, BatchItemAction.ADD, BatchItemStatus.IN_FLIGHT, mid="987654321")
+        batch = Batch.objects.create(file_name="second.csv")
+        delete = self.make_item(batch, BatchItemAction.DELETE, start_date=None, end_date=None)
+        again = self.make_item(batch, BatchItemAction.ADD, mid="987654321")
+
+        self.assertEqual([delete.id, again.id], self.dispatch(batch))
+        self.assertEqual([BatchItemStatus.QUEUED] * 2, self.statuses(tried, delete))
+        self.assertEqual(BatchItemStatus.IN_FLIGHT, self.statuses(in_flight)[0])
+
+    def test_force_send_batch_is_left_alone(self) -> None:
+        first = self.make_item(Batch.objects.create(file_name="first.csv"), BatchItemAction.ADD, BatchItemStatus.QUEUED)
+        batch = Batch.objects.create(file_name="second.csv", force_send=True)
+        again = self.make_item(batch, BatchItemAction.ADD)
+
+        self.assertEqual([again.id], self.dispatch(batch))
+        self.assertEqual([BatchItemStatus.QUEUED] * 2, self.statuses(first, again))
+
+    @override_settings(DISPATCH_COALESCE=False)
+    def test_disabled(self) -> None:
+        batch = Batch.objects.create(file_name="mids.csv")
+        items = [self.make_item(batch, BatchItemAction.ADD), self.make_item(batch, BatchItemAction.ADD)]
+
+        self.assertEqual([item.id for item in items], self.dispatch(batch))
@@ -0,0 +1,79 @@
+import threading
+
+from django.core.management import CommandError, call_command
+from django.test import SimpleTestCase, override_settings
+
+from eos import concurrency, tasks, timing
+from eos.concurrency import AdaptiveConcurrency
+
+
+class TestAdaptiveConcurrency(SimpleTestCase):
+    def setUp(self) -> None:
+        self.concurrency = AdaptiveConcurrency(minimum=2, maximum=8, latency_target=1.0, error_threshold=0.1)
+
+    def run_window(self, latency: float = 0.1, failures: int = 0) -> None:
+        for n in range(self.concurrency.window):
+            self.concurrency.acquire()
+            self.concurrency.release(latency, failed=n < failures)
+
+    def test_limit_grows_while_healthy(self) -> None:
+        self.run_window()
+        self.run_window()
+        self.assertEqual(4, self.concurrency.limit)
+        self.assertIn("healthy", self.concurrency.reason)
+
+    def test_limit_cut_on_errors(self) -> None:
+        self.concurrency.limit = 8
+        self.run_window(failures=5)
+        self.assertEqual(4, self.concurrency.limit)
+        self.assertIn("error rate 25%", self.concurrency.reason)
+
+    def test_limit_cut_on_latency(self) -> None:
+        self.concurrency.limit = 8
+        self.run_window(latency=1.5)
+        self.assertEqual(4, self.concurrency.limit)
+        self.assertIn("p95 latency 1.50s", self.concurrency.reason)
+
+    def test_limit_stays_within_bounds(self) -> None:
+        self.run_window(failures=20)
+        self.assertEqual(2, self.concurrency.limit)
+        for _ in range(10):
+            self.run_window()
+        self.assertEqual(8, self.concurrency.limit)
+
+    def test_acquire_blocks_at_limit(self) -> None:
+        self.concurrency.acquire()
+        self.concurrency.acquire()
+        acquired = threading.Event()
+
+        def acquire() -> None:
+            self.concurrency.acquire()
+            acquired.set()
+
+        thread = threading.Thread(target=acquire)
+        thread.start()
+        self.assertFalse(acquired.wait(0.1))
+        self.concurrency.release(0.1, failed=False)
+        self.assertTrue(acquired.wait(1))
+        thread.join()
+
+    def test_slot_counts_exceptions_as_failures(self) -> None:
+        with self.assertRaises(ValueError), self.concurrency.slot(lambda: 0.0):
+            raise ValueError
+        self.assertEqual(0, self.concurrency.in_flight)
+        self.assertEqual(1, self.concurrency._failures)
+
+    def test_limit_published_after_each_window(self) -> None:
+        self.concurrency.redis = tasks.redis
+        key = concurrency.stats_key(timing.worker_name())
+        self.addCleanup(tasks.redis.delete, key)
+        self.run_window()
+
+        stats = concurrency.published(tasks.redis)[timing.worker_name()]
+        self.assertEqual(("3", "0"), (stats["limit"], stats["in_flight"]))
+        self.assertGreater(tasks.redis.ttl(key), 0)
+
+    @override_settings(AMEX_ADAPTIVE_CONCURRENCY=True)
+    def test_worker_without_threads_rejected(self) -> None:
+        with self.assertRaisesMessage(CommandError, "needs --threads above 1"):
+            call_command("worker", "--burst", "--threads", "1")
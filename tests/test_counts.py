@@ -0,0 +1,120 @@
+from io import StringIO
+from unittest import mock
+
+import requests
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import DatabaseError, connection, transaction
+from django.test import Client, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from eos import counts, tasks
+from mids.models import Batch, BatchItem, BatchItemStatus
+
+from .helpers import MockResponse, make_batch
+
+
+@override_settings(DISPATCH_MODE=tasks.DISPATCH_MODE_QUEUE, RESULT_BUFFER_SIZE=1)
+class TestBatchCounts(TestCase):
+    def assertCounted(self, batch: Batch, **expected: int) -> None:
+        batch.refresh_from_db()
+        self.assertEqual(expected, {field: getattr(batch, field) for field in counts.FIELDS if getattr(batch, field)})
+        self.assertEqual(
+            counts.counted([batch.id])[batch.id], {field: getattr(batch, field) for field in counts.FIELDS}
+        )
+
+    def test_counts_follow_items(self) -> None:
+        batch = make_batch("mids.csv", 4)
+        self.assertCounted(batch, total_items=4, pending_items=4)
+
+        with mock.patch.object(tasks.task_queue, "enqueue_many"), self.captureOnCommitCallbacks(execute=True):
+            tasks.dispatch_batch(batch.id)
+        self.assertCounted(batch, total_items=4, queued_items=4)
+
+        with mock.patch("eos.tasks.amex_agent") as mock_amex_agent:
+            error = {"error_code": "Inv_Req", "error_type": "Bad", "error_description": "Merchant is not valid"}
+            mock_amex_agent.return_value.add_merchant.side_effect = [
+                (MockResponse({}), timezone.now()),
+                (MockResponse({}), timezone.now()),
+                requests.ConnectionError,
+                (MockResponse(error), timezone.now()),
+            ]
+            with override_settings(ITEM_MAX_ATTEMPTS=1), self.captureOnCommitCallbacks(execute=True):
+                tasks.process_items(list(batch.batchitem_set.values_list("id", flat=True)))
+        self.assertCounted(batch, total_items=4, done_items=2)
+
+        dead_letters = batch.batchitem_set.filter(status=BatchItemStatus.DEAD_LETTER)
+        with self.captureOnCommitCallbacks(execute=True):
+            tasks.redrive_items(list(dead_letters.values_list("id", flat=True)))
+        self.assertCounted(batch, total_items=4, queued_items=2, done_items=2)
+
+    def test_counts_left_alone_on_rollback(self) -> None:
+        batch = make_batch("mids.csv", 1)
+        with self.captureOnCommitCallbacks(execute=True), self.assertRaises(DatabaseError), transaction.atomic():
+            counts.move([(batch.id, BatchItemStatus.PENDING, BatchItemStatus.QUEUED)])
+            raise DatabaseError
+        self.assertCounted(batch, total_items=1, pending_items=1)
+
+    def test_batches_updated_in_id_order(self) -> None:
+        first, second = make_batch("first.csv", 1), make_batch("second.csv", 1)
+        with CaptureQueriesContext(connection) as queries, self.captureOnCommitCallbacks(execute=True):
+            counts.move(
+                [
+                    (second.id, BatchItemStatus.PENDING, BatchItemStatus.QUEUED),
+                    (first.id, BatchItemStatus.PENDING, BatchItemStatus.QUEUED),
+                ]
+            )
+        self.assertEqual(
+            [f'"mids_batch"."id" = {first.id}', f'"mids_batch"."id" = {second.id}'],
+            [query["sql"].rpartition("WHERE ")[2] for query in queries],
+        )
+
+    def test_reconcile_command(self) -> None:
+        batch = make_batch("mids.csv", 3)
+        untouched = make_batch("other.csv", 2)
+        BatchItem.objects.filter(batch=batch, mid="0").update(status=BatchItemStatus.DONE)
+        Batch.objects.create(file_name="empty.csv", total_items=1, error_items=1)
+
+        out = StringIO()
+        call_command("reconcile_batch_counts", stdout=out)
+        self.assertEqual("Corrected the counts of 2 batches\n", out.getvalue())
+        self.assertCounted(batch, total_items=3, pending_items=2, done_items=1)
+        self.assertCounted(untouched, total_items=2, pending_items=2)
+        self.assertFalse(Batch.objects.filter(file_name="empty.csv", total_items__gt=0).exists())
+
+    def test_items_deleted_from_the_admin_leave_the_counts(self) -> None:
+        User.objects.create_superuser("admin", "admin@bink.com", "!Potato12345!")
+        client = Client()
+        client.login(username="admin", password="!Potato12345!")
+        batch = make_batch("mids.csv", 3)
+        first, second, third = batch.batchitem_set.all()
+        BatchItem.objects.filter(id=first.id).update(status=BatchItemStatus.DONE)
+        counts.reconcile([batch.id])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            client.post(reverse("admin:mids_batchitem_delete", args=[third.id]), {"post": "yes"})
+            client.post(
+                reverse("admin:mids_batchitem_changelist"),
+                {"action": "delete_selected", "_selected_action": [first.id], "post": "yes"},
+            )
+        self.assertEqual([second.id], list(batch.batchitem_set.values_list("id", flat=True)))
+        self.assertCounted(batch, total_items=1, pending_items=1)
+
+    def test_changelist_queries_do_not_grow_with_batches(self) -> None:
+        User.objects.create_superuser("admin", "admin@bink.com", "!Potato12345!")
+        client = Client()
+        client.login(username="admin", password="!Potato12345!")
+
+        def changelist_queries() -> int:
+            with CaptureQueriesContext(connection) as queries:
+                response = client.get(reverse("admin:mids_batch_changelist"))
+            self.assertEqual(200, response.status_code)
+            return len(queries)
+
+        make_batch("first.csv", 2)
+        expected = changelist_queries()
+        for n in range(5):
+            make_batch(f"batch-{n}.csv", 2)
+        self.assertEqual(expected, changelist_queries())
@@ -1,13 +1,17 @@
-from datetime import date
+from datetime import date, timedelta
+from unittest import mock
 
 from django.contrib.auth.models import User
 from django.core.files.uploadedfile import SimpleUploadedFile
 from django.http.response import HttpResponse
 from django.test import Client, TestCase
 from django.urls import reverse
+from django.utils import timezone
+from redis.exceptions import RedisError
 
-from eos.tasks import task_queue
-from mids.models import Batch, BatchItem, BatchItemAction, BatchItemStatus
+from eos import tasks
+from eos.tasks import dispatch_batch, task_queue, urgent_queue
+from mids.models import Batch, BatchDispatchStatus, BatchItem, BatchItemAction, BatchItemStatus, MerchantRegistration
 
 
 class TestMidsAdmin(TestCase):
@@ -109,6 +113,99 @@ class TestMidsAdmin(TestCase):
         response = self.upload_file(file_content)
         self.assertContains(response, "Invalid file format")
 
+    def test_roster_upload(self) -> None:
+        for mid in ("4548436161", "4548436162"):
+            MerchantRegistration.objects.create(
+                mid=mid,
+                provider_slug="amex",
+                merchant_slug="bink_test_merchant",
+                action=BatchItemAction.ADD,
+                start_date=date(2021, 1, 1),
+                end_date=date(2999, 12, 31),
+            )
+        file_content = b"""mid,start_date,end_date,merchant_slug,provider_slug
+4548436161,2021-01-01,2999-12-31,bink_test_merchant,amex
+9999999999,2021-01-01,2999-12-31,bink_test_merchant,amex
+"""
+        self.client.login(username="admin", password="!Potato12345!")
+        response = self.client.post(
+            reverse("admin:mids_batch_roster"),
+            {"input_file": SimpleUploadedFile("roster.csv", file_content, content_type="text/csv")},
+        )
+        self.assertContains(response, "roster.csv: 1 MIDs to add and 1 MIDs to delete.")
+        self.assertEqual(0, Batch.objects.count())
+
+        response = self.client.post(
+            reverse("admin:mids_batch_roster"), {"token": response.context["token"]}, follow=True
+        )
+        self.assertContains(response, "Batch imported with 2 changes from the roster")
+        self.assertEqual(
+            [("4548436162", BatchItemAction.DELETE), ("9999999999", BatchItemAction.ADD)],
+            list(
+                BatchItem.objects.filter(batch__file_name="roster.csv", status=BatchItemStatus.PENDING)
+                .order_by("mid")
+                .values_list("mid", "action")
+            ),
+        )
+
+        response = self.client.post(reverse("admin:mids_batch_roster"), {"token": "junk"}, follow=True)
+        self.assertContains(response, "The roster preview has expired")
+
+    def test_roster_upload_rejects_duplicates(self) -> None:
+        file_content = b"""mid,start_date,end_date,merchant_slug,provider_slug
+4548436161,2021-01-01,2999-12-31,bink_test_merchant,amex
+4548436161,2021-01-01,2030-12-31,bink_test_merchant,amex
+"""
+        self.client.login(username="admin", password="!Potato12345!")
+        response = self.client.post(
+            reverse("admin:mids_batch_roster"),
+            {"input_file": SimpleUploadedFile("roster.csv", file_content, content_type="text/csv")},
+        )
+        self.assertEqual({"4548436161": ["Listed more than once for amex"]}, response.context["file_errors"])
+        self.assertNotIn("token", response.context)
+
+        response = self.client.post(
+            reverse("admin:mids_batch_roster"),
+            {"input_file": SimpleUploadedFile("roster.csv", file_content + b"\xff\xfe\n", content_type="text/csv")},
+            follow=True,
+        )
+        self.assertContains(response, "Invalid file format")
+
+    def test_roster_upload_with_action_column(self) -> None:
+        file_content = b"""mid,start_date,end_date,merchant_slug,provider_slug,action
+4548436161,2021-01-01,2999-12-31,bink_test_merchant,amex,a
+"""
+        self.client.login(username="admin", password="!Potato12345!")
+        response = self.client.post(
+            reverse("admin:mids_batch_roster"),
+            {"input_file": SimpleUploadedFile("roster.csv", file_content, content_type="text/csv")},
+            follow=True,
+        )
+        self.assertContains(
+            response, "Required column headers: mid, start_date, end_date, merchant_slug, provider_slug"
+        )
+
+    def test_redrive_items_action(self) -> None:
+        self.client.login(username="admin", password="!Potato12345!")
+        batch = Batch.objects.create(file_name="test.csv")
+        fields = dict(batch=batch, mid="1", merchant_slug="test", provider_slug="amex", action=BatchItemAction.DELETE)
+        dead = BatchItem.objects.create(status=BatchItemStatus.DEAD_LETTER, attempts=5, **fields)
+        done = BatchItem.objects.create(status=BatchItemStatus.DONE, **fields)
+        task_queue.empty()
+        self.addCleanup(task_queue.empty)
+
+        response = self.client.post(
+            reverse("admin:mids_batchitem_changelist"),
+            {"action": "redrive_items_action", "_selected_action": [dead.id, done.id]},
+            follow=True,
+        )
+        self.assertContains(response, "Queued 1 dead letter items again")
+        self.assertEqual(
+            {dead.id: BatchItemStatus.QUEUED, done.id: BatchItemStatus.DONE},
+            dict(BatchItem.objects.values_list("id", "status")),
+        )
+        self.assertEqual([[dead.id]], [job.args[0] for job in task_queue.jobs])
+
     def test_process_batches_action(self) -> None:
         self.client.login(username="admin", password="!Potato12345!")
         batch = Batch.objects.create(file_name="test.csv")
@@ -129,14 +226,109 @@ class TestMidsAdmin(TestCase):
         task_queue.empty()
         self.assertEqual(0, len(task_queue))
 
-        response = self.client.post(
-            reverse("admin:mids_batch_changelist"),
-            {"action": "queue_batches_action", "_selected_action": batch.id},
-            follow=True,
-        )
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                reverse("admin:mids_batch_changelist"),
+                {"action": "queue_batches_action", "_selected_action": batch.id},
+                follow=True,
+            )
+        self.assertContains(response, "Queuing items from 1 batches in the background")
+        batch.refresh_from_db()
+        self.assertEqual(BatchDispatchStatus.PENDING, batch.dispatch_status)
+        self.assertEqual("admin", batch.sender_name)
+        self.assertEqual(1, len(task_queue))
+        job = task_queue.jobs[0]
+        self.assertEqual(batch.id, job.args[0])
+        self.assertEqual("eos.tasks.dispatch_batch", job.func_name)
+        task_queue.empty()
+
+        dispatch_batch(batch.id)
         self.assertEqual(BatchItemStatus.QUEUED, BatchItem.objects.get(id=pending_item_id).status)
-        self.assertContains(response, "Queued 1 items")
         self.assertEqual(1, len(task_queue))
-        job = task_queue.fetch_job(task_queue.job_ids[0])
-        self.assertEqual(pending_item_id, job.args[0])
-        self.assertEqual("eos.tasks.process_item", job.func_name)
+        job = task_queue.jobs[0]
+        self.assertEqual([pending_item_id], job.args[0])
+        self.assertEqual("eos.tasks.process_items", job.func_name)
+        task_queue.empty()
+
+        response = self.client.get(reverse("admin:mids_batch_changelist"))
+        self.assertContains(response, "Dispatched: 1 of 1 queued")
+
+    def test_resend_batches_action(self) -> None:
+        self.client.login(username="admin", password="!Potato12345!")
+        batch = Batch.objects.create(file_name="test.csv")
+        task_queue.empty()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                reverse("admin:mids_batch_changelist"),
+                {"action": "resend_batches_action", "_selected_action": batch.id},
+                follow=True,
+            )
+        self.assertContains(response, "Queuing items from 1 batches in the background")
+        batch.refresh_from_db()
+        self.assertTrue(batch.force_send)
+        self.assertEqual(BatchDispatchStatus.PENDING, batch.dispatch_status)
+        task_queue.empty()
+
+    def test_urgent_batches_action(self) -> None:
+        self.client.login(username="admin", password="!Potato12345!")
+        batch = Batch.objects.create(file_name="test.csv")
+        urgent_queue.empty()
+        self.addCleanup(urgent_queue.empty)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                reverse("admin:mids_batch_changelist"),
+                {"action": "urgent_batches_action", "_selected_action": batch.id},
+                follow=True,
+            )
+        self.assertContains(response, "Queuing items from 1 batches in the background")
+        batch.refresh_from_db()
+        self.assertTrue(batch.urgent)
+        self.assertEqual(1, len(urgent_queue))
+        self.assertEqual(batch.id, urgent_queue.jobs[0].args[0])
+
+    def test_process_batches_action_already_dispatching(self) -> None:
+        self.client.login(username="admin", password="!Potato12345!")
+        batch = Batch.objects.create(file_name="test.csv", dispatch_status=BatchDispatchStatus.DISPATCHING)
+        task_queue.empty()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                reverse("admin:mids_batch_changelist"),
+                {"action": "queue_batches_action", "_selected_action": batch.id},
+                follow=True,
+            )
+        self.assertContains(response, "1 batches are already being queued")
+        self.assertEqual(0, len(task_queue))
+
+    def test_process_batches_action_redis_error(self) -> None:
+        self.client.login(username="admin", password="!Potato12345!")
+        batch = Batch.objects.create(file_name="test.csv")
+
+        with mock.patch.object(task_queue, "enqueue", side_effect=RedisError), self.captureOnCommitCallbacks(
+            execute=True
+        ):
+            response = self.client.post(
+                reverse("admin:mids_batch_changelist"),
+                {"action": "queue_batches_action", "_selected_action": batch.id},
+                follow=True,
+            )
+        self.assertEqual(200, response.status_code)
+        batch.refresh_from_db()
+        self.assertEqual(BatchDispatchStatus.FAILED, batch.dispatch_status)
+
+    def test_stale_dispatch_reclaimed(self) -> None:
+        started = timezone.now() - timedelta(seconds=3700)
+        stale = Batch.objects.create(
+            file_name="stale.csv", dispatch_status=BatchDispatchStatus.DISPATCHING, dispatch_started=started
+        )
+        running = Batch.objects.create(
+            file_name="running.csv", dispatch_status=BatchDispatchStatus.DISPATCHING, dispatch_started=timezone.now()
+        )
+
+        self.assertEqual(1, tasks.reclaim_stale_dispatches())
+        self.assertEqual(
+            {stale.id: BatchDispatchStatus.FAILED, running.id: BatchDispatchStatus.DISPATCHING},
+            dict(Batch.objects.values_list("id", "dispatch_status")),
+        )
@@ -0,0 +1,107 @@
+import json
+import typing as t
+from unittest import mock
+
+import requests
+from django.contrib.auth.models import User
+from django.db import DatabaseError, transaction
+from django.test import Client, TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from eos import tasks
+from eos.progress import BatchProgress
+from eos.results import ResultBuffer
+from mids.models import Batch, BatchItem, BatchItemStatus
+
+from .helpers import MockResponse, make_items
+
+
+@override_settings(DISPATCH_MODE=tasks.DISPATCH_MODE_QUEUE)
+class TestBatchProgress(TestCase):
+    def setUp(self) -> None:
+        self.batch = Batch.objects.create(file_name="mids.csv")
+        self.addCleanup(tasks.redis.delete, BatchProgress.key(self.batch.id))
+        tasks.redis.delete(BatchProgress.key(self.batch.id))
+        self.items = make_items(self.batch, 4)
+
+    def progress(self) -> t.Dict[str, t.Any]:
+        progress = tasks.progress.read(self.batch.id)
+        self.assertIsNotNone(progress)
+        return t.cast(t.Dict[str, t.Any], progress)
+
+    def counts(self) -> t.Dict[str, int]:
+        return {name: count for name, count in self.progress()["counts"].items() if count}
+
+    def test_counts_follow_items_without_queries(self) -> None:
+        with mock.patch.object(tasks.task_queue, "enqueue_many"), self.captureOnCommitCallbacks(execute=True):
+            tasks.dispatch_batch(self.batch.id)
+        with self.assertNumQueries(0):
+            self.assertEqual({"queued": 4}, self.counts())
+
+        with mock.patch("eos.tasks.amex_agent") as mock_amex_agent, mock.patch.object(
+            tasks, "results", ResultBuffer(size=10, interval=60, progress=tasks.progress)
+        ):
+            error = {"error_code": "Inv_Req", "error_type": "Bad", "error_description": "Merchant is not valid"}
+            mock_amex_agent.return_value.add_merchant.side_effect = [
+                (MockResponse({}), timezone.now()),
+                (MockResponse({}), timezone.now()),
+                requests.ConnectionError,
+                (MockResponse(error), timezone.now()),
+            ]
+            with override_settings(ITEM_MAX_ATTEMPTS=1), self.captureOnCommitCallbacks(execute=True):
+                tasks.process_items([item.id for item in self.items])
+
+        progress = self.progress()
+        self.assertEqual({"done": 2, "dead_letter": 2}, self.counts())
+        self.assertEqual((4, 4, 0), (progress["total"], progress["finished"], progress["eta"]))
+        self.assertGreater(progress["throughput"], 0)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            tasks.redrive_items([self.items[2].id])
+        self.assertEqual({"done": 2, "queued": 1, "dead_letter": 1}, self.counts())
+
+    def test_counted_by_a_job_when_missing(self) -> None:
+        BatchItem.objects.filter(id=self.items[0].id).update(status=BatchItemStatus.IN_FLIGHT)
+        tasks.progress.move([(self.batch.id, BatchItemStatus.PENDING, BatchItemStatus.QUEUED)])
+        self.assertFalse(tasks.redis.exists(BatchProgress.key(self.batch.id)))
+        self.assertIsNone(tasks.progress.read(self.batch.id))
+
+        with mock.patch.object(tasks.urgent_queue, "enqueue") as enqueue:
+            tasks.request_progress(self.batch.id)
+        enqueue.assert_called_once_with(tasks.count_progress, self.batch.id, job_id=f"count-progress-{self.batch.id}")
+        tasks.count_progress(self.batch.id)
+        self.assertEqual({"pending": 3, "queued": 1}, self.counts())
+        self.assertIsNone(self.progress()["eta"])
+
+    def test_moves_dropped_on_rollback(self) -> None:
+        tasks.progress.reset(self.batch.id)
+        with self.captureOnCommitCallbacks(execute=True), self.assertRaises(DatabaseError), transaction.atomic():
+            tasks._count_moves([(self.batch.id, BatchItemStatus.PENDING, BatchItemStatus.QUEUED)])
+            raise DatabaseError
+        self.assertEqual({"pending": 4}, self.counts())
+
+    def test_progress_endpoints(self) -> None:
+        User.objects.create_superuser("admin", "admin@bink.com", "!Potato12345!")
+        client = Client()
+        client.login(username="admin", password="!Potato12345!")
+
+        response = client.get(reverse("admin:mids_batch_progress", args=[self.batch.id]))
+        self.assertContains(response, reverse("admin:mids_batch_progress_stream", args=[self.batch.id]))
+
+        with mock.patch.object(tasks.urgent_queue, "enqueue") as enqueue:
+            response = client.get(reverse("admin:mids_batch_progress_json", args=[self.batch.id]))
+        self.assertEqual(503, response.status_code)
+        enqueue.assert_called_once()
+
+        tasks.progress.reset(self.batch.id)
+        response = client.get(reverse("admin:mids_batch_progress_json", args=[self.batch.id]))
+        self.assertEqual(4, response.json()["counts"]["pending"])
+
+        BatchItem.objects.filter(batch=self.batch).update(status=BatchItemStatus.DONE)
+        tasks.progress.reset(self.batch.id)
+        response = client.get(reverse("admin:mids_batch_progress_stream", args=[self.batch.id]))
+        self.assertEqual("text/event-stream", response["Content-Type"])
+        retry, event, data = response.content.decode().strip().split("\n")
+        self.assertEqual(("retry: 2000", "event: done"), (retry, event))
+        self.assertEqual(4, json.loads(data.removeprefix("data: "))["counts"]["done"])
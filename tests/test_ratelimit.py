@@ -0,0 +1,39 @@
+import time
+
+from django.test import SimpleTestCase
+
+from eos.ratelimit import RateLimiter, RateLimitExceeded
+from eos.tasks import redis
+
+
+class TestRateLimiter(SimpleTestCase):
+    def setUp(self) -> None:
+        self.limiter = RateLimiter(redis, "test", rate=10, burst=2, max_wait=1)
+        redis.delete(self.limiter.key)
+        self.addCleanup(redis.delete, self.limiter.key)
+
+    def test_burst_then_limited(self) -> None:
+        self.assertEqual(0, self.limiter.try_acquire())
+        self.assertEqual(0, self.limiter.try_acquire())
+        wait = self.limiter.try_acquire()
+        self.assertGreater(wait, 0)
+        self.assertLessEqual(wait, 0.1)
+
+    def test_limiters_share_state(self) -> None:
+        other = RateLimiter(redis, "test", rate=10, burst=2)
+        self.limiter.try_acquire()
+        other.try_acquire()
+        self.assertGreater(self.limiter.try_acquire(), 0)
+
+    def test_acquire_waits_for_token(self) -> None:
+        start = time.monotonic()
+        for _ in range(4):
+            self.limiter.acquire()
+        # two tokens from the burst, then one every 100ms
+        self.assertGreaterEqual(time.monotonic() - start, 0.15)
+
+    def test_acquire_gives_up_after_max_wait(self) -> None:
+        limiter = RateLimiter(redis, "test", rate=0.1, burst=1, max_wait=1)
+        limiter.acquire()
+        with self.assertRaises(RateLimitExceeded):
+            limiter.acquire()
@@ -0,0 +1,108 @@
+import threading
+import typing as t
+from unittest import mock
+
+from django.test import TestCase, TransactionTestCase
+from django.utils import timezone
+
+from eos import tasks
+from eos.results import ResultBuffer
+from mids.models import Batch, BatchItem, BatchItemStatus
+
+from .helpers import MockResponse, make_items
+
+
+class TestResultBuffer(TestCase):
+    def test_writes_when_full(self) -> None:
+        buffer = ResultBuffer(size=3, interval=60)
+        items = make_items(Batch.objects.create(file_name="mids.csv"), 3, BatchItemStatus.IN_FLIGHT)
+        for item in items[:2]:
+            item.status = BatchItemStatus.DONE
+            buffer.add(item, ["status"])
+        self.assertFalse(BatchItem.objects.filter(status=BatchItemStatus.DONE).exists())
+
+        items[2].status = BatchItemStatus.DONE
+        with self.assertNumQueries(5):
+            # the claims locked, one UPDATE and one upsert of the registrations within a savepoint, the batch's counts
+            # once committed
+            buffer.add(items[2], ["status"])
+        self.assertEqual(3, BatchItem.objects.filter(status=BatchItemStatus.DONE).count())
+        self.assertEqual(0, buffer.flush())
+
+    def test_drops_results_of_reclaimed_items(self) -> None:
+        buffer = ResultBuffer(size=10, interval=60)
+        items = make_items(Batch.objects.create(file_name="mids.csv"), 3, BatchItemStatus.IN_FLIGHT)
+        for item in items:
+            item.claimed_at = timezone.now()
+            BatchItem.objects.filter(id=item.id).update(claimed_at=item.claimed_at)
+            item.status = BatchItemStatus.DONE
+            buffer.add(item, ["status"])
+        # reclaimed, and claimed again by another worker
+        BatchItem.objects.filter(id=items[0].id).update(claimed_at=timezone.now())
+        BatchItem.objects.filter(id=items[1].id).update(status=BatchItemStatus.QUEUED, claimed_at=None)
+
+        self.assertEqual(1, buffer.flush())
+        self.assertEqual(
+            [BatchItemStatus.IN_FLIGHT, BatchItemStatus.QUEUED, BatchItemStatus.DONE],
+            list(BatchItem.objects.order_by("id").values_list("status", flat=True)),
+        )
+
+    def test_same_result_as_saving_each_item(self) -> None:
+        responses = [
+            {"some": "json"},
+            {"error_code": "Inv_Req", "error_type": "Bad", "error_description": "Merchant is not valid"},
+        ]
+        saved, buffered = make_items(
+            Batch.objects.create(file_name="mids.csv"), 2, BatchItemStatus.IN_FLIGHT
+        ), make_items(Batch.objects.create(file_name="mids.csv"), 2, BatchItemStatus.IN_FLIGHT)
+        timestamp = timezone.now()
+        with mock.patch.object(tasks, "results", ResultBuffer(size=1, interval=60)):
+            for item, response in zip(saved, responses):
+                tasks._save_response(item, t.cast(t.Any, MockResponse(response)), timestamp)
+        with mock.patch.object(tasks, "results", ResultBuffer(size=10, interval=60)) as buffer:
+            for item, response in zip(buffered, responses):
+                tasks._save_response(item, t.cast(t.Any, MockResponse(response)), timestamp)
+            self.assertEqual(2, buffer.flush())
+
+        fields = ["status", "response", "request_timestamp", "error_code", "error_type", "error_description"]
+        self.assertEqual(
+            list(BatchItem.objects.filter(id__in=[item.id for item in saved]).order_by("mid").values(*fields)),
+            list(BatchItem.objects.filter(id__in=[item.id for item in buffered]).order_by("mid").values(*fields)),
+        )
+
+    def test_process_items_writes_chunk_before_returning(self) -> None:
+        items = make_items(Batch.objects.create(file_name="mids.csv"), 4, BatchItemStatus.IN_FLIGHT)
+        BatchItem.objects.update(status=BatchItemStatus.QUEUED)
+        with mock.patch("eos.tasks.amex_agent") as mock_amex_agent, mock.patch.object(
+            tasks, "results", ResultBuffer(size=3, interval=60)
+        ):
+            mock_amex_agent.return_value.add_merchant.return_value = MockResponse({}), timezone.now()
+            result = tasks.process_items([item.id for item in items])
+        self.assertEqual({item.id: "Done" for item in items}, result)
+
+    def test_skip_sees_registration_still_buffered(self) -> None:
+        first, second = make_items(
+            Batch.objects.create(file_name="mids.csv"), 1, BatchItemStatus.IN_FLIGHT
+        ) + make_items(Batch.objects.create(file_name="mids.csv"), 1, BatchItemStatus.IN_FLIGHT)
+        BatchItem.objects.update(status=BatchItemStatus.QUEUED)
+        with mock.patch("eos.tasks.amex_agent") as mock_amex_agent, mock.patch.object(
+            tasks, "results", ResultBuffer(size=10, interval=60)
+        ):
+            mock_amex_agent.return_value.add_merchant.return_value = MockResponse({}), timezone.now()
+            result = tasks.process_items([first.id, second.id])
+        self.assertEqual({first.id: "Done", second.id: "Skipped"}, result)
+        mock_amex_agent.return_value.add_merchant.assert_called_once()
+
+
+class TestResultBufferTimer(TransactionTestCase):
+    def test_writes_after_interval(self) -> None:
+        buffer = ResultBuffer(size=10, interval=0.05)
+        item = make_items(Batch.objects.create(file_name="mids.csv"), 1, BatchItemStatus.IN_FLIGHT)[0]
+        item.status = BatchItemStatus.DONE
+        buffer.add(item, ["status"])
+        timer = t.cast(threading.Timer, buffer.timer)
+        timer.join(timeout=5)
+
+        item.refresh_from_db()
+        self.assertEqual(BatchItemStatus.DONE, item.status)
+        self.assertIsNone(buffer.timer)
@@ -0,0 +1,27 @@
+import requests
+from django.db import OperationalError
+from django.test import SimpleTestCase, override_settings
+
+from eos import retries
+
+
+class TestRetries(SimpleTestCase):
+    @override_settings(ITEM_RETRY_DELAY=10, ITEM_RETRY_MAX_DELAY=60)
+    def test_backoff(self) -> None:
+        for attempts, delay in ((1, 10), (2, 20), (3, 40), (4, 60), (10, 60)):
+            with self.subTest(attempts=attempts):
+                for _ in range(20):
+                    self.assertTrue(delay / 2 <= retries.backoff(attempts) <= delay)
+
+    def test_is_transient(self) -> None:
+        response = requests.Response()
+        response.status_code = 503
+        for ex in (
+            requests.ConnectionError(),
+            requests.Timeout(),
+            OperationalError(),
+            retries.AmexUnavailable(response),
+        ):
+            self.assertTrue(retries.is_transient(ex), ex)
+        for ex in (ValueError(), KeyError("error_type"), requests.JSONDecodeError("Expecting value", "<html>", 0)):
+            self.assertFalse(retries.is_transient(ex), ex)
@@ -0,0 +1,75 @@
+import typing as t
+from datetime import date
+
+from django.test import TestCase
+
+from eos.tasks import redis
+from mids import roster
+from mids.models import BatchItemAction, MerchantRegistration
+
+START, END = date(2021, 1, 1), date(2999, 12, 31)
+
+
+def row(mid: str, merchant_slug: str = "wasabi-club", end_date: date = END) -> t.Dict[str, t.Any]:
+    return {
+        "mid": mid,
+        "start_date": START,
+        "end_date": end_date,
+        "merchant_slug": merchant_slug,
+        "provider_slug": "amex",
+    }
+
+
+class TestRosterDiff(TestCase):
+    def setUp(self) -> None:
+        for mid, merchant_slug, action in (
+            ("1", "wasabi-club", BatchItemAction.ADD),
+            ("2", "wasabi-club", BatchItemAction.ADD),
+            ("3", "wasabi-club", BatchItemAction.ADD),
+            ("4", "wasabi-club", BatchItemAction.DELETE),
+            ("5", "iceland", BatchItemAction.ADD),
+        ):
+            MerchantRegistration.objects.create(
+                mid=mid,
+                provider_slug="amex",
+                merchant_slug=merchant_slug,
+                action=action,
+                start_date=START,
+                end_date=END,
+            )
+
+    def test_diff(self) -> None:
+        diff = roster.RosterDiff([row("1"), row("2", end_date=date(2030, 1, 1)), row("4"), row("6")])
+
+        self.assertEqual([("2", "amex"), ("4", "amex"), ("6", "amex")], diff.adds)
+        # MIDs of merchants missing from the roster are left alone
+        self.assertEqual([("3", "amex")], diff.deletes)
+        self.assertEqual(
+            [
+                {
+                    "merchant_slug": "wasabi-club",
+                    "provider_slug": "amex",
+                    "roster": 4,
+                    "adds": 3,
+                    "deletes": 1,
+                    "unchanged": 1,
+                }
+            ],
+            diff.summary(),
+        )
+        rows = list(diff.rows())
+        self.assertEqual(
+            [BatchItemAction.ADD] * 3 + [BatchItemAction.DELETE], [roster_row["action"] for roster_row in rows]
+        )
+        self.assertEqual(("3", None, None, "wasabi-club"), tuple(rows[3].values())[:4])
+
+    def test_duplicates(self) -> None:
+        diff = roster.RosterDiff([row("1"), row("6"), row("6", merchant_slug="iceland")])
+        self.assertEqual([("6", "amex")], diff.duplicates)
+        self.assertEqual([], roster.RosterDiff([row("1"), row("6")]).duplicates)
+
+    def test_stash(self) -> None:
+        rows = list(roster.RosterDiff([row("7")]).rows())
+        token = roster.stash(redis, "roster.csv", rows)
+        self.assertEqual(("roster.csv", rows), roster.unstash(redis, token))
+        self.assertIsNone(roster.unstash(redis, token))
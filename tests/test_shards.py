@@ -0,0 +1,188 @@
+import threading
+import typing as t
+from datetime import date
+from unittest import mock
+
+import requests
+import rq
+from django.db import connection
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
+from rq.registry import FailedJobRegistry, ScheduledJobRegistry
+from rq.timeouts import JobTimeoutException, TimerDeathPenalty
+
+from eos import tasks
+from eos.shards import ShardLease, shard_of
+from eos.workers import PersistentWorker, ShardWorker
+from mids.models import Batch, BatchItem, BatchItemAction, BatchItemStatus
+
+SHARDS = 3
+
+
+def empty_shard_queues() -> None:
+    for shard in range(SHARDS):
+        queue = tasks.shard_queue(shard)
+        queue.empty()
+        tasks.redis.delete(FailedJobRegistry(queue=queue).key, ScheduledJobRegistry(queue=queue).key)
+
+
+class TestShardLease(SimpleTestCase):
+    def setUp(self) -> None:
+        self.addCleanup(tasks.redis.delete, *(ShardLease.key(shard) for shard in range(SHARDS)))
+        self.one = ShardLease(tasks.redis, owner="one", ttl=30)
+        self.other = ShardLease(tasks.redis, owner="other", ttl=30)
+
+    def test_one_holder_per_shard(self) -> None:
+        self.assertTrue(self.one.acquire(0))
+        self.assertFalse(self.other.acquire(0))
+        self.assertTrue(self.other.acquire(1))
+
+        self.assertFalse(self.other.renew(0))
+        self.other.release(0)
+        self.assertTrue(self.one.renew(0))
+
+        self.one.release(0)
+        self.assertTrue(self.other.acquire(0))
+
+    @override_settings(AMEX_SHARDS=SHARDS)
+    def test_shard_of(self) -> None:
+        shards = [shard_of(str(mid)) for mid in range(100)]
+        self.assertEqual(set(range(SHARDS)), set(shards))
+        self.assertEqual(shards, [shard_of(str(mid)) for mid in range(100)])
+
+
+@override_settings(AMEX_SHARDS=SHARDS, DISPATCH_MODE=tasks.DISPATCH_MODE_SHARDED, BATCH_CHUNK_SIZE=2)
+class TestShardedProcessing(TransactionTestCase):
+    def setUp(self) -> None:
+        empty_shard_queues()
+        self.addCleanup(empty_shard_queues)
+        self.mids = [str(mid) for mid in range(100000000, 100000009)]
+        # an ADD then a DELETE for every MID in one batch, and another ADD in the next
+        self.item_ids = self.make_items([BatchItemAction.ADD, BatchItemAction.DELETE])
+        self.item_ids += self.make_items([BatchItemAction.ADD])
+
+    def make_items(self, actions: t.List[BatchItemAction]) -> t.List[int]:
+        batch = Batch.objects.create(file_name="mids.csv")
+        return [
+            BatchItem.objects.create(
+                batch=batch,
+                mid=mid,
+                start_date=date(2021, 2, 15),
+                end_date=date(2021, 2, 16),
+                merchant_slug="wasabi-club",
+                provider_slug="amex",
+                action=action,
+                status=BatchItemStatus.QUEUED,
+            ).id
+            for action in actions
+            for mid in self.mids
+        ]
+
+    def test_items_of_each_mid_sent_in_order_one_at_a_time(self) -> None:
+        calls: t.Dict[str, t.List[str]] = {mid: [] for mid in self.mids}
+        sending: t.Set[str] = set()
+        overlaps: t.List[str] = []
+        in_flight = peak = 0
+        lock = threading.Lock()
+
+        def call(action: str, mid: str) -> tuple:
+            nonlocal in_flight, peak
+            with lock:
+                if mid in sending:
+                    overlaps.append(mid)
+                sending.add(mid)
+                in_flight += 1
+                peak = max(peak, in_flight)
+                calls[mid].append(action)
+                first_call = len(calls[mid]) == 1
+            threading.Event().wait(0.02)
+            with lock:
+                sending.discard(mid)
+                in_flight -= 1
+            if first_call and mid == self.mids[0]:
+                # retried in place, ahead of the items queued behind it
+                raise requests.ConnectionError
+            return mock.Mock(json=lambda: {}), None
+
+        def consume() -> None:
+            try:
+                ShardWorker().work(burst=True)
+            finally:
+                connection.close()
+
+        queued, errors = tasks.hand_over(self.item_ids, tasks.bulk_queue)
+        self.assertEqual((sorted(self.item_ids), []), (sorted(queued), errors))
+        self.assertEqual(0, tasks.bulk_queue.count)
+        with mock.patch("eos.tasks.amex_agent") as mock_amex_agent, mock.patch(
+            "eos.retries.backoff", return_value=0.01
+        ), mock.patch.object(PersistentWorker, "death_penalty_class", TimerDeathPenalty), mock.patch.object(
+            # signal handlers can only be set on the main thread
+            rq.Worker,
+            "_install_signal_handlers",
+        ):
+            mock_amex_agent.return_value.add_merchant.side_effect = lambda mid, *args: call("add", mid)
+            mock_amex_agent.return_value.delete_merchant.side_effect = lambda mid, *args: call("delete", mid)
+            threads = [threading.Thread(target=consume) for _ in range(SHARDS)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual([], overlaps)
+        self.assertGreater(peak, 1)
+        self.assertEqual(["add", "add", "delete", "add"], calls[self.mids[0]])
+        for mid in self.mids[1:]:
+            self.assertEqual(["add", "delete", "add"], calls[mid])
+        self.assertEqual(
+            len(self.item_ids), BatchItem.objects.filter(status=BatchItemStatus.DONE, attempts__lte=1).count()
+        )
+
+    def test_shard_worker_drains_every_shard(self) -> None:
+        tasks.hand_over(self.item_ids)
+        with mock.patch("eos.tasks.amex_agent") as mock_amex_agent:
+            mock_amex_agent.return_value.add_merchant.return_value = mock.Mock(json=lambda: {}), None
+            mock_amex_agent.return_value.delete_merchant.return_value = mock.Mock(json=lambda: {}), None
+            worker = ShardWorker()
+            worker.work(burst=True)
+
+        self.assertFalse(worker.recycle)
+        self.assertEqual(len(self.item_ids), BatchItem.objects.filter(status=BatchItemStatus.DONE).count())
+        self.assertEqual([], [shard for shard in range(SHARDS) if tasks.redis.exists(ShardLease.key(shard))])
+
+    def test_failed_chunk_dead_letters_its_unsent_items(self) -> None:
+        mock_response = mock.Mock(json=lambda: {}), None
+        timed_out: t.List[str] = []
+
+        def add_merchant(mid: str, *args: t.Any) -> tuple:
+            if mid == self.mids[0] and not timed_out:
+                timed_out.append(mid)
+                raise JobTimeoutException
+            return mock_response
+
+        tasks.hand_over(self.item_ids)
+        with mock.patch("eos.tasks.amex_agent") as mock_amex_agent:
+            mock_amex_agent.return_value.add_merchant.side_effect = add_merchant
+            mock_amex_agent.return_value.delete_merchant.return_value = mock_response
+            ShardWorker().work(burst=True)
+
+        shard = tasks.shard_queue(shard_of(self.mids[0]))
+        failed = [
+            rq.job.Job.fetch(job_id, connection=tasks.redis) for job_id in FailedJobRegistry(queue=shard).get_job_ids()
+        ]
+        self.assertEqual([self.item_ids[0]], [job.args[0][0] for job in failed])
+        self.assertEqual(0, ScheduledJobRegistry(queue=shard).count)
+        dead_letters = BatchItem.objects.filter(status=BatchItemStatus.DEAD_LETTER).values_list("id", flat=True)
+        self.assertEqual(failed[0].args[0], sorted(dead_letters))
+        self.assertEqual(
+            len(self.item_ids) - len(dead_letters), BatchItem.objects.filter(status=BatchItemStatus.DONE).count()
+        )
+
+    @override_settings(BATCH_CHUNK_JOB_TIMEOUT=10)
+    def test_held_back_chunk_goes_back_to_the_head_of_its_shard(self) -> None:
+        shard = tasks.shard_queue(shard_of(self.mids[0]))
+        shard.enqueue(tasks.process_items_in_order, [self.item_ids[-1]])
+        with mock.patch("eos.tasks._attempt", return_value=60) as mock_attempt:
+            statuses = tasks.process_items_in_order(self.item_ids[:2])
+
+        self.assertEqual({}, statuses)
+        mock_attempt.assert_called_once_with(self.item_ids[0])
+        self.assertEqual([self.item_ids[:2], [self.item_ids[-1]]], [job.args[0] for job in shard.get_jobs()])
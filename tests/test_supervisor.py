@@ -0,0 +1,49 @@
+import os
+import signal
+import tempfile
+import threading
+import time
+
+from django.test import SimpleTestCase
+
+from eos.supervisor import Supervisor
+
+
+class TestSupervisor(SimpleTestCase):
+    def setUp(self) -> None:
+        self.log = tempfile.NamedTemporaryFile()
+        self.addCleanup(self.log.close)
+
+    def starts(self) -> int:
+        with open(self.log.name) as file:
+            return len(file.read())
+
+    def record_start(self) -> int:
+        with open(self.log.name, "a") as file:
+            file.write("x")
+        return self.starts()
+
+    def test_restarts_crashed_children_in_burst(self) -> None:
+        def target() -> None:
+            # the first start crashes, the rest finish cleanly
+            if self.record_start() == 1:
+                raise RuntimeError("crash")
+
+        supervisor = Supervisor(2, target, burst=True)
+        supervisor.min_uptime = 0
+        supervisor.run()
+        self.assertEqual(3, self.starts())
+
+    def test_sigterm_stops_children(self) -> None:
+        def target() -> None:
+            self.record_start()
+            time.sleep(60)
+
+        timer = threading.Timer(1, os.kill, (os.getpid(), signal.SIGTERM))
+        timer.start()
+        self.addCleanup(timer.cancel)
+        start = time.monotonic()
+        Supervisor(3, target).run()
+
+        self.assertLess(time.monotonic() - start, 30)
+        self.assertEqual(3, self.starts())
@@ -1,12 +1,27 @@
-from datetime import date
+import json
+import os
+import ssl
+import tempfile
+import threading
+import typing as t
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from unittest import mock
 
+import requests
 import responses
 from django.test import TestCase, override_settings
 from django.utils import timezone
+from redis.exceptions import RedisError
 
 from eos import tasks
-from mids.models import Batch, BatchItem, BatchItemAction, BatchItemStatus
+from eos.agents.amex import make_ssl_context
+from eos.circuitbreaker import CircuitOpen
+from eos.ratelimit import RateLimitExceeded
+from mids.models import Batch, BatchDispatchStatus, BatchItem, BatchItemAction, BatchItemStatus, MerchantRegistration
+
+from .certs import make_self_signed_cert
+from .helpers import MockResponse
 
 AMEX_API_HOST = "http://localhost"
 AMEX_CLIENT_SECRET = "shhhh"
@@ -37,22 +52,15 @@ class TestTasks(TestCase):
     @responses.activate
     def test_process_item_not_status_queued(self) -> None:
         BatchItem.objects.filter(id=self.item.id).update(status=BatchItemStatus.PENDING)
-        with mock.patch("eos.tasks.MerchantRegApi") as mock_amex:
+        with mock.patch("eos.tasks.amex_agent") as mock_amex_agent:
             tasks.process_item(self.item.id)
-            mock_amex.add_merchant.assert_not_called()
-
-    class MockResponse:
-        def __init__(self, json: dict) -> None:
-            self._json = json
-
-        def json(self) -> dict:
-            return self._json
+            mock_amex_agent.return_value.add_merchant.assert_not_called()
 
     def test_process_item(self) -> None:
-        with mock.patch("eos.tasks.MerchantRegApi") as mock_api_cls:
-            mock_api = mock_api_cls.return_value
+        with mock.patch("eos.tasks.amex_agent") as mock_amex_agent:
+            mock_api = mock_amex_agent.return_value
             mock_api.add_merchant.return_value = (
-                self.MockResponse({"some": "json"}),
+                MockResponse({"some": "json"}),
                 timezone.now(),
             )
             tasks.process_item(self.item.id)
@@ -61,9 +69,56 @@ class TestTasks(TestCase):
         self.assertEqual(self.item.status, BatchItemStatus.DONE)
         self.assertEqual(self.item.response, {"some": "json"})
 
+    def test_process_item_records_registration(self) -> None:
+        timestamp = timezone.now()
+        with mock.patch("eos.tasks.amex_agent") as mock_amex_agent:
+            mock_amex_agent.return_value.add_merchant.return_value = MockResponse({}), timestamp
+            tasks.process_item(self.item.id)
+        registration = MerchantRegistration.objects.get(mid="123456789", provider_slug="amex")
+        self.assertEqual(
+            (BatchItemAction.ADD, self.start, self.end, self.item.id, timestamp),
+            (
+                registration.action,
+                registration.start_date,
+                registration.end_date,
+                registration.last_item_id,
+                registration.last_success,
+            ),
+        )
+
+    def test_process_item_skips_registered_mid(self) -> None:
+        MerchantRegistration.from_item(self.item).save()
+        with mock.patch("eos.tasks.amex_agent") as mock_amex_agent:
+            tasks.process_item(self.item.id)
+            mock_amex_agent.return_value.add_merchant.assert_not_called()
+        self.item.refresh_from_db()
+        self.assertEqual(BatchItemStatus.SKIPPED, self.item.status)
+
+    def test_process_item_sends_changed_registration(self) -> None:
+        registration = MerchantRegistration.from_item(self.item)
+        registration.end_date = date(2021, 2, 20)
+        registration.save()
+        with mock.patch("eos.tasks.amex_agent") as mock_amex_agent:
+            mock_amex_agent.return_value.add_merchant.return_value = MockResponse({}), timezone.now()
+            tasks.process_item(self.item.id)
+        self.item.refresh_from_db()
+        self.assertEqual(BatchItemStatus.DONE, self.item.status)
+        registration.refresh_from_db()
+        self.assertEqual(self.end, registration.end_date)
+
+    def test_process_item_force_send(self) -> None:
+        MerchantRegistration.from_item(self.item).save()
+        Batch.objects.filter(id=self.batch.id).update(force_send=True)
+        with mock.patch("eos.tasks.amex_agent") as mock_amex_agent:
+            mock_amex_agent.return_value.add_merchant.return_value = MockResponse({}), timezone.now()
+            tasks.process_item(self.item.id)
+            mock_amex_agent.return_value.add_merchant.assert_called_once()
+        self.item.refresh_from_db()
+        self.assertEqual(BatchItemStatus.DONE, self.item.status)
+
     def test_process_item_error(self) -> None:
-        with mock.patch("eos.tasks.MerchantRegApi") as mock_api_cls:
-            mock_api = mock_api_cls.return_value
+        with mock.patch("eos.tasks.amex_agent") as mock_amex_agent:
+            mock_api = mock_amex_agent.return_value
             canned_json = {
                 "error_code": "1040012",
                 "error_type": "Invalid request",
@@ -71,16 +126,297 @@ class TestTasks(TestCase):
                 "correlationId": "5bd5af1f-c456-4edd-8ec6-ec33a5d0f731",
             }
             mock_api.add_merchant.return_value = (
-                self.MockResponse(canned_json),
+                MockResponse(canned_json),
                 timezone.now(),
             )
             tasks.process_item(self.item.id)
             mock_api.add_merchant.assert_called_with("123456789", "wasabi-club", self.start, self.end)
         self.item.refresh_from_db()
-        self.assertEqual(self.item.status, BatchItemStatus.ERROR)
+        self.assertEqual(self.item.status, BatchItemStatus.DEAD_LETTER)
         self.assertEqual(self.item.error_code, "1040012")
         self.assertEqual(self.item.error_type, "Invalid request")
         self.assertEqual(
             self.item.error_description,
             "Merchant ID already registered, updated, or deleted.",
         )
+
+    def test_process_item_rate_limited(self) -> None:
+        with mock.patch("eos.tasks.amex_agent") as mock_amex_agent, mock.patch("eos.tasks.task_queue") as mock_queue:
+            mock_amex_agent.return_value.add_merchant.side_effect = RateLimitExceeded
+            tasks.process_item(self.item.id)
+        mock_queue.enqueue.assert_called_once_with(tasks.process_item, self.item.id)
+        self.item.refresh_from_db()
+        self.assertEqual(self.item.status, BatchItemStatus.QUEUED)
+
+    def test_process_item_circuit_open(self) -> None:
+        with mock.patch("eos.tasks.amex_agent") as mock_amex_agent, mock.patch("eos.tasks.task_queue") as mock_queue:
+            mock_amex_agent.return_value.add_merchant.side_effect = CircuitOpen("amex", 12)
+            tasks.process_item(self.item.id)
+        mock_queue.enqueue_in.assert_called_once_with(timedelta(seconds=12), tasks.process_item, self.item.id)
+        self.item.refresh_from_db()
+        self.assertEqual(self.item.status, BatchItemStatus.QUEUED)
+
+    def test_process_items_retries_transient_failures(self) -> None:
+        other = BatchItem.objects.create(
+            batch=self.batch,
+            mid="987654321",
+            start_date=self.start,
+            end_date=self.end,
+            merchant_slug="wasabi-club",
+            provider_slug="amex",
+            action=BatchItemAction.ADD,
+            status=BatchItemStatus.QUEUED,
+        )
+        with mock.patch("eos.tasks.amex_agent") as mock_amex_agent, mock.patch(
+            "eos.tasks.task_queue"
+        ) as mock_queue, mock.patch("eos.retries.backoff", return_value=15):
+            mock_amex_agent.return_value.add_merchant.side_effect = [
+                requests.ConnectionError,
+                (MockResponse({"some": "json"}), timezone.now()),
+            ]
+            result = tasks.process_items([self.item.id, other.id])
+        self.assertEqual({self.item.id: "Queued", other.id: "Done"}, result)
+        mock_queue.enqueue_in.assert_called_once_with(timedelta(seconds=15), tasks.process_item, self.item.id)
+        self.item.refresh_from_db()
+        self.assertEqual((BatchItemStatus.QUEUED, 1), (self.item.status, self.item.attempts))
+        self.assertIsNotNone(self.item.retry_at)
+
+    def test_process_item_retries_unavailable_amex(self) -> None:
+        with mock.patch("eos.tasks.amex_agent") as mock_amex_agent, mock.patch("eos.tasks.task_queue") as mock_queue:
+            mock_amex_agent.return_value.add_merchant.return_value = (
+                MockResponse({"error_code": "503.01"}, status_code=503),
+                timezone.now(),
+            )
+            tasks.process_item(self.item.id)
+        mock_queue.enqueue_in.assert_called_once()
+        self.item.refresh_from_db()
+        self.assertEqual((BatchItemStatus.QUEUED, ""), (self.item.status, self.item.error_code))
+
+    def test_process_item_rejected_credentials_dead_letter(self) -> None:
+        with mock.patch("eos.tasks.amex_agent") as mock_amex_agent, mock.patch("eos.tasks.task_queue") as mock_queue:
+            mock_amex_agent.return_value.add_merchant.return_value = MockResponse({}, status_code=401), None
+            tasks.process_item(self.item.id)
+        mock_queue.enqueue_in.assert_not_called()
+        self.item.refresh_from_db()
+        self.assertEqual(
+            (BatchItemStatus.DEAD_LETTER, "CredentialsRejected: Amex rejected our credentials (401)"),
+            (self.item.status, self.item.error_description),
+        )
+
+    def test_process_item_permanent_failure_dead_letter(self) -> None:
+        with mock.patch("eos.tasks.amex_agent") as mock_amex_agent, mock.patch("eos.tasks.task_queue") as mock_queue:
+            response = MockResponse({})
+            response.json = mock.Mock(  # type: ignore[method-assign]
+                side_effect=requests.JSONDecodeError("Expecting value", "<html>", 0)
+            )
+            mock_amex_agent.return_value.add_merchant.return_value = response, timezone.now()
+            tasks.process_item(self.item.id)
+        mock_queue.enqueue_in.assert_not_called()
+        self.item.refresh_from_db()
+        self.assertEqual(
+            (BatchItemStatus.DEAD_LETTER, 1, "JSONDecodeError: Expecting value: line 1 column 1 (char 0)"),
+            (self.item.status, self.item.attempts, self.item.error_description),
+        )
+
+    @override_settings(ITEM_MAX_ATTEMPTS=3)
+    def test_process_item_out_of_attempts_dead_letter(self) -> None:
+        BatchItem.objects.filter(id=self.item.id).update(attempts=2)
+        with mock.patch("eos.tasks.amex_agent") as mock_amex_agent, mock.patch("eos.tasks.task_queue") as mock_queue:
+            mock_amex_agent.return_value.add_merchant.side_effect = requests.ConnectionError("refused")
+            tasks.process_item(self.item.id)
+        mock_queue.enqueue_in.assert_not_called()
+        self.item.refresh_from_db()
+        self.assertEqual((BatchItemStatus.DEAD_LETTER, 3), (self.item.status, self.item.attempts))
+
+    def test_redrive_items(self) -> None:
+        BatchItem.objects.filter(id=self.item.id).update(
+            status=BatchItemStatus.DEAD_LETTER, attempts=5, error_code="1040012", error_description="Rejected"
+        )
+        with mock.patch.object(tasks.task_queue, "enqueue_many") as enqueue_many:
+            self.assertEqual(([self.item.id], []), tasks.redrive_items([self.item.id]))
+        enqueue_many.assert_called_once()
+        self.item.refresh_from_db()
+        self.assertEqual(
+            (BatchItemStatus.QUEUED, 0, "", ""),
+            (self.item.status, self.item.attempts, self.item.error_code, self.item.error_description),
+        )
+
+    def test_process_item_in_flight_during_call(self) -> None:
+        def add_merchant(*args: t.Any) -> tuple:
+            item = BatchItem.objects.get(id=self.item.id)
+            self.assertEqual(BatchItemStatus.IN_FLIGHT, item.status)
+            self.assertIsNotNone(item.claimed_at)
+            return MockResponse({"some": "json"}), timezone.now()
+
+        with mock.patch("eos.tasks.amex_agent") as mock_amex_agent:
+            mock_amex_agent.return_value.add_merchant.side_effect = add_merchant
+            tasks.process_item(self.item.id)
+        self.item.refresh_from_db()
+        self.assertEqual(BatchItemStatus.DONE, self.item.status)
+
+    def test_process_item_releases_claim_on_error(self) -> None:
+        with mock.patch("eos.tasks.amex_agent") as mock_amex_agent, mock.patch("eos.tasks.task_queue"):
+            mock_amex_agent.return_value.add_merchant.side_effect = requests.ConnectionError
+            tasks.process_item(self.item.id)
+        self.item.refresh_from_db()
+        self.assertEqual((BatchItemStatus.QUEUED, None), (self.item.status, self.item.claimed_at))
+
+    @override_settings(ITEM_CLAIM_TIMEOUT=300)
+    def test_reclaim_stale_items(self) -> None:
+        BatchItem.objects.filter(id=self.item.id).update(
+            status=BatchItemStatus.IN_FLIGHT, claimed_at=timezone.now() - timedelta(seconds=301)
+        )
+        fresh_id = self._pending_item(1)
+        BatchItem.objects.filter(id=fresh_id).update(status=BatchItemStatus.IN_FLIGHT, claimed_at=timezone.now())
+
+        with mock.patch.object(tasks.task_queue, "enqueue_many") as enqueue_many:
+            self.assertEqual(1, tasks.reclaim_stale_items())
+        self.assertEqual([self.item.id], enqueue_many.call_args.args[0][0].args[0])
+        self.assertEqual(BatchItemStatus.QUEUED, BatchItem.objects.get(id=self.item.id).status)
+        self.assertEqual(BatchItemStatus.IN_FLIGHT, BatchItem.objects.get(id=fresh_id).status)
+
+    @override_settings(BATCH_CHUNK_SIZE=2, ENQUEUE_PIPELINE_SIZE=2)
+    def test_enqueue_items_pipelines_chunks(self) -> None:
+        with mock.patch.object(tasks.task_queue, "enqueue_many", side_effect=[[], RedisError]) as enqueue_many:
+            queued, errors = tasks.enqueue_items([1, 2, 3, 4, 5])
+        self.assertEqual(([1, 2, 3, 4], [5]), (queued, errors))
+        self.assertEqual(2, enqueue_many.call_count)
+        self.assertEqual([([1, 2],), ([3, 4],)], [data.args for data in enqueue_many.call_args_list[0].args[0]])
+
+    @override_settings(BATCH_CHUNK_SIZE=2, DISPATCH_PAGE_SIZE=3)
+    def test_dispatch_batch_pages_and_chunks(self) -> None:
+        self.item.delete()
+        item_ids = [self._pending_item(mid) for mid in range(5)]
+        with mock.patch.object(tasks.task_queue, "enqueue_many") as enqueue_many:
+            tasks.dispatch_batch(self.batch.id)
+
+        chunks = [data.args[0] for call in enqueue_many.call_args_list for data in call.args[0]]
+        self.assertEqual([item_ids[0:2], item_ids[2:3], item_ids[3:5]], chunks)
+        self.assertEqual(5, self.batch.batchitem_set.filter(status=BatchItemStatus.QUEUED).count())
+        self.batch.refresh_from_db()
+        self.assertEqual(BatchDispatchStatus.DISPATCHED, self.batch.dispatch_status)
+        self.assertEqual((5, 5), (self.batch.items_to_dispatch, self.batch.items_dispatched))
+
+    def test_dispatch_batch_redis_error(self) -> None:
+        self.item.delete()
+        item_id = self._pending_item(1)
+        with mock.patch.object(tasks.task_queue, "enqueue_many", side_effect=RedisError):
+            tasks.dispatch_batch(self.batch.id)
+
+        self.assertEqual(BatchItemStatus.PENDING, BatchItem.objects.get(id=item_id).status)
+        self.batch.refresh_from_db()
+        self.assertEqual(BatchDispatchStatus.FAILED, self.batch.dispatch_status)
+        self.assertEqual(0, self.batch.items_dispatched)
+
+    @override_settings(BULK_BATCH_SIZE=2)
+    def test_dispatch_batch_queue_priority(self) -> None:
+        self.item.delete()
+        self._pending_item(1)
+        for queue, urgent, items in (
+            (tasks.task_queue, False, 1),
+            (tasks.bulk_queue, False, 2),
+            (tasks.urgent_queue, True, 2),
+        ):
+            with self.subTest(queue=queue.name):
+                BatchItem.objects.update(status=BatchItemStatus.PENDING)
+                Batch.objects.filter(id=self.batch.id).update(urgent=urgent)
+                if items > self.batch.batchitem_set.count():
+                    self._pending_item(2)
+                with mock.patch.object(queue, "enqueue_many") as enqueue_many:
+                    tasks.dispatch_batch(self.batch.id)
+                enqueue_many.assert_called_once()
+
+    def _pending_item(self, mid: int) -> int:
+        return BatchItem.objects.create(
+            batch=self.batch,
+            mid=str(mid),
+            start_date=self.start,
+            end_date=self.end,
+            merchant_slug="wasabi-club",
+            provider_slug="amex",
+            action=BatchItemAction.ADD,
+            status=BatchItemStatus.PENDING,
+        ).id
+
+
+class AmexStandIn(ThreadingHTTPServer):
+    """
+    Local HTTPS server answering every merchant call with success, counting the TLS connections made to it.
+    """
+
+    def __init__(self, key: str, cert: str) -> None:
+        super().__init__(("127.0.0.1", 0), self.Handler)
+        self.connections = 0
+        self.cert_dir = tempfile.TemporaryDirectory()
+        self.cert_path = os.path.join(self.cert_dir.name, "cert.pem")
+        key_path = os.path.join(self.cert_dir.name, "key.pem")
+        for path, data in ((self.cert_path, cert), (key_path, key)):
+            with open(path, "w") as file:
+                file.write(data)
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(self.cert_path, key_path)
+        self.socket = context.wrap_socket(self.socket, server_side=True)
+
+    def get_request(self) -> t.Tuple[t.Any, t.Any]:
+        self.connections += 1
+        return super().get_request()
+
+    def server_close(self) -> None:
+        super().server_close()
+        self.cert_dir.cleanup()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self) -> None:
+            self.rfile.read(int(self.headers["Content-Length"]))
+            body = json.dumps({"correlationId": "stand-in"}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format: str, *args: t.Any) -> None:
+            pass
+
+
+class TestAmexAgentReuse(TestCase):
+    def setUp(self) -> None:
+        self.server = AmexStandIn(*make_self_signed_cert())
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        batch = Batch.objects.create(file_name="mids.csv")
+        self.item_ids = [
+            BatchItem.objects.create(
+                batch=batch,
+                mid=str(mid),
+                start_date=date(2021, 2, 15),
+                end_date=date(2021, 2, 16),
+                merchant_slug="wasabi-club",
+                provider_slug="amex",
+                action=BatchItemAction.ADD,
+                status=BatchItemStatus.QUEUED,
+            ).id
+            for mid in range(5)
+        ]
+
+    def test_sequential_items_reuse_one_connection(self) -> None:
+        with override_settings(
+            AMEX_API_HOST=f"https://localhost:{self.server.server_address[1]}",
+            AMEX_CLIENT_SECRET=AMEX_CLIENT_SECRET,
+            AMEX_CLIENT_ID=AMEX_CLIENT_ID,
+        ), mock.patch("eos.tasks._amex_agent", None), mock.patch(
+            "eos.agents.amex.MerchantRegApi.load_cert_from_vault",
+            return_value=make_ssl_context(*make_self_signed_cert()),
+        ):
+            session = tasks.amex_agent().session
+            session.trust_env = False  # REQUESTS_CA_BUNDLE would otherwise take precedence over session.verify
+            session.verify = self.server.cert_path
+            for item_id in self.item_ids:
+                tasks.process_item(item_id)
+
+        self.assertEqual(len(self.item_ids), BatchItem.objects.filter(status=BatchItemStatus.DONE).count())
+        self.assertEqual(1, self.server.connections)
@@ -0,0 +1,93 @@
+import threading
+from datetime import date
+from unittest import mock
+
+from django.test import SimpleTestCase, TestCase, override_settings
+from redis.exceptions import RedisError
+
+from eos import tasks, timing
+from eos.agents.amex import MerchantRegApi, make_ssl_context
+from mids.models import Batch, BatchItem, BatchItemAction, BatchItemStatus
+
+from .certs import make_self_signed_cert
+from .test_tasks import AmexStandIn
+
+
+class TestTimedCall(TestCase):
+    def setUp(self) -> None:
+        self.key = timing.histogram_key(timing.worker_name())
+        tasks.redis.delete(self.key)
+        self.addCleanup(tasks.redis.delete, self.key)
+
+    @override_settings(AMEX_CALL_TIMINGS=False)
+    def test_disabled_records_nothing(self) -> None:
+        with timing.timed_call(tasks.redis, "call") as timings:
+            with timings.stage("work"):
+                pass
+            self.assertIs(timing.NULL_TIMINGS, timing.current())
+        self.assertEqual({}, timings.stages)
+        self.assertFalse(tasks.redis.exists(self.key))
+
+    @override_settings(AMEX_CALL_TIMINGS=True)
+    def test_redis_error_does_not_fail_call(self) -> None:
+        with mock.patch("eos.timing.observe", side_effect=RedisError), self.assertLogs("eos.timing", "ERROR"):
+            with timing.timed_call(tasks.redis, "call") as timings:
+                with timings.stage("work"):
+                    pass
+        self.assertIn("work", timings.stages)
+
+    @override_settings(AMEX_CALL_TIMINGS=True)
+    def test_process_item_records_stages(self) -> None:
+        item = BatchItem.objects.create(
+            batch=Batch.objects.create(file_name="mids.csv"),
+            mid="123456789",
+            start_date=date(2021, 2, 15),
+            end_date=date(2021, 2, 16),
+            merchant_slug="wasabi-club",
+            provider_slug="amex",
+            action=BatchItemAction.ADD,
+            status=BatchItemStatus.QUEUED,
+        )
+        response = mock.Mock(**{"json.return_value": {"some": "json"}})
+        with mock.patch("eos.tasks.amex_agent") as mock_amex_agent, self.assertLogs("eos.timing") as logs:
+            mock_amex_agent.return_value.add_merchant.return_value = (response, None)
+            tasks.process_item(item.id)
+
+        record = logs.records[0]
+        self.assertEqual(item.id, getattr(record, "batch_item_id"))
+        for stage in ("db_claim", "db_write", "total"):
+            self.assertGreater(getattr(record, f"timing_{stage}"), 0)
+        histograms = timing.histograms(tasks.redis, timing.worker_name())
+        self.assertEqual(1, histograms["total"]["count"])
+        self.assertEqual(1, timing.summary(histograms["db_write"])["count"])
+
+
+class TestConnectionTimings(SimpleTestCase):
+    def test_new_connection_records_connect_and_tls(self) -> None:
+        key, cert = make_self_signed_cert()
+        server = AmexStandIn(key, cert)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        with override_settings(
+            AMEX_API_HOST=f"https://localhost:{server.server_address[1]}",
+            AMEX_CLIENT_ID="client-id",
+            AMEX_CLIENT_SECRET="shhhh",
+            AMEX_CALL_TIMINGS=True,
+        ), mock.patch.object(MerchantRegApi, "load_cert_from_vault", return_value=make_ssl_context(key, cert)):
+            api = MerchantRegApi()
+            api.session.trust_env = False
+            api.session.verify = server.cert_path
+            stages = []
+            for _ in range(2):
+                with mock.patch.object(timing, "observe"), timing.timed_call(tasks.redis, "call") as timings:
+                    api.add_merchant("4548436161", "wasabi-club", date(2021, 2, 15), date(2021, 2, 16))
+                stages.append(timings.stages)
+
+        self.assertGreater(stages[0]["connect"], 0)
+        self.assertGreater(stages[0]["tls"], 0)
+        # the second call reuses the pooled connection
+        self.assertNotIn("tls", stages[1])
+        for stage in ("vault", "sign", "request", "server"):
+            self.assertIn(stage, stages[1])
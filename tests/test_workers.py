@@ -0,0 +1,261 @@
+import os
+import threading
+import typing as t
+from datetime import date, timedelta
+from unittest import mock
+
+import rq
+from django.db import connection, transaction
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+
+from eos import tasks
+from eos.workers import ConcurrentWorker, DatabaseWorker, PersistentWorker, weighted_schedule
+from mids.models import Batch, BatchDispatchStatus, BatchItem, BatchItemAction, BatchItemStatus
+
+
+class TestConcurrentWorker(TransactionTestCase):
+    def setUp(self) -> None:
+        self.queue = rq.Queue("test-concurrent-worker", connection=tasks.redis)
+        self.queue.empty()
+        self.addCleanup(self.queue.empty)
+        batch = Batch.objects.create(file_name="mids.csv")
+        self.item_ids = [
+            BatchItem.objects.create(
+                batch=batch,
+                mid=str(mid),
+                start_date=date(2021, 2, 15),
+                end_date=date(2021, 2, 16),
+                merchant_slug="wasabi-club",
+                provider_slug="amex",
+                action=BatchItemAction.ADD,
+                status=BatchItemStatus.QUEUED,
+            ).id
+            for mid in range(6)
+        ]
+
+    def test_jobs_run_concurrently(self) -> None:
+        in_flight = peak = 0
+        lock = threading.Lock()
+
+        def add_merchant(*args: str) -> tuple:
+            nonlocal in_flight, peak
+            with lock:
+                in_flight += 1
+                peak = max(peak, in_flight)
+            threading.Event().wait(0.2)
+            with lock:
+                in_flight -= 1
+            return mock.Mock(json=lambda: {}), None
+
+        for item_id in self.item_ids:
+            self.queue.enqueue(tasks.process_item, item_id)
+
+        with mock.patch("eos.tasks.amex_agent") as mock_amex_agent:
+            mock_amex_agent.return_value.add_merchant.side_effect = add_merchant
+            worker = ConcurrentWorker([self.queue], connection=tasks.redis, concurrency=3)
+            worker.work(burst=True)
+
+        self.assertEqual(3, peak)
+        self.assertEqual(len(self.item_ids), BatchItem.objects.filter(status=BatchItemStatus.DONE).count())
+
+    def test_recycles_after_max_jobs(self) -> None:
+        for item_id in self.item_ids:
+            self.queue.enqueue(tasks.process_item, item_id)
+
+        with mock.patch("eos.tasks.amex_agent") as mock_amex_agent:
+            mock_amex_agent.return_value.add_merchant.return_value = mock.Mock(json=lambda: {}), None
+            worker = ConcurrentWorker([self.queue], connection=tasks.redis, concurrency=2, max_jobs=2)
+            worker.work(burst=True)
+
+        self.assertTrue(worker.recycle)
+        # the jobs taken before the recycle was asked for are finished, and the rest left on the queue
+        done = BatchItem.objects.filter(status=BatchItemStatus.DONE).count()
+        self.assertEqual(done, worker.jobs_started)
+        self.assertLess(done, len(self.item_ids))
+        self.assertEqual(len(self.item_ids) - done, self.queue.count)
+
+
+class TestPersistentWorker(TransactionTestCase):
+    def setUp(self) -> None:
+        self.queue = rq.Queue("test-persistent-worker", connection=tasks.redis)
+        self.queue.empty()
+        self.addCleanup(self.queue.empty)
+        batch = Batch.objects.create(file_name="mids.csv")
+        self.item_ids = [
+            BatchItem.objects.create(
+                batch=batch,
+                mid=str(mid),
+                start_date=date(2021, 2, 15),
+                end_date=date(2021, 2, 16),
+                merchant_slug="wasabi-club",
+                provider_slug="amex",
+                action=BatchItemAction.ADD,
+                status=BatchItemStatus.QUEUED,
+            ).id
+            for mid in range(3)
+        ]
+        for item_id in self.item_ids:
+            self.queue.enqueue(tasks.process_item, item_id)
+
+    def test_jobs_run_in_process(self) -> None:
+        pids: t.List[int] = []
+
+        def add_merchant(*args: str) -> tuple:
+            pids.append(os.getpid())
+            return mock.Mock(json=lambda: {}), None
+
+        with mock.patch("eos.tasks.amex_agent") as mock_amex_agent:
+            mock_amex_agent.return_value.add_merchant.side_effect = add_merchant
+            worker = PersistentWorker([self.queue], connection=tasks.redis)
+            worker.work(burst=True)
+
+        self.assertEqual([os.getpid()] * 3, pids)
+        self.assertFalse(worker.recycle)
+        self.assertEqual(3, BatchItem.objects.filter(status=BatchItemStatus.DONE).count())
+
+    def test_recycles_after_max_jobs(self) -> None:
+        with mock.patch("eos.tasks.amex_agent") as mock_amex_agent:
+            mock_amex_agent.return_value.add_merchant.return_value = mock.Mock(json=lambda: {}), None
+            worker = PersistentWorker([self.queue], connection=tasks.redis, max_jobs=2)
+            worker.work(burst=True)
+
+        self.assertTrue(worker.recycle)
+        self.assertEqual(2, BatchItem.objects.filter(status=BatchItemStatus.DONE).count())
+        self.assertEqual(1, self.queue.count)
+
+    def test_recycles_after_memory_growth(self) -> None:
+        with mock.patch("eos.tasks.amex_agent") as mock_amex_agent, mock.patch(
+            "eos.workers.peak_rss_mb", side_effect=[100.0, 180.0, 200.0]
+        ):
+            mock_amex_agent.return_value.add_merchant.return_value = mock.Mock(json=lambda: {}), None
+            worker = PersistentWorker([self.queue], connection=tasks.redis, max_memory=100)
+            worker.work(burst=True)
+
+        self.assertTrue(worker.recycle)
+        self.assertEqual(3, worker.jobs_started)
+
+
+executed: t.List[str] = []
+
+
+def record(name: str) -> None:
+    executed.append(name)
+
+
+class TestWeightedQueues(SimpleTestCase):
+    def setUp(self) -> None:
+        self.queues = [rq.Queue(f"test-weighted-{name}", connection=tasks.redis) for name in ("a", "b")]
+        for queue in self.queues:
+            queue.empty()
+            self.addCleanup(queue.empty)
+        executed.clear()
+
+    def test_weighted_schedule(self) -> None:
+        self.assertEqual(["a", "b", "a", "c", "b", "a"], weighted_schedule({"a": 3, "b": 2, "c": 1}))
+        self.assertEqual([], weighted_schedule({"a": 0}))
+
+    def test_jobs_taken_in_weighted_round_robin(self) -> None:
+        for queue in self.queues:
+            for n in range(3):
+                queue.enqueue(record, f"{queue.name[-1]}{n}")
+
+        worker = PersistentWorker(
+            self.queues, connection=tasks.redis, weights={"test-weighted-a": 2, "test-weighted-b": 1}
+        )
+        worker.work(burst=True)
+
+        # a's turns come round twice as often as b's, and b takes the turns a has no job for
+        self.assertEqual(["a0", "a1", "b0", "a2", "b1", "b2"], executed)
+
+
+@override_settings(DISPATCH_MODE=tasks.DISPATCH_MODE_DB)
+class TestDatabaseWorker(TransactionTestCase):
+    def setUp(self) -> None:
+        self.batch = Batch.objects.create(file_name="mids.csv")
+        self.item_ids = [
+            BatchItem.objects.create(
+                batch=self.batch,
+                mid=str(mid),
+                start_date=date(2021, 2, 15),
+                end_date=date(2021, 2, 16),
+                merchant_slug="wasabi-club",
+                provider_slug="amex",
+                action=BatchItemAction.ADD,
+                status=BatchItemStatus.QUEUED,
+            ).id
+            for mid in range(6)
+        ]
+
+    def test_claimers_skip_locked_rows(self) -> None:
+        claimed: t.List[int] = []
+
+        def claim() -> None:
+            claimed.extend(tasks.claim_items(3)[0])
+            connection.close()
+
+        with transaction.atomic():
+            list(BatchItem.objects.select_for_update().filter(id__in=self.item_ids[:3]))
+            thread = threading.Thread(target=claim)
+            thread.start()
+            thread.join()
+
+        self.assertEqual(self.item_ids[3:], claimed)
+        self.assertEqual(self.item_ids[:3], tasks.claim_items(10)[0])
+        self.assertFalse(BatchItem.objects.filter(status=BatchItemStatus.QUEUED).exists())
+
+    def test_claim_skips_items_waiting_to_retry(self) -> None:
+        BatchItem.objects.filter(id=self.item_ids[0]).update(retry_at=timezone.now() + timedelta(minutes=1))
+        BatchItem.objects.filter(id=self.item_ids[1]).update(retry_at=timezone.now() - timedelta(minutes=1))
+        self.assertEqual(self.item_ids[1:], tasks.claim_items(10)[0])
+
+    def test_drains_dispatched_batch(self) -> None:
+        BatchItem.objects.update(status=BatchItemStatus.PENDING)
+        Batch.objects.update(dispatch_status=BatchDispatchStatus.PENDING)
+
+        with mock.patch("eos.tasks.amex_agent") as mock_amex_agent:
+            mock_amex_agent.return_value.add_merchant.return_value = mock.Mock(json=lambda: {}), None
+            DatabaseWorker(concurrency=2, block_size=2).work(burst=True)
+
+        self.assertEqual(len(self.item_ids), BatchItem.objects.filter(status=BatchItemStatus.DONE).count())
+        self.batch.refresh_from_db()
+        self.assertEqual(BatchDispatchStatus.DISPATCHED, self.batch.dispatch_status)
+
+    def test_stop_releases_unfinished_items(self) -> None:
+        worker = DatabaseWorker(block_size=3)
+
+        def add_merchant(*args: str) -> tuple:
+            worker.stopping.set()
+            return mock.Mock(json=lambda: {}), None
+
+        with mock.patch("eos.tasks.amex_agent") as mock_amex_agent:
+            mock_amex_agent.return_value.add_merchant.side_effect = add_merchant
+            self.assertTrue(worker.work_once())
+
+        statuses = dict(BatchItem.objects.values_list("id", "status"))
+        self.assertEqual(BatchItemStatus.DONE, statuses[self.item_ids[0]])
+        self.assertEqual([BatchItemStatus.QUEUED] * 5, [statuses[item_id] for item_id in self.item_ids[1:]])
+
+    def test_items_reclaimed_from_block_are_left_alone(self) -> None:
+        worker = DatabaseWorker(block_size=3)
+        calls = []
+
+        def add_merchant(mid: str, *args: str) -> tuple:
+            calls.append(mid)
+            # the rest of the block outlives ITEM_CLAIM_TIMEOUT and is reclaimed for another worker
+            BatchItem.objects.filter(id__in=self.item_ids[1:3]).update(claimed_at=timezone.now() - timedelta(hours=1))
+            with override_settings(DISPATCH_MODE=tasks.DISPATCH_MODE_DB):
+                tasks.reclaim_stale_items()
+            tasks.claim_items(1)
+            return mock.Mock(json=lambda: {}), None
+
+        with mock.patch("eos.tasks.amex_agent") as mock_amex_agent:
+            mock_amex_agent.return_value.add_merchant.side_effect = add_merchant
+            self.assertTrue(worker.work_once())
+
+        self.assertEqual(["0"], calls)
+        statuses = dict(BatchItem.objects.values_list("id", "status"))
+        self.assertEqual(
+            [BatchItemStatus.DONE, BatchItemStatus.IN_FLIGHT, BatchItemStatus.QUEUED],
+            [statuses[item_id] for item_id in self.item_ids[:3]],
+        )